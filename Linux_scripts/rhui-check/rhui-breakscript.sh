@@ -14,6 +14,9 @@ set -e
 # Configuration
 LOGFILE="/var/log/rhuibreak.log"
 BACKUP_DIR="/var/tmp/rhuibreak_backups"
+# Built-in RHUI addresses, replaced by the current and decommissioned entries of the rhui-check endpoint
+# catalog (RHUI_ENDPOINTS, rhui-endpoints.json next to this script or /etc/rhui-check/rhui-endpoints.json) when one is found
+RHUI_ENDPOINTS="${RHUI_ENDPOINTS:-}"
 RHUI4_IPS=("52.136.197.163" "20.225.226.182" "52.142.4.99" "20.248.180.252" "20.24.186.80")
 RHUI3_IPS=("13.91.47.76" "40.85.190.91" "52.187.75.218")
 
@@ -57,6 +60,41 @@ check_rhel() {
     fi
 }
 
+catalog_addresses() {
+    local python=$1
+    local catalog=$2
+    local status=$3
+    "$python" - "$catalog" "$status" <<'EOF'
+import json, sys
+with open(sys.argv[1]) as stream:
+    catalog = json.load(stream)
+for endpoint in catalog['endpoints']:
+    if catalog['infrastructures'][endpoint['infrastructure']]['status'] == sys.argv[2]:
+        for address in endpoint.get('addresses', []) + endpoint.get('networks', []):
+            print(address)
+EOF
+}
+
+load_endpoint_catalog() {
+    local python catalog current decommissioned
+    python=$(command -v /usr/libexec/platform-python python3 | head -n 1)
+    [[ -n "$python" ]] || return 0
+
+    for catalog in "$RHUI_ENDPOINTS" "$(dirname "$0")/rhui-endpoints.json" /etc/rhui-check/rhui-endpoints.json; do
+        [[ -n "$catalog" && -f "$catalog" ]] || continue
+        if current=$(catalog_addresses "$python" "$catalog" current 2>/dev/null) && \
+           decommissioned=$(catalog_addresses "$python" "$catalog" decommissioned 2>/dev/null) && [[ -n "$current" ]]; then
+            mapfile -t RHUI4_IPS <<< "$current"
+            RHUI3_IPS=()
+            [[ -z "$decommissioned" ]] || mapfile -t RHUI3_IPS <<< "$decommissioned"
+            log "Using RHUI addresses from $catalog"
+        else
+            log_warning "Unable to read RHUI endpoint catalog $catalog, using the built-in addresses"
+        fi
+        return 0
+    done
+}
+
 create_backup_dir() {
     mkdir -p "$BACKUP_DIR"
 }
@@ -619,6 +657,7 @@ main() {
     check_root
     check_rhel
     create_backup_dir
+    load_endpoint_catalog
     
     if [[ $# -eq 0 ]]; then
         list_scenarios
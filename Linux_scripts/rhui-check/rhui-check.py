@@ -1,12 +1,21 @@
 #!/usr/libexec/platform-python
 
 import argparse
+import bisect
+import json
 import logging
 import os
 import re
+import socket
+import struct
 import subprocess
 import time
 import sys
+try:
+    import ipaddress
+except ImportError:
+    # not part of python 2, RHEL 7 only has it when python-ipaddress is installed
+    ipaddress = None
 #import urllib.request
 eus = 0
 issues = {}
@@ -471,27 +480,122 @@ def check_repos(reposconfig):
 
     return [ enabled_repos, local_issues ]
 
-def ip_address_check(host):
-    ''' Checks whether the parameter is within the RHUI4 infrastructure '''
+def address_range(network):
+    """
+    Returns (version, first address, last address) as integers for an IP address or CIDR range.  Without the
+    ipaddress module only IPv4 is understood.
+    """
+    if ipaddress:
+        # the python 2 backport only takes unicode strings
+        network = ipaddress.ip_network(u'{}'.format(network), strict=False)
+        return (network.version, int(network.network_address), int(network.broadcast_address))
 
+    address, _, prefix = network.partition('/')
     try:
-        import socket
-    except ImportError:
-        logger.critical("'socket' python module not found, but it is required for this test script, review your python installation.")
-        exit(1) 
+        first = struct.unpack('!I', socket.inet_aton(address))[0]
+    except (socket.error, OSError):
+        raise ValueError('{} is not an IPv4 address or network'.format(network))
+    host_bits = 32 - int(prefix or 32)
+    if not 0 <= host_bits <= 32:
+        raise ValueError('{} is not an IPv4 address or network'.format(network))
+    first = first >> host_bits << host_bits
+    return (4, first, first + (1 << host_bits) - 1)
+
+class EndpointIndex(object):
+    """
+    The RHUI endpoint catalog indexed for lookups.  Every address and CIDR range of the catalog is kept sorted by its
+    first address so an IP address is classified with a binary search.  Ranges can't overlap, a catalog where they
+    do is rejected.
+    """
+
+    def __init__(self, catalog):
+        self.infrastructures = catalog['infrastructures']
+        for name, infrastructure in self.infrastructures.items():
+            if infrastructure.get('status') not in ('current', 'decommissioned'):
+                raise ValueError('infrastructure {} has no valid status'.format(name))
+
+        ranges = list()
+        for endpoint in catalog['endpoints']:
+            if endpoint['infrastructure'] not in self.infrastructures:
+                raise ValueError('unknown infrastructure {}'.format(endpoint['infrastructure']))
+            for network in endpoint.get('addresses', list()) + endpoint.get('networks', list()):
+                if not ipaddress and ':' in network:
+                    logger.debug('Skipping {}, IPv6 needs the python ipaddress module'.format(network))
+                    continue
+                version, first, last = address_range(network)
+                ranges.append(((version, first), last, network, endpoint))
+        ranges.sort(key=lambda entry: entry[0])
+
+        for previous, current in zip(ranges, ranges[1:]):
+            if previous[0][0] == current[0][0] and current[0][1] <= previous[1]:
+                raise ValueError('{} overlaps {}'.format(current[2], previous[2]))
+
+        self.starts = [ entry[0] for entry in ranges ]
+        self.ranges = ranges
+
+    def lookup(self, address):
+        """Returns the catalog endpoint an IP address belongs to, or None."""
+        try:
+            version, value, _ = address_range(address.split('/')[0])
+        except ValueError:
+            return None
+
+        position = bisect.bisect_right(self.starts, (version, value)) - 1
+        if position >= 0:
+            (range_version, first), last, network, endpoint = self.ranges[position]
+            if range_version == version and value <= last:
+                return endpoint
+        return None
+
+    def status(self, endpoint):
+        return self.infrastructures[endpoint['infrastructure']]['status']
+
+def load_endpoint_catalog(path=None):
+    """
+    Returns the indexed RHUI endpoint catalog from the first JSON catalog file found, or from the catalog built into
+    the script.  A broken catalog file found in the default locations is reported and the built-in catalog used instead,
+    a catalog given with --endpoints that can't be used stops the check, its addresses would be judged wrong otherwise.
+    """
+    if path:
+        try:
+            with open(path) as stream:
+                index = EndpointIndex(json.load(stream))
+            logger.debug('Using the RHUI endpoint catalog {}, {} address range(s)'.format(path, len(index.ranges)))
+            return index
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.critical('Unable to use the RHUI endpoint catalog {}: {}'.format(path, e))
+            exit(2)
+
+    for catalog_path in endpoint_catalog_paths:
+        if not os.path.exists(catalog_path):
+            continue
+        try:
+            with open(catalog_path) as stream:
+                index = EndpointIndex(json.load(stream))
+            logger.debug('Using the RHUI endpoint catalog {}, {} address range(s)'.format(catalog_path, len(index.ranges)))
+            return index
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning('Unable to use the RHUI endpoint catalog {}, using the built-in one: {}'.format(catalog_path, e))
+            break
+
+    return EndpointIndex(default_endpoint_catalog)
+
+def ip_address_check(host):
+    ''' Checks whether the parameter is within the RHUI4 infrastructure '''
 
     try:
         rhui_ip_address = socket.gethostbyname(host)
+        endpoint = endpoint_index.lookup(rhui_ip_address)
 
-        if rhui_ip_address  in rhui4:
-            logger.debug('RHUI host {} points to RHUI4 infrastructure.'.format(host))
+        if endpoint and endpoint_index.status(endpoint) == 'current':
+            logger.debug('RHUI host {} points to {} infrastructure ({} in {}).'.format(host, endpoint['infrastructure'].upper(), rhui_ip_address, endpoint.get('region', 'unknown region')))
             return True
-        elif rhui_ip_address in rhui3 + rhuius:
+        elif endpoint:
             reinstall_link = 'https://learn.microsoft.com/troubleshoot/azure/virtual-machines/linux/troubleshoot-linux-rhui-certificate-issues?tabs=rhel7-eus%2Crhel7-noneus%2Crhel7-rhel-sap-apps%2Crhel8-rhel-sap-apps%2Crhel9-rhel-sap-apps#solution-2-reinstall-the-eus-non-eus-or-sap-rhui-package'
             logger.error('RHUI server {} points to decommissioned infrastructure, reinstall the RHUI package'.format(host))
             logger.error('for more detailed information, use: {}'.format(reinstall_link))
             bad_hosts.append(host)
-            warnings = warnings + 1
+            issues['decommissioned_rhui'] = '{} points to {}'.format(host, rhui_ip_address)
             return False
         else:
             logger.critical('RHUI server {} points to an invalid destination, validate /etc/hosts file for any invalid static RHUI IPs or reinstall the RHUI package.'.format(host))
@@ -557,9 +661,28 @@ def connect_to_repos(reposconfig, check_repos, issues):
             issues['unable_to_connect'] = 1
             continue
 
-rhui3 = ['13.91.47.76', '40.85.190.91', '52.187.75.218']
-rhui4 = ['52.136.197.163', '20.225.226.182', '52.142.4.99', '20.248.180.252', '20.24.186.80']
-rhuius = ['13.72.186.193', '13.72.14.155', '52.224.249.194']
+# RHUI content delivery servers, same layout as rhui-endpoints.json, used when no catalog file is found
+default_endpoint_catalog = {
+    'version': 1,
+    'infrastructures': {
+        'rhui4': {'status': 'current', 'description': 'RHUI 4 content delivery servers'},
+        'rhui3': {'status': 'decommissioned', 'description': 'RHUI 3 content delivery servers'},
+        'rhuius': {'status': 'decommissioned', 'description': 'RHUI 3 content delivery servers in Azure US Government'}
+    },
+    'endpoints': [
+        {'infrastructure': 'rhui4', 'region': 'westeurope', 'addresses': ['52.136.197.163']},
+        {'infrastructure': 'rhui4', 'region': 'southcentralus', 'addresses': ['20.225.226.182']},
+        {'infrastructure': 'rhui4', 'region': 'eastus', 'addresses': ['52.142.4.99']},
+        {'infrastructure': 'rhui4', 'region': 'australiaeast', 'addresses': ['20.248.180.252']},
+        {'infrastructure': 'rhui4', 'region': 'southeastasia', 'addresses': ['20.24.186.80']},
+        {'infrastructure': 'rhui3', 'addresses': ['13.91.47.76', '40.85.190.91', '52.187.75.218']},
+        {'infrastructure': 'rhuius', 'addresses': ['13.72.186.193', '13.72.14.155', '52.224.249.194']}
+    ]
+}
+# where a catalog file is looked for when --endpoints isn't used, the first one found wins
+endpoint_catalog_paths = [ '/etc/rhui-check/rhui-endpoints.json' ]
+if os.path.isfile(sys.argv[0]):
+    endpoint_catalog_paths.insert(0, os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'rhui-endpoints.json'))
 system_proxy = dict()
 bad_hosts = list()
  
@@ -577,8 +700,12 @@ parser = argparse.ArgumentParser()
 parser.add_argument(  '--debug','-d',
                       action='store_true',
                       help='Use DEBUG level')
+parser.add_argument(  '--endpoints',
+                      metavar='FILE',
+                      help='RHUI endpoint catalog (JSON) to validate the RHUI server addresses against, instead of rhui-endpoints.json next to the script, /etc/rhui-check/rhui-endpoints.json or the built-in catalog')
 args = parser.parse_args()
 logger = start_logging(args.debug)
+endpoint_index = load_endpoint_catalog(args.endpoints)
 
 try:
     import requests
@@ -1,12 +1,27 @@
 #!/usr/libexec/platform-python
 
 import argparse
+import atexit
+import base64
+import bisect
+import heapq
+import ipaddress
+import json
 import logging
 import os
+import random
 import re
+import shlex
+import signal
+import socket
 import subprocess
+import threading
 import time
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from string import Template
+from xml.etree import ElementTree
 import sys
 #import urllib.request
 
@@ -15,6 +30,8 @@ script_start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 eus = 0
 issues = {}
+# problems that don't fail the check yet, like a client certificate about to expire
+check_warnings = {}
 
 ######################################################
 # logger the output of the script into /var/log/rhuicheck.log file
@@ -50,7 +67,7 @@ class CustomFormatter(logging.Formatter):
 
 
 
-def start_logging(debug_level = False):
+def start_logging(debug_level = False, log_file = True):
     """This function sets up the logging configuration for the script and writes the log to /var/log/rhuicheck.log"""
 
     logger = logging.getLogger(__name__)
@@ -70,13 +87,23 @@ def start_logging(debug_level = False):
         
         logger.addHandler(console_handler)
 
+    if not log_file:
+        # fleet mode runs from an admin workstation, the per-host logs stay on each host
+        if not logger.handlers:
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(plain_formatter)
+            console_handler.setLevel(logging.DEBUG if debug_level else logging.INFO)
+            logger.addHandler(console_handler)
+        logger.setLevel(logging.DEBUG)
+        return logger
+
     try:
         log_filename = '/var/log/rhuicheck.log'
         file_handler = logging.FileHandler(filename=log_filename)
         file_handler.setFormatter(plain_formatter)    
     except:
         logger.critical("Unable to create log file in /var/log/rhuicheck.log, make sure the script is running with root privileges, the filesystem has enough space and it's not in Read-Only mode.")
-        exit(1)
+        stop_check('log_file_error', 'unable to create /var/log/rhuicheck.log')
     else:
         file_handler.setLevel(logging.DEBUG)
         logger.addHandler(file_handler)
@@ -85,8 +112,7 @@ def start_logging(debug_level = False):
     return logger
        
 def get_host(url):
-    urlregex = r'[^:]*://([^/]*)/.*'
-    host_match = re.match(urlregex, url)
+    host_match = url_regex.match(url)
     return host_match.group(1)
 
 def validate_ca_certificates():
@@ -101,59 +127,150 @@ def validate_ca_certificates():
     except:
         logger.error('Unable to check server side certificates installed in the server.')
         logger.error('Use {} to reinstall the ca-certificates'.format(reinstall_ca_bundle_link))
-        if not sys.stdout.isatty():
+        if not sys.stdout.isatty() and args.format == 'text':
             print("ERROR: Unable to verify ca-certificates package")
         issues['ca_cert_check_failed'] = 'Unable to verify ca-certificates package'
         return False
    
     if result:
         logger.error('The ca-certificate package is invalid, you can reinstall it. Follow {} to reinstall it manually'.format(reinstall_ca_bundle_link))
-        if not sys.stdout.isatty():
+        if not sys.stdout.isatty() and args.format == 'text':
             print("ERROR: ca-certificates package verification failed - package is corrupted or modified")
         issues['ca_cert_invalid'] = 'ca-certificates package is corrupted or modified'
         return False
     else:
         return True
 
-def connect_to_host(url, selection, mysection):
-    from string import Template
+class HostFacts(object):
+    """
+    The values the yum variables in the RHUI baseurls expand to on this host, worked out once per run instead of for
+    every baseurl.  Each fact is computed the first time it is used, reset() forgets them all when the configuration
+    changes in monitor mode.
+    """
 
-    temp_url = Template(url)
-    url_host = get_host(url)
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.facts = dict()
+        # expanded repomd.xml URLs, {(baseurl, releasever): url}
+        self.urls = dict()
+
+    def fact(self, name, compute):
+        if name not in self.facts:
+            self.facts[name] = compute()
+        return self.facts[name]
+
+    @property
+    def uname(self):
+        def compute():
+            try:
+                return os.uname()
+            except:
+                logger.critical('Unable to identify OS version.')
+                exit(1)
+        return self.fact('uname', compute)
+
+    @property
+    def basearch(self):
+        def compute():
+            try:
+                return self.uname.machine
+            except AttributeError:
+                return self.uname[-1]
+        return self.fact('basearch', compute)
+
+    @property
+    def baserelease(self):
+        def compute():
+            try:
+                return self.uname.release
+            except AttributeError:
+                return self.uname[2]
+        return self.fact('baserelease', compute)
+
+    @property
+    def major_release(self):
+        """The EL major version of the running kernel, '7' for an el7 kernel."""
+        return self.fact('major_release', lambda: releasever_regex.sub(r'\1', self.baserelease))
+
+    @property
+    def os_releasever(self):
+        return self.fact('os_releasever', lambda: '7Server' if self.major_release == '7' else self.major_release)
+
+    @property
+    def eus_releasever(self):
+        def compute():
+            with open('/etc/yum/vars/releasever') as fd:
+                return fd.readline().strip()
+        return self.fact('eus_releasever', compute)
+
+    @property
+    def releasever(self):
+        """The locked EUS release when EUS repositories are in use, the OS release otherwise."""
+        if eus and not 'eus_missing' in issues:
+            return self.eus_releasever
+        return self.os_releasever
+
+    def expand(self, url):
+        key = (url, self.releasever)
+        if key not in self.urls:
+            mydict = dict(releasever=self.releasever, basearch=self.basearch, arch=self.basearch)
+            self.urls[key] = Template(url).substitute(mydict) + "/repodata/repomd.xml"
+        return self.urls[key]
 
-    try:
-        uname = os.uname()
-    except:
-        logger.critical('Unable to identify OS version.')
-        exit(1)    
+    def as_dict(self):
+        return {'basearch': self.basearch, 'baserelease': self.baserelease, 'releasever': self.releasever, 'eus': bool(eus)}
 
-    try:
-        basearch = uname.machine
-    except AttributeError:
-        basearch = uname[-1]
+def expand_baseurl(url):
+    """Replaces the yum variables in a baseurl and returns the URL of its repomd.xml."""
+    return host_facts.expand(url)
 
+def valid_repomd(content):
+    """Whether a downloaded repomd.xml is complete XML with a repomd root element."""
     try:
-        baserelease = uname.release
-    except AttributeError:
-        baserelease = uname[2]
-
-    if eus and not 'eus_missing' in issues:
-        fd = open('/etc/yum/vars/releasever')
-        releasever = fd.readline().strip()
-    else:
-        releasever  = re.sub(r'^.*el([0-9][0-9]*).*',r'\1',baserelease)
-        if releasever == '7':
-            releasever = '7Server'
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError:
+        return False
+    return root.tag.split('}')[-1] == 'repomd'
 
-    mydict = dict(releasever=releasever, basearch=basearch, arch=basearch)
+def fetch_repomd(session, url, cert, proxies):
+    """
+    Requests one repomd.xml the way --probe says and returns the response.
+    head sends a HEAD request, conditional a GET with the ETag and Last-Modified of the last run, which the server answers
+    with 304 Not Modified when the repository hasn't changed. Only get downloads the body so it can be validated.
+    """
+    mode = args.probe
+    if mode == 'head':
+        r = session.head(url, cert=cert, timeout=5, proxies=proxies, allow_redirects=True)
+        if r.status_code not in (405, 501):
+            return r
+        # servers that don't implement HEAD get the conditional GET instead
+        logger.debug('HEAD not supported for {}, RC {}'.format(url, r.status_code))
+        mode = 'conditional'
+
+    if mode == 'get':
+        return session.get(url, cert=cert, timeout=5, proxies=proxies)
+
+    r = session.get(url, cert=cert, headers=repomd_validators.headers(url), timeout=5, proxies=proxies, stream=True)
+    if r.status_code == 304:
+        repomd_validators.not_modified += 1
+    elif r.status_code == 200:
+        repomd_validators.update(url, r.headers)
+    # a repomd.xml is a few KB, less than a new TLS handshake, so finish reading it to keep the connection for the
+    # next repository of the host, larger or unknown sizes close the connection instead
+    if r.status_code == 304 or int(r.headers.get('content-length') or repomd_drain_limit + 1) <= repomd_drain_limit:
+        r.content
+    r.close()
+    return r
 
-    newurl = temp_url.substitute(mydict)
-    url = newurl+"/repodata/repomd.xml"
+def connect_to_host(url, selection, mysection):
+    """Probes the repomd.xml of one baseurl, returns (success, error class) with the error class None on success."""
+    url_host = get_host(url)
+    url = expand_baseurl(url)
 
     logger.debug('baseurl for repo {} is {}'.format(mysection, url))
 
-    headers = {'content-type': 'application/json'}
-    s = requests.Session()
     local_proxy = get_proxies(selection, mysection)
 
     cert = ()
@@ -162,51 +279,157 @@ def connect_to_host(url, selection, mysection):
     except:
         cert=()
 
+    s = session_pool.get(url_host, cert, local_proxy)
+
     try:
-        r = s.get(url, cert=cert, headers=headers, timeout=5, proxies=local_proxy)
+        r = fetch_repomd(s, url, cert, local_proxy)
     except requests.exceptions.Timeout:
         logger.warning('TIMEOUT: Unable to reach RHUI URI {}'.format(url))
         bad_hosts.append(url_host)
-        return False
+        return False, 'timeout'
     except requests.exceptions.SSLError:
         if not validate_ca_certificates():
             logger.warning('PROBLEM: CA certificates are invalid or corrupted')
         else:
             logger.warning('PROBLEM: MITM proxy misconfiguration. Proxy cannot intercept certs for {}'.format(url))
         bad_hosts.append(url_host)
-        return False
+        return False, 'ssl_error'
     except requests.exceptions.ProxyError:
         logger.warning('PROBLEM: Unable to use the proxy gateway when connecting to RHUI server {}'.format(url))
         bad_hosts.append(url_host)
-        return False
+        return False, 'proxy_error'
     except requests.exceptions.ConnectionError as e:
         logger.warning('PROBLEM: Unable to establish connectivity to RHUI server {}'.format(url))
         logger.error('{}'.format(e))
         bad_hosts.append(url_host)
-        return False
+        return False, 'connection_error'
     except OSError:
         if not validate_ca_certificates():
             logger.warning('PROBLEM: CA certificates are invalid or corrupted')
         bad_hosts.append(url_host)
-        return False
+        return False, 'os_error'
     except Exception as e:
         logger.warning('PROBLEM: Unknown error, unable to connect to the RHUI server {}'.format(url))
         bad_hosts.append(url_host)
         raise(e)
-        return False
     else:
-        if r.status_code == 200:
+        if r.status_code in (200, 304):
             logger.debug('The RC for this {} link is {}'.format(url, r.status_code))
-            return True
+            if args.probe == 'get' and not valid_repomd(r.content):
+                logger.error('The repomd.xml of repo {} is not valid, a proxy or firewall may be altering the RHUI content: {}'.format(mysection, url))
+                bad_hosts.append(url_host)
+                return False, 'invalid_repomd'
+            return True, None
         elif r.status_code == 404:
             logger.error("Unable to find the contents for repo {}, make sure to use the correct version lock if you're using EUS repositories".format(mysection))
             logger.error("For more detailed information and valid levels consult: https://aka.ms/rhlifecycle#RHEL8_and_9_Life_Cycle")
             bad_hosts.append(url_host)
-            return False
+            return False, 'http_404'
         else:
             logger.warning('The RC for this {} link is {}'.format(url, r.status_code))
             bad_hosts.append(url_host)
-            return False
+            return False, 'http_{}'.format(r.status_code)
+
+class RepomdValidators(object):
+    """
+    ETag and Last-Modified of every repomd.xml from the last run, sent back with the conditional probes so the RHUI
+    servers can answer 304 Not Modified instead of sending a repomd.xml that hasn't changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.validators = dict()
+        self.changed = False
+        self.not_modified = 0
+
+    def load(self):
+        try:
+            with open(self.path) as stream:
+                data = json.load(stream)
+            if data.get('version') == 1:
+                self.validators = data['validators']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logger.debug('No repomd.xml validators loaded from {}: {}'.format(self.path, e))
+
+    def headers(self, url):
+        cached = self.validators.get(url, dict())
+        headers = dict()
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+
+    def update(self, url, response_headers):
+        entry = {'etag': response_headers.get('etag'), 'last_modified': response_headers.get('last-modified')}
+        if (entry['etag'] or entry['last_modified']) and self.validators.get(url) != entry:
+            self.validators[url] = entry
+            self.changed = True
+
+    def save(self):
+        """Writes the validators when they changed, replacing the file in one step like the status file."""
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = '{}.{}'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as stream:
+                json.dump({'version': 1, 'validators': self.validators}, stream, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+            self.changed = False
+        except (IOError, OSError) as e:
+            logger.debug('Unable to save the repomd.xml validators in {}: {}'.format(self.path, e))
+
+class SessionPool(object):
+    """
+    Keeps one keep-alive requests.Session per (host, client certificate, proxy), so every
+    repository served by the same RHUI CDS reuses the TLS connection instead of doing a new handshake.
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = max(1, maxsize)
+        self.sessions = dict()
+        self.requests = 0
+        # connections of closed sessions, still counted in the report
+        self.closed_connections = 0
+        self.lock = threading.Lock()
+
+    def get(self, host, cert, proxies):
+        key = (host, tuple(cert), tuple(sorted((proxies or {}).items())))
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                logger.debug('Opening new connection pool for {}'.format(host))
+                session = requests.Session()
+                # the pool must be as large as the number of workers or parallel probes discard connections
+                adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=self.maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[key] = session
+            self.requests += 1
+        return session
+
+    def connections(self):
+        """Number of connections (and therefore TLS handshakes) opened by all the sessions."""
+        total = self.closed_connections
+        for session in self.sessions.values():
+            adapter = session.get_adapter('https://')
+            managers = [ adapter.poolmanager ] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for pool_key in manager.pools.keys():
+                    pool = manager.pools.get(pool_key)
+                    if pool is not None:
+                        total += pool.num_connections
+        return total
+
+    def handshakes_saved(self):
+        return max(0, self.requests - self.connections())
+
+    def close(self):
+        self.closed_connections = self.connections()
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
 
 def rpm_names():
     """
@@ -223,7 +446,7 @@ def rpm_names():
     else:
         logger.critical('Could not find a specific RHUI package installed, please refer to the documentation and install the apropriate one. ')
         logger.critical('Consider using the following document to install RHUI support https://aka.ms/tsrhuicert#cause-3-rhui-package-is-missing')
-        exit(1) 
+        stop_check('rhuipkg_missing', 'no rhui-* package installed')
 
 def get_pkg_info(package_name):
     ''' Identifies rhui package name(s)'''
@@ -235,16 +458,17 @@ def get_pkg_info(package_name):
         info = result.stdout.read().decode('utf-8').strip().splitlines()
         
         hash_info = {}
-        for key in pattern.keys():
-            logger.debug('checking key {}'.format(key))
-            for data in info:
-                logger.debug('checking key {} and data {}'.format(key, data))
-                if re.match(pattern[key], data):
-                    hash_info[key] = data
+        # single pass over the file list, the first file matching each pattern is kept
+        for data in info:
+            match = pattern_regex.match(data)
+            if match and match.lastgroup not in hash_info:
+                hash_info[match.lastgroup] = data
+                if len(hash_info) == len(pattern):
                     break
+        logger.debug('%s package files: %s', package_name, hash_info)
     except:
         logger.critical('Failed to grab RHUI RPM details, rebuild RPM database.')
-        exit(1)
+        stop_check('rpmdb_error', 'unable to list the files of {}'.format(package_name))
     else:
         return hash_info
 
@@ -265,55 +489,127 @@ def verify_pkg_info(package_name, rpm_info):
     if errors:
         data_link = "https://aka.ms/tsrhuicert#cause-2-rhui-certificate-is-missing"
         logger.critical('follow {} for information to install the RHUI package'.format(data_link))
-        exit(1)
+        stop_check('rhuipkg_invalid', '{} file(s) of {} missing'.format(errors, package_name))
 
     return True
 
-def default_policy():
-    """"Returns a boolean whether the default encryption policies are set to default via the /etc/crypto-policies/config file, if it can't test it, the result will be set to true."""
-    try:
-        uname = os.uname()
-    except:
-        logger.critical('Unable to identify OS version.')
-        exit(1)    
-
+def crypto_policy():
+    """Returns the system wide crypto policy as update-crypto-policies --show would, None if it can't be read."""
     try:
-        baserelease = uname.release
-    except AttributeError:
-        baserelease = uname[2]
+        with open('/etc/crypto-policies/config') as stream:
+            for line in stream:
+                line = line.split('#')[0].strip()
+                if line:
+                    return line
+    except (IOError, OSError):
+        return None
+    return 'DEFAULT'
 
-    policy_releasever  = re.sub(r'^.*el([0-9][0-9]*).*',r'\1',baserelease)
+def default_policy():
+    """"Returns a boolean whether the default encryption policies are set to default via the /etc/crypto-policies/config file, if it can't test it, the result will be set to true."""
+    policy_releasever  = host_facts.major_release
 
     # return true for EL7
     if policy_releasever == '7':
         return True
 
-    try:
-        policy = subprocess.check_output('/bin/update-crypto-policies --show', shell=True)
-        policy = policy.decode('utf-8').strip()
-        if policy != 'DEFAULT':
-            return False
-    except:
-        return True
+    policy = crypto_policy()
+    if policy and policy != 'DEFAULT':
+        return False
 
     return True
 
+def read_certificate_cryptography(cert_path):
+    """Returns the not_after date, key type, key size and signature algorithm OID of a PEM certificate with the cryptography module."""
+    try:
+        with open(cert_path, 'rb') as stream:
+            cert = x509.load_pem_x509_certificate(stream.read(), default_backend())
+    except (IOError, OSError) as e:
+        raise ValueError(str(e))
+
+    not_after = getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after.replace(tzinfo=timezone.utc)
+    public_key = cert.public_key()
+    if isinstance(public_key, rsa.RSAPublicKey):
+        key_type = 'RSA'
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        key_type = 'EC'
+    else:
+        key_type = type(public_key).__name__.strip('_').replace('PublicKey', '')
+    return not_after, key_type, getattr(public_key, 'key_size', None), cert.signature_algorithm_oid.dotted_string
+
+def read_certificate_openssl(cert_path):
+    """Same as read_certificate_cryptography() from the openssl x509 text output, for systems without the cryptography module."""
+    try:
+        result = subprocess.run(['openssl', 'x509', '-noout', '-text', '-in', cert_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError as e:
+        raise ValueError('unable to run openssl: {}'.format(e))
+    if result.returncode:
+        error = result.stderr.strip().splitlines()
+        raise ValueError(error[0] if error else 'openssl returned RC {}'.format(result.returncode))
+
+    not_after = openssl_not_after_regex.search(result.stdout)
+    if not not_after:
+        raise ValueError('no expiration date found')
+    not_after = datetime.strptime(not_after.group(1).strip(), '%b %d %H:%M:%S %Y GMT').replace(tzinfo=timezone.utc)
+    key_type = openssl_key_regex.search(result.stdout)
+    key_type = key_names.get(key_type.group(1), key_type.group(1)) if key_type else None
+    key_size = openssl_key_size_regex.search(result.stdout)
+    signature = openssl_signature_regex.search(result.stdout)
+    return not_after, key_type, int(key_size.group(1)) if key_size else None, signature.group(1) if signature else None
+
+def inspect_certificate(cert_path):
+    """
+    Reads a PEM certificate and returns a dict with its not_after date (UTC), days_left, key_type, key_size and
+    signature algorithm, with the cryptography module when it's installed and openssl otherwise.
+    Each certificate is parsed once and only again if the file changes, a certificate that can't be read raises ValueError.
+    """
+    stamp = file_stamp(cert_path)
+    if cert_path in cert_cache and cert_cache[cert_path][0] == stamp:
+        return cert_cache[cert_path][1]
+
+    if x509 is not None:
+        not_after, key_type, key_size, signature = read_certificate_cryptography(cert_path)
+    else:
+        not_after, key_type, key_size, signature = read_certificate_openssl(cert_path)
+
+    info = {
+        'not_after': not_after,
+        'days_left': (not_after - datetime.now(timezone.utc)).days,
+        'key_type': key_type,
+        'key_size': key_size,
+        'signature': signature_names.get(signature, signature),
+    }
+    cert_cache[cert_path] = (stamp, info)
+    return info
+
 def expiration_time(cert_path):
     """ 
-    Checks whether client certificate stored at cert_path has expired or not.
+    Checks whether client certificate stored at cert_path has expired or not, and warns when it expires within
+    the --cert-warn-days window. Returns None when the certificate can't be read.
     """
     logger.debug('Entering expiration_time()')
     logger.debug('Checking certificate expiration time.')
     try:
-        result = subprocess.check_call('openssl x509 -in {} -checkend 0 > /dev/null 2>&1 '.format(cert_path),shell=True)
-
-    except subprocess.CalledProcessError:
+        cert_info = inspect_certificate(cert_path)
+    except ValueError as e:
+        logger.critical('Unable to read the client RHUI certificate {}: {}'.format(cert_path, e))
+        logger.critical('Reinstall the RHUI rpm to restore it.')
+        issues['unreadable_cert'] = '{}: {}'.format(cert_path, e)
+        return None
+
+    if cert_info['not_after'] <= datetime.now(timezone.utc):
         logger.critical('Client RHUI Certificate has expired, please update the RHUI rpm.')
         logger.critical('Refer to: https://aka.ms/tsrhuicert#cause-1-rhui-client-certificate-is-expired')
         return False
 
+    logger.debug('Client RHUI certificate {} expires {} UTC, {} {}-bit key signed with {}'.format(cert_path, cert_info['not_after'], cert_info['key_type'], cert_info['key_size'], cert_info['signature']))
+    if cert_info['days_left'] < args.cert_warn_days:
+        logger.warning('Client RHUI Certificate expires in {} days ({} UTC), update the RHUI rpm before it does.'.format(cert_info['days_left'], cert_info['not_after']))
+        check_warnings['cert_expiring'] = 'expires in {} days'.format(cert_info['days_left'])
+
     if not default_policy():
         logger.critical('Client crypto policies not set to DEFAULT.')
+        logger.critical('The client certificate uses a {}-bit {} key signed with {}.'.format(cert_info['key_size'], cert_info['key_type'], cert_info['signature']))
         logger.critical('Refer to: https://aka.ms/tsrhuicert?tabs=rhel8-eus%2Crhel7-noneus%2Crhel79-rhel-sap-apps-base%2Crhel8-rhel-sap-apps%2Crhel9-rhel-sap-apps#cause-5-verification-error-in-rhel-version-8-9-or-10-ca-certificate-key-too-weak')
         return False
 
@@ -371,7 +667,7 @@ def get_proxies(parser_object, mysection):
                 proxy_info['scheme'] = 'https'
             else:
                 logger.critical('Invalid proxy configuration, please make sure you are using a valid proxy in your settings.')
-                exit(1)
+                stop_check('invalid_proxy', 'invalid proxy in {}'.format(mysection))
         else:
             return system_proxy
     except KeyError:
@@ -423,21 +719,19 @@ def check_rhui_repo_file(path):
 
     except configparser.ParsingError:
         logger.critical('{} does not follow standard REPO config format, reinstall the RHUI rpm and try again.'.format(path))
-        exit(1)
+        stop_check('invalid_repoconfig', '{} is not a valid repository file'.format(path))
 
 def check_repos(reposconfig):
     """ Checks whether the rhui-microsoft-azure-* repository exists and tests whether it's enabled or not."""
     global eus 
 
     logger.debug('Entering microsoft_repo()')
-    rhuirepo = r'^(rhui-)?microsoft.*'
-    eusrepo  = r'.*-(eus|e4s)-.*'
     microsoft_reponame = ''
     enabled_repos = list()
     local_issues = {}
 
     for repo_name in reposconfig.sections():
-        if re.match(r'\[*default\]*', repo_name):
+        if default_regex.match(repo_name):
             continue
 
         try:
@@ -446,7 +740,7 @@ def check_repos(reposconfig):
             enabled = 1
         
     
-        if re.match(rhuirepo, repo_name):
+        if rhuirepo_regex.match(repo_name):
             microsoft_reponame = repo_name
             if enabled:
                 logger.info('Using Microsoft RHUI repository {}'.format(repo_name))
@@ -462,7 +756,7 @@ def check_repos(reposconfig):
         else:
            continue
 
-        if re.match(eusrepo, repo_name):
+        if eusrepo_regex.match(repo_name):
             eus = 1
 
     if not microsoft_reponame:
@@ -484,62 +778,294 @@ def check_repos(reposconfig):
 
     return [ enabled_repos, local_issues ]
 
-def ip_address_check(host):
-    ''' Checks whether the parameter is within the RHUI4 infrastructure '''
+class EndpointIndex(object):
+    """
+    The RHUI endpoint catalog indexed for lookups.  Every address and CIDR range of the catalog becomes an
+    ipaddress network, kept sorted by its first address so an IP address is classified with a binary search.
+    Ranges can't overlap, a catalog where they do is rejected.
+    """
 
-    try:
-        import socket
-    except ImportError:
-        logger.critical("'socket' python module not found, but it is required for this test script, review your python installation.")
-        exit(1) 
+    def __init__(self, catalog):
+        self.infrastructures = catalog['infrastructures']
+        for name, infrastructure in self.infrastructures.items():
+            if infrastructure.get('status') not in ('current', 'decommissioned'):
+                raise ValueError('infrastructure {} has no valid status'.format(name))
+
+        ranges = list()
+        for endpoint in catalog['endpoints']:
+            if endpoint['infrastructure'] not in self.infrastructures:
+                raise ValueError('unknown infrastructure {}'.format(endpoint['infrastructure']))
+            for network in endpoint.get('addresses', list()) + endpoint.get('networks', list()):
+                # a single address becomes a /32 (or /128) network
+                network = ipaddress.ip_network(network, strict=False)
+                ranges.append(((network.version, int(network.network_address)), int(network.broadcast_address), network, endpoint))
+        ranges.sort(key=lambda entry: entry[0])
+
+        for previous, current in zip(ranges, ranges[1:]):
+            if previous[0][0] == current[0][0] and current[0][1] <= previous[1]:
+                raise ValueError('{} overlaps {}'.format(current[2], previous[2]))
+
+        self.starts = [ entry[0] for entry in ranges ]
+        self.ranges = ranges
+
+    def lookup(self, address):
+        """Returns the catalog endpoint an IP address belongs to, or None."""
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+
+        position = bisect.bisect_right(self.starts, (address.version, int(address))) - 1
+        if position >= 0:
+            (version, first), last, network, endpoint = self.ranges[position]
+            if version == address.version and int(address) <= last:
+                return endpoint
+        return None
+
+    def status(self, endpoint):
+        return self.infrastructures[endpoint['infrastructure']]['status']
+
+def load_endpoint_catalog(path=None, data=None):
+    """
+    Returns the indexed RHUI endpoint catalog from the first JSON catalog file found, or from the catalog built into
+    the script.  A broken catalog file found in the default locations is reported and the built-in catalog used instead,
+    a catalog given with --endpoints that can't be used stops the check, its addresses would be judged wrong otherwise.
+    data is the base64 encoded catalog fleet mode sends along with the script, it wins over any catalog file.
+    """
+    if data:
+        try:
+            index = EndpointIndex(json.loads(base64.b64decode(data).decode('utf-8')))
+            logger.debug('Using the RHUI endpoint catalog sent by fleet mode, {} address range(s)'.format(len(index.ranges)))
+            return index
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.critical('Unable to use the RHUI endpoint catalog sent by fleet mode: {}'.format(e))
+            stop_check('invalid_endpoints', 'unable to use the RHUI endpoint catalog sent by fleet mode: {}'.format(e))
+
+    if path:
+        try:
+            with open(path) as stream:
+                index = EndpointIndex(json.load(stream))
+            logger.debug('Using the RHUI endpoint catalog {}, {} address range(s)'.format(path, len(index.ranges)))
+            return index
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.critical('Unable to use the RHUI endpoint catalog {}: {}'.format(path, e))
+            stop_check('invalid_endpoints', 'unable to use the RHUI endpoint catalog {}: {}'.format(path, e))
+
+    for catalog_path in endpoint_catalog_paths:
+        if not os.path.exists(catalog_path):
+            continue
+        try:
+            with open(catalog_path) as stream:
+                index = EndpointIndex(json.load(stream))
+            logger.debug('Using the RHUI endpoint catalog {}, {} address range(s)'.format(catalog_path, len(index.ranges)))
+            return index
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning('Unable to use the RHUI endpoint catalog {}, using the built-in one: {}'.format(catalog_path, e))
+            break
+
+    return EndpointIndex(default_endpoint_catalog)
 
+def resolve_host(host):
+    """
+    Returns (addresses, error) for a RHUI host, with every IPv4 address getaddrinfo returned and not just the first one.
+    The RHUI servers are IPv4 only, AAAA answers of a dual-stack resolver are left out so they aren't mistaken for
+    invalid RHUI addresses. The host is only resolved the first time it is asked for, failures are kept too so a broken resolver costs one
+    timeout per host instead of one per repository.
+    """
+    if host in dns_cache:
+        return dns_cache[host]
+
+    addresses = list()
+    error = None
     try:
-        rhui_ip_address = socket.gethostbyname(host)
+        for family, socktype, proto, canonname, sockaddr in socket.getaddrinfo(host, 443, family=socket.AF_INET, proto=socket.IPPROTO_TCP):
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+    except (OSError, UnicodeError) as e:
+        error = e
+
+    logger.debug('RHUI host {} resolves to {}'.format(host, ', '.join(addresses) or error))
+    return dns_cache.setdefault(host, (addresses, error))
+
+def resolve_hosts(hosts, workers):
+    """Resolves the hosts that haven't been resolved yet, all at the same time."""
+    pending = [ host for host in set(hosts) if host and host not in dns_cache ]
+    if not pending:
+        return
+
+    logger.debug('Resolving {} RHUI host(s) using {} worker(s)'.format(len(pending), min(max(1, workers), len(pending))))
+    with ThreadPoolExecutor(max_workers=min(max(1, workers), len(pending))) as executor:
+        list(executor.map(resolve_host, pending))
+
+def rhui_infrastructure(address):
+    """Returns the RHUI endpoint catalog entry an IP address belongs to, or None if it isn't a RHUI address."""
+    return endpoint_index.lookup(address)
+
+def classify_host(host):
+    """
+    Returns (status, addresses, error) for a RHUI host.  status is 'passed' when every address is a current RHUI
+    address, otherwise 'unresolved', 'decommissioned' or 'invalid', addresses is a list of (address, catalog endpoint or None).
+    """
+    addresses, error = resolve_host(host)
+    if not addresses:
+        return 'unresolved', list(), error
 
-        if rhui_ip_address  in rhui4:
-            logger.debug('RHUI host {} points to RHUI4 infrastructure.'.format(host))
-            return True
-        elif rhui_ip_address in rhui3 + rhuius:
-            reinstall_link = 'https://learn.microsoft.com/troubleshoot/azure/virtual-machines/linux/troubleshoot-linux-rhui-certificate-issues?tabs=rhel7-eus%2Crhel7-noneus%2Crhel7-rhel-sap-apps%2Crhel8-rhel-sap-apps%2Crhel9-rhel-sap-apps#solution-2-reinstall-the-eus-non-eus-or-sap-rhui-package'
-            logger.error('RHUI server {} points to decommissioned infrastructure, reinstall the RHUI package'.format(host))
-            logger.error('for more detailed information, use: {}'.format(reinstall_link))
-            bad_hosts.append(host)
-            warnings = warnings + 1
-            return False
-        else:
-            logger.critical('RHUI server {} points to an invalid destination, validate /etc/hosts file for any invalid static RHUI IPs or reinstall the RHUI package.'.format(host))
-            logger.warning('Please make sure your server is able to resolve {} to one of the ip addresses'.format(host))
-            rhui_link = 'https://aka.ms/rhui?tabs=rhel7#the-ips-for-the-rhui-content-delivery-servers'
-            logger.warning('listed in this document {}'.format(rhui_link))
-            return False
-    except Exception as e:
+    infrastructure = [ (address, rhui_infrastructure(address)) for address in addresses ]
+    if [ address for address, endpoint in infrastructure if endpoint and endpoint_index.status(endpoint) == 'decommissioned' ]:
+        return 'decommissioned', infrastructure, None
+    if [ address for address, endpoint in infrastructure if endpoint is None ]:
+        return 'invalid', infrastructure, None
+    return 'passed', infrastructure, None
+
+def ip_address_check(host):
+    ''' Checks whether every address of the parameter is within the RHUI4 infrastructure '''
+
+    status, infrastructure, error = classify_host(host)
+
+    if status == 'unresolved':
          logger.warning('Unable to resolve IP address for host {}.'.format(host))
          logger.warning('Please make sure your server is able to resolve {} to one of the IP addresses.'.format(host))
          rhui_link = 'https://aka.ms/rhui?tabs=rhel7#the-ips-for-the-rhui-content-delivery-servers'
          logger.warning('listed in this document {}'.format(rhui_link ))
-         logger.warning(e)
+         logger.warning(error)
          return False
 
-def connect_to_repos(reposconfig, check_repos, issues):
-    """Downloads repomd.xml from each enabled repository."""
+    if status == 'passed':
+        for address, endpoint in infrastructure:
+            logger.debug('RHUI host {} points to {} infrastructure ({} in {}).'.format(host, endpoint['infrastructure'].upper(), address, endpoint.get('region', 'unknown region')))
+        return True
+    elif status == 'decommissioned':
+        decommissioned = [ address for address, endpoint in infrastructure if endpoint and endpoint_index.status(endpoint) == 'decommissioned' ]
+        reinstall_link = 'https://learn.microsoft.com/troubleshoot/azure/virtual-machines/linux/troubleshoot-linux-rhui-certificate-issues?tabs=rhel7-eus%2Crhel7-noneus%2Crhel7-rhel-sap-apps%2Crhel8-rhel-sap-apps%2Crhel9-rhel-sap-apps#solution-2-reinstall-the-eus-non-eus-or-sap-rhui-package'
+        logger.error('RHUI server {} points to decommissioned infrastructure ({}), reinstall the RHUI package'.format(host, ', '.join(decommissioned)))
+        logger.error('for more detailed information, use: {}'.format(reinstall_link))
+        bad_hosts.append(host)
+        issues['decommissioned_rhui'] = '{} points to {}'.format(host, ', '.join(decommissioned))
+        return False
+    else:
+        invalid = [ address for address, endpoint in infrastructure if endpoint is None ]
+        logger.critical('RHUI server {} points to an invalid destination ({}), validate /etc/hosts file for any invalid static RHUI IPs or reinstall the RHUI package.'.format(host, ', '.join(invalid)))
+        logger.warning('Please make sure your server is able to resolve {} to one of the ip addresses'.format(host))
+        rhui_link = 'https://aka.ms/rhui?tabs=rhel7#the-ips-for-the-rhui-content-delivery-servers'
+        logger.warning('listed in this document {}'.format(rhui_link))
+        return False
 
-    logger.debug('Entering connect_to_repos()')
-    rhuirepo = r'^(rhui-)?microsoft.*'
-    eusrepo  = r'.*-(eus|e4s)-.*'
+class ProbeLogBuffer(logging.Filter):
+    """
+    Holds back the records logged by a probe worker thread so they can be replayed
+    in repository order once every probe has finished.
+    """
+
+    def __init__(self):
+        super(ProbeLogBuffer, self).__init__()
+        self.local = threading.local()
+
+    def capture(self, records):
+        self.local.records = records
+
+    def release(self):
+        self.local.records = None
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+class RepoProbe(object):
+    """A single baseurl of an enabled repository waiting to be probed, and the record of how the probe went."""
+
+    def __init__(self, repo_name, url):
+        self.repo_name = repo_name
+        self.url = url
+        self.host = get_host(url)
+        self.records = list()
+        self.result = False
+        # probes of a host that already failed are never started
+        self.status = 'skipped'
+        self.error = 'host_failed'
+        self.latency = None
+
+    def as_dict(self):
+        return {'repo': self.repo_name, 'baseurl': self.url, 'host': self.host, 'status': self.status,
+                'latency': round(self.latency, 3) if self.latency is not None else None, 'error': self.error}
+
+def probe_url(probe, reposconfig, log_buffer, gate):
+    """
+    Runs the checks for one baseurl from a worker thread, the gate probe of each host also validates the host IP address.
+    A host already in bad_hosts is not contacted again.
+    """
+    log_buffer.capture(probe.records)
+    try:
+        if probe.host in bad_hosts:
+            return
+        if gate and not ip_address_check(probe.host):
+            bad_hosts.append(probe.host)
+            probe.status, probe.error = 'failed', 'address_{}'.format(classify_host(probe.host)[0])
+            return
+        start = time.monotonic()
+        probe.result, probe.error = connect_to_host(probe.url, reposconfig, probe.repo_name)
+        probe.latency = time.monotonic() - start
+        probe.status = 'passed' if probe.result else 'failed'
+    finally:
+        log_buffer.release()
+
+def run_probes(probes, reposconfig, workers):
+    """
+    Probes all the baseurls with a bounded thread pool.
+    The first probe for each host goes out alone, the remaining probes for that host are only
+    started if it succeeded, this keeps the bad_hosts short-circuit working as in a serial run.
+    """
+    logger.debug('Probing {} baseurl(s) using {} worker(s)'.format(len(probes), workers))
+
+    by_host = dict()
+    for probe in probes:
+        by_host.setdefault(probe.host, list()).append(probe)
+
+    # resolve every host up front, the gate probes then only look at the cached addresses
+    resolve_hosts(by_host.keys(), workers)
+
+    log_buffer = ProbeLogBuffer()
+    logger.addFilter(log_buffer)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = dict()
+            for host, host_probes in by_host.items():
+                pending[executor.submit(probe_url, host_probes[0], reposconfig, log_buffer, True)] = host
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host = pending.pop(future)
+                    # re-raise anything unexpected coming from the worker thread
+                    future.result()
+                    if host is None or host in bad_hosts:
+                        continue
+                    for probe in by_host[host][1:]:
+                        pending[executor.submit(probe_url, probe, reposconfig, log_buffer, False)] = None
+    finally:
+        logger.removeFilter(log_buffer)
+
+def repo_baseurls(reposconfig, check_repos, issues):
+    """
+    Returns a (repo_name, [baseurl, ...]) tuple for each repository worth testing, repositories that can't work
+    because of an issue already found are left out.
+    """
 
-    warnings = 0
+    repo_urls = list()
 
     for repo_name in check_repos:
 
-        if re.match(r'\[*default\]*', repo_name):
+        if default_regex.match(repo_name):
             continue
 
-        # skip checking Software Repositories if the Certificate is invalid.
+        # skip checking Software Repositories if the Certificate is invalid or can't be read.
         # skip checking EUS repos if releasever file is missing
         if  \
-               'invalid_cert' in issues and not re.match(rhuirepo, repo_name) \
-            or 'eus_missing'  in issues and re.match(eusrepo, repo_name)      \
-            or 'extra_eus'    in issues and not re.match(eusrepo, repo_name):
+               ('invalid_cert' in issues or 'unreadable_cert' in issues) and not rhuirepo_regex.match(repo_name) \
+            or 'eus_missing'  in issues and eusrepo_regex.match(repo_name)      \
+            or 'extra_eus'    in issues and not eusrepo_regex.match(repo_name):
               continue
 
         try:
@@ -551,15 +1077,31 @@ def connect_to_repos(reposconfig, check_repos, issues):
             issues['invalid_repoconfig'] = 1
             continue
 
+        repo_urls.append((repo_name, baseurl_info))
+
+    return repo_urls
+
+def connect_to_repos(reposconfig, check_repos, issues, workers=1):
+    """Downloads repomd.xml from each enabled repository."""
+
+    logger.debug('Entering connect_to_repos()')
+
+    repo_probes = list()
+    for repo_name, baseurl_info in repo_baseurls(reposconfig, check_repos, issues):
+        repo_probes.append((repo_name, [ RepoProbe(repo_name, url) for url in baseurl_info ]))
+
+    run_probes([ probe for repo_name, probes in repo_probes for probe in probes ], reposconfig, workers)
+    for repo_name, probes in repo_probes:
+        repo_results.extend(probes)
+
+    # report in the same order as the repositories are configured
+    for repo_name, probes in repo_probes:
         successes = 0
         logger.info('Testing connectivity to repository: {}'.format(repo_name))
-        for url in baseurl_info:
-            url_host = get_host(url)
-            if not ip_address_check(url_host):
-                bad_hosts.append(url_host)
-                continue
-
-            if url_host not in bad_hosts  and connect_to_host(url, reposconfig, repo_name):
+        for probe in probes:
+            for record in probe.records:
+                logger.handle(record)
+            if probe.result:
                 successes += 1
 
         if successes == 0:
@@ -570,34 +1112,708 @@ def connect_to_repos(reposconfig, check_repos, issues):
             issues['unable_to_connect'] = 1
             continue
 
-rhui3 = ['13.91.47.76', '40.85.190.91', '52.187.75.218']
-rhui4 = ['52.136.197.163', '20.225.226.182', '52.142.4.99', '20.248.180.252', '20.24.186.80']
-rhuius = ['13.72.186.193', '13.72.14.155', '52.224.249.194']
+def read_inventory(path):
+    """
+    Reads the hosts from an Ansible style inventory file, one host per line, [group] headers and comments are ignored.
+    ansible_host and ansible_user variables on the host line are honored.
+    """
+    hosts = list()
+    try:
+        with open(path) as stream:
+            for line in stream:
+                line = line.split('#')[0].strip()
+                if not line or line.startswith(';') or line.startswith('['):
+                    continue
+                fields = line.split()
+                host = {'name': fields[0], 'address': fields[0], 'user': None}
+                for field in fields[1:]:
+                    key, _, value = field.partition('=')
+                    if key == 'ansible_host':
+                        host['address'] = value
+                    elif key == 'ansible_user':
+                        host['user'] = value
+                hosts.append(host)
+    except (IOError, OSError) as e:
+        logger.critical('Unable to read inventory file {}: {}'.format(path, e))
+        exit(1)
+    return hosts
+
+def check_fleet_host(host, script, catalog, args):
+    """
+    Runs this script on a remote host through ssh and returns its (issues, warnings) dicts.
+    catalog is the base64 encoded --endpoints catalog, passed on the remote command line since stdin carries the script.
+    Hosts that can't be reached or don't report back get a fleet_* issue instead.
+    """
+    remote_command = "sudo sh -c 'if [ -x /usr/libexec/platform-python ]; then p=/usr/libexec/platform-python; else p=python3; fi; exec $p - --report-issues --workers {} --cert-warn-days {} --probe {}{}'".format(
+                     args.workers, args.cert_warn_days, args.probe, ' --endpoints-data ' + catalog if catalog else '')
+    command = shlex.split(args.ssh_command)
+    user = host['user'] or args.ssh_user
+    if user:
+        command += ['-l', user]
+    command += [host['address'], remote_command]
+    logger.debug('Running {}'.format(command))
+
+    try:
+        result = subprocess.run(command, input=script, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=args.ssh_timeout)
+    except subprocess.TimeoutExpired:
+        return {'fleet_timeout': 'no answer after {} seconds'.format(args.ssh_timeout)}, dict()
+    except OSError as e:
+        return {'fleet_unreachable': str(e)}, dict()
+
+    host_warnings = dict()
+    for line in reversed(result.stdout.decode('utf-8', 'replace').splitlines()):
+        if line.startswith(warnings_marker):
+            try:
+                host_warnings = json.loads(line[len(warnings_marker):])
+            except ValueError:
+                pass
+        elif line.startswith(issues_marker):
+            try:
+                host_issues = json.loads(line[len(issues_marker):])
+            except ValueError:
+                break
+            if result.returncode and not host_issues:
+                host_issues['check_aborted'] = 'rhui-check stopped with RC {}, see /var/log/rhuicheck.log on the host'.format(result.returncode)
+            return host_issues, host_warnings
+
+    error = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+    return {'fleet_unreachable': error[-1] if error else 'ssh returned RC {} without a report'.format(result.returncode)}, dict()
+
+def run_fleet(args):
+    """
+    Fans the check out to every host in the inventory with a pool of ssh workers, prints each host result
+    as it comes back and finishes with a report grouped by issue key.
+    """
+    try:
+        with open(os.path.abspath(__file__), 'rb') as stream:
+            script = stream.read()
+    except (IOError, OSError, NameError):
+        logger.critical('Fleet mode needs to read the script from disk, download it instead of piping it to python.')
+        return 1
+
+    # the hosts don't have the catalog file, it is checked here and sent to every host with the script
+    catalog = None
+    if args.endpoints:
+        try:
+            with open(args.endpoints) as stream:
+                data = json.load(stream)
+            EndpointIndex(data)
+            catalog = base64.b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii')
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.critical('Unable to use the RHUI endpoint catalog {}: {}'.format(args.endpoints, e))
+            return exit_codes['usage']
+
+    hosts = read_inventory(args.fleet)
+    logger.info('Checking {} host(s) from {} using {} ssh worker(s)'.format(len(hosts), args.fleet, args.fleet_workers))
+
+    results = dict()
+    host_warnings = dict()
+    with ThreadPoolExecutor(max_workers=max(1, args.fleet_workers)) as executor:
+        futures = dict((executor.submit(check_fleet_host, host, script, catalog, args), host['name']) for host in hosts)
+        for future in as_completed(futures):
+            name = futures[future]
+            results[name], host_warnings[name] = future.result()
+            warning_note = ' warnings: {}'.format(', '.join(sorted(host_warnings[name]))) if host_warnings[name] else ''
+            if results[name]:
+                print('{}: FAILED ({}){}'.format(name, ', '.join(sorted(results[name].keys())), warning_note))
+            else:
+                print('{}: PASSED{}'.format(name, warning_note))
+            sys.stdout.flush()
+
+    by_issue = dict()
+    by_warning = dict()
+    for host in hosts:
+        for issue, description in results[host['name']].items():
+            by_issue.setdefault(issue, list()).append((host['name'], description))
+        for warning, description in host_warnings[host['name']].items():
+            by_warning.setdefault(warning, list()).append((host['name'], description))
+    failed = len([ host for host in hosts if results[host['name']] ])
+
+    print("")
+    print("="*70)
+    print("RHUI Fleet Check Results")
+    print(f"Started at: {script_start_time}")
+    print(f"Hosts checked: {len(hosts)}, passed: {len(hosts) - failed}, failed: {failed}")
+    print("="*70)
+    for issue in sorted(by_issue, key=lambda key: (-len(by_issue[key]), key)):
+        print("")
+        print(f"{issue} ({len(by_issue[issue])} host(s)):")
+        for name, description in by_issue[issue]:
+            print(f"  - {name}: {description}")
+    for warning in sorted(by_warning, key=lambda key: (-len(by_warning[key]), key)):
+        print("")
+        print(f"Warning {warning} ({len(by_warning[warning])} host(s)):")
+        for name, description in by_warning[warning]:
+            print(f"  - {name}: {description}")
+    print("")
+
+    return exit_code(set(issue for host in hosts for issue in results[host['name']]))
+
+def print_issues_report():
+    """Machine readable copy of the issues and warnings for fleet mode, printed however the script ends."""
+    print(issues_marker + json.dumps(issues, sort_keys=True))
+    print(warnings_marker + json.dumps(check_warnings, sort_keys=True))
+    sys.stdout.flush()
+
+def issue_class(issue):
+    return issue_classes.get(issue, ('error', []))[0]
+
+def exit_code(found_issues):
+    """Exit code for a set of issues, the code of the first class in exit_class_order that has an issue."""
+    classes = set(issue_class(issue) for issue in found_issues)
+    for class_name in exit_class_order:
+        if class_name in classes:
+            return exit_codes[class_name]
+    return exit_codes['passed']
+
+def stop_check(issue, description):
+    """Records an issue the remaining checks can't run without and exits with the exit code of its class."""
+    issues[issue] = description
+    exit(exit_code(issues))
+
+def build_report():
+    """The results of the run as one JSON friendly dict: issues, per check, per repository baseurl and per RHUI host records."""
+    hosts = list()
+    for host in sorted(set(probe.host for probe in repo_results) | set(dns_cache)):
+        status, infrastructure, error = classify_host(host)
+        probes = [ probe for probe in repo_results if probe.host == host ]
+        latencies = [ probe.latency for probe in probes if probe.latency is not None ]
+        hosts.append({
+            'host': host,
+            'status': 'failed' if status == 'passed' and host in bad_hosts else status,
+            'addresses': [ {'address': address, 'infrastructure': endpoint['infrastructure'] if endpoint else None,
+                            'region': endpoint.get('region') if endpoint else None} for address, endpoint in infrastructure ],
+            'error': type(error).__name__ if error else None,
+            'probes': len(probes),
+            'failed': len([ probe for probe in probes if probe.status == 'failed' ]),
+            'latency': round(sum(latencies) / len(latencies), 3) if latencies else None,
+        })
+
+    # a run that stopped without recording an issue died on something unexpected
+    if issues:
+        status, code = 'failed', exit_code(issues)
+    elif run_complete:
+        status, code = 'passed', exit_codes['passed']
+    else:
+        status, code = 'incomplete', exit_codes['error']
+
+    return {
+        'version': 1,
+        'started': script_start_time,
+        'complete': run_complete,
+        'status': status,
+        'exit_code': code,
+        'issues': issues,
+        'warnings': check_warnings,
+        'checks': [ {'check': issue, 'class': class_name, 'status': 'failed' if issue in issues else 'passed', 'detail': issues.get(issue)}
+                    for issue, (class_name, actions) in issue_classes.items() ],
+        'packages': checked_packages,
+        'host_facts': host_facts.facts and host_facts.as_dict(),
+        'repositories': [ probe.as_dict() for probe in repo_results ],
+        'hosts': hosts,
+        'requests': {'sent': session_pool.requests, 'connections': session_pool.connections(), 'handshakes_saved': session_pool.handshakes_saved(),
+                     'probe': args.probe, 'not_modified': repomd_validators.not_modified},
+    }
+
+def print_json_report():
+    """The --format json report, printed however the script ends so the fleet collector always gets one."""
+    print(json.dumps(build_report(), indent=2, sort_keys=True, default=str))
+    sys.stdout.flush()
+
+def print_text_report(report):
+    """Clean summary for non-TTY environments (like Azure Run Command)."""
+    print("")
+    print("="*70)
+    print("RHUI Connectivity Check Results")
+    print(f"Started at: {report['started']}")
+    print(f"TLS handshakes saved by connection reuse: {report['requests']['handshakes_saved']}")
+    print("="*70)
+
+    if report['issues']:
+        print("")
+        print("Status: FAILED")
+        print("")
+        print("Issues detected:")
+        for issue, description in report['issues'].items():
+            print(f"  - {issue}: {description}")
+        print("")
+        print("Detailed logs: /var/log/rhuicheck.log")
+        print("")
+        print("Recommended actions:")
+        actions = list()
+        for issue, (class_name, issue_actions) in issue_classes.items():
+            if issue in report['issues']:
+                actions += [ action for action in issue_actions if action not in actions ]
+        for action in actions:
+            print(f"  * {action}")
+        print_text_warnings(report['warnings'])
+        print("")
+        print("For detailed troubleshooting: https://aka.ms/tsrhuicert")
+        print("="*70)
+        print("")
+    else:
+        print("")
+        print("Status: SUCCESS")
+        print("")
+        print("All RHUI connectivity tests passed successfully!")
+        print(f"")
+        print(f"RHUI package: {report['packages'][-1]['name']}")
+        print(f"Repository config: {report['packages'][-1]['repofile']}")
+        print("")
+        print("Detailed logs: /var/log/rhuicheck.log")
+        print_text_warnings(report['warnings'])
+        print("="*70)
+        print("")
+
+def print_text_warnings(found_warnings):
+    """Warnings part of the text summary, printed with the issues or on its own when all the checks passed."""
+    if not found_warnings:
+        return
+    print("")
+    print("Warnings:")
+    for warning, description in found_warnings.items():
+        print(f"  - {warning}: {description}")
+    for warning in found_warnings:
+        for action in warning_actions.get(warning, []):
+            print(f"  * {action}")
+
+class HostStats(object):
+    """Rolling window of probe results for one RHUI host, used by monitor mode."""
+
+    def __init__(self, window):
+        self.results = deque(maxlen=max(1, window))
+        self.consecutive_failures = 0
+        self.last_ok = None
+        self.last_failure = None
+        self.last_error = None
+        self.state = 'unknown'
+
+    def record(self, ok, latency, error):
+        now = datetime.now().isoformat(timespec='seconds')
+        self.results.append((ok, latency))
+        if ok:
+            self.consecutive_failures = 0
+            self.last_ok = now
+        else:
+            self.consecutive_failures += 1
+            self.last_failure = now
+            self.last_error = error
+
+    def success_rate(self):
+        if not self.results:
+            return None
+        return len([ ok for ok, latency in self.results if ok ]) / len(self.results)
+
+    def update_state(self):
+        """Works out the host state from the window and returns it, down after 3 failures in a row."""
+        rate = self.success_rate()
+        if rate is None:
+            self.state = 'unknown'
+        elif self.consecutive_failures >= 3:
+            self.state = 'down'
+        elif self.consecutive_failures or rate < 0.9:
+            self.state = 'degraded'
+        else:
+            self.state = 'up'
+        return self.state
+
+    def summary(self):
+        latencies = sorted(latency for ok, latency in self.results if ok)
+        summary = {
+            'state': self.state,
+            'probes': len(self.results),
+            'success_rate': round(self.success_rate(), 3) if self.results else None,
+            'consecutive_failures': self.consecutive_failures,
+            'last_ok': self.last_ok,
+            'last_failure': self.last_failure,
+            'last_error': self.last_error,
+        }
+        if latencies:
+            summary['latency_ms'] = {
+                'avg': round(1000 * sum(latencies) / len(latencies), 1),
+                'p50': round(1000 * latencies[len(latencies) // 2], 1),
+                'p95': round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+                'max': round(1000 * latencies[-1], 1),
+            }
+        return summary
+
+def file_stamp(path):
+    """Identity of a file for change detection, None when it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def load_monitor_config():
+    """
+    Runs the same configuration checks as a normal run, without probing, and returns what monitor mode needs:
+    the repomd.xml endpoints to probe, the files to watch for changes, the certificate expiry dates and the issues found.
+    """
+    global eus, system_proxy
+    logger.info('Reading yum/dnf and RHUI configuration')
+    eus = 0
+    issues.clear()
+    check_warnings.clear()
+    host_facts.reset()
+    config = {'endpoints': dict(), 'files': list(monitor_files), 'cert_expiry': dict(), 'packages': list()}
+
+    yum_dnf_conf = read_yum_dnf_conf()
+    system_proxy = get_proxies(yum_dnf_conf,'main')
+
+    for package_name in rpm_names():
+        data = get_pkg_info(package_name)
+        verify_pkg_info(package_name, data)
+        config['packages'].append(package_name)
+        config['files'] += [ data['repofile'], data['clientcert'], data['clientkey'] ]
+        if expiration_time(data['clientcert']) is False:
+            issues['invalid_cert'] = 1
+        cert_info = cert_cache.get(data['clientcert'], (None, None))[1]
+        config['cert_expiry'][data['clientcert']] = cert_info['not_after'] if cert_info else None
+
+        reposconfig = check_rhui_repo_file(data['repofile'])
+        enabled_repos, newissues  = check_repos(reposconfig)
+        issues.update(newissues)
+        for repo_name, baseurl_info in repo_baseurls(reposconfig, enabled_repos, issues):
+            try:
+                cert = (reposconfig.get(repo_name, 'sslclientcert'), reposconfig.get(repo_name, 'sslclientkey'))
+            except:
+                cert = ()
+            for url in baseurl_info:
+                endpoint_url = expand_baseurl(url)
+                config['endpoints'][endpoint_url] = {'url': endpoint_url, 'host': get_host(url), 'repo': repo_name,
+                                                     'cert': cert, 'proxies': get_proxies(reposconfig, repo_name)}
+
+    config['issues'] = dict(issues)
+    config['host_facts'] = host_facts.as_dict()
+    logger.info('Host facts: {}'.format(config['host_facts']))
+    logger.info('Monitoring {} repomd.xml endpoint(s) on {} RHUI host(s)'.format(len(config['endpoints']),
+                len(set(endpoint['host'] for endpoint in config['endpoints'].values()))))
+    return config
+
+def probe_endpoint(endpoint):
+    """Probes one repomd.xml over the pooled session, returns (ok, seconds, error)."""
+    start = time.monotonic()
+    try:
+        s = session_pool.get(endpoint['host'], endpoint['cert'], endpoint['proxies'])
+        r = fetch_repomd(s, endpoint['url'], endpoint['cert'], endpoint['proxies'])
+    except requests.exceptions.RequestException as e:
+        return False, time.monotonic() - start, type(e).__name__
+    except OSError as e:
+        return False, time.monotonic() - start, str(e)
+    if r.status_code not in (200, 304):
+        return False, time.monotonic() - start, 'HTTP {}'.format(r.status_code)
+    if args.probe == 'get' and not valid_repomd(r.content):
+        return False, time.monotonic() - start, 'invalid repomd.xml'
+    return True, time.monotonic() - start, None
+
+def write_status(path, status):
+    """Replaces the status file in one step so readers never see half of it."""
+    try:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{}.{}'.format(path, os.getpid())
+        with open(temp_path, 'w') as stream:
+            json.dump(status, stream, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+    except (IOError, OSError) as e:
+        logger.error('Unable to write status file {}: {}'.format(path, e))
+
+def run_monitor(args):
+    """
+    Keeps probing the RHUI repomd.xml endpoints until stopped, each endpoint on its own jittered schedule so a fleet
+    of VMs doesn't hit the RHUI servers in lockstep. The configuration is only read again when one of the files it
+    came from changes, and the rolling statistics for every RHUI host are written to the status file after each round.
+    """
+    # leave through the same path as Ctrl-C, a SystemExit here means a configuration check gave up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    config = None
+    stamps = None
+    schedule = list()
+    host_stats = dict()
+    endpoint_status = dict()
+    status = {'started': datetime.now().isoformat(timespec='seconds'), 'pid': os.getpid(), 'interval': args.monitor}
+
+    logger.info('Monitor mode, probing every {}s (+/- {}%), status in {}'.format(args.monitor, int(args.jitter * 100), args.status_file))
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        try:
+            while True:
+                watched = config['files'] if config else monitor_files
+                new_stamps = dict((path, file_stamp(path)) for path in watched)
+                if new_stamps != stamps:
+                    if stamps is not None:
+                        logger.info('Configuration changed: {}'.format(', '.join(sorted(path for path in new_stamps if new_stamps[path] != stamps.get(path)))))
+                    try:
+                        config = load_monitor_config()
+                    except (SystemExit, Exception) as e:
+                        logger.critical('Configuration checks failed ({}), waiting for the configuration to change'.format(e))
+                        config = {'endpoints': dict(), 'files': list(set(watched) | set(monitor_files)), 'cert_expiry': dict(),
+                                  'packages': list(), 'issues': dict(issues)}
+                    stamps = dict((path, file_stamp(path)) for path in config['files'])
+                    # spread the first round over the whole interval
+                    now = time.monotonic()
+                    schedule = [ (now + random.uniform(0, args.monitor), url) for url in config['endpoints'] ]
+                    heapq.heapify(schedule)
+                    hosts = set(endpoint['host'] for endpoint in config['endpoints'].values())
+                    host_stats = dict((host, host_stats.get(host) or HostStats(args.window)) for host in hosts)
+                    endpoint_status = dict((url, endpoint_status[url]) for url in endpoint_status if url in config['endpoints'])
+
+                now = time.monotonic()
+                due = list()
+                while schedule and schedule[0][0] <= now:
+                    due.append(heapq.heappop(schedule)[1])
+
+                if due:
+                    futures = dict((executor.submit(probe_endpoint, config['endpoints'][url]), url) for url in due)
+                    for future in as_completed(futures):
+                        url = futures[future]
+                        ok, latency, error = future.result()
+                        endpoint = config['endpoints'][url]
+                        host_stats[endpoint['host']].record(ok, latency, error)
+                        endpoint_status[url] = {'repo': endpoint['repo'], 'host': endpoint['host'], 'ok': ok,
+                                                'latency_ms': round(1000 * latency, 1), 'error': error,
+                                                'checked': datetime.now().isoformat(timespec='seconds')}
+                        heapq.heappush(schedule, (time.monotonic() + args.monitor * random.uniform(1 - args.jitter, 1 + args.jitter), url))
+
+                    for host, stats in sorted(host_stats.items()):
+                        old_state = stats.state
+                        new_state = stats.update_state()
+                        if new_state != old_state:
+                            message = 'RHUI host {} is {} (was {}), last error: {}'.format(host, new_state, old_state, stats.last_error)
+                            if new_state == 'up':
+                                logger.info(message)
+                            else:
+                                logger.warning(message)
+
+                    monitor_issues = dict(config['issues'])
+                    monitor_warnings = dict()
+                    for cert_path, not_after in config['cert_expiry'].items():
+                        if not_after and not_after < datetime.now(timezone.utc):
+                            monitor_issues['invalid_cert'] = 1
+                        elif not_after and (not_after - datetime.now(timezone.utc)).days < args.cert_warn_days:
+                            monitor_warnings['cert_expiring'] = 'expires in {} days'.format((not_after - datetime.now(timezone.utc)).days)
+                    if [ host for host, stats in host_stats.items() if stats.state == 'down' ]:
+                        monitor_issues['unable_to_connect'] = 1
+
+                    status.update({
+                        'updated': datetime.now().isoformat(timespec='seconds'),
+                        'state': 'running',
+                        'packages': config['packages'],
+                        'host_facts': config.get('host_facts'),
+                        'issues': monitor_issues,
+                        'warnings': monitor_warnings,
+                        'cert_expiry': dict((path, not_after.isoformat() if not_after else None) for path, not_after in config['cert_expiry'].items()),
+                        'hosts': dict((host, stats.summary()) for host, stats in host_stats.items()),
+                        'endpoints': endpoint_status,
+                    })
+                    write_status(args.status_file, status)
+                    repomd_validators.save()
+
+                # check the watched files every few seconds, and wake up for the next probe in between
+                wait_time = 5
+                if schedule:
+                    wait_time = min(wait_time, max(0, schedule[0][0] - time.monotonic()))
+                time.sleep(wait_time)
+        except KeyboardInterrupt:
+            logger.info('Monitor mode stopped')
+            status.update({'updated': datetime.now().isoformat(timespec='seconds'), 'state': 'stopped'})
+            write_status(args.status_file, status)
+
+    session_pool.close()
+    return 0
+
+# RHUI content delivery servers, same layout as rhui-endpoints.json, used when no catalog file is found
+default_endpoint_catalog = {
+    'version': 1,
+    'infrastructures': {
+        'rhui4': {'status': 'current', 'description': 'RHUI 4 content delivery servers'},
+        'rhui3': {'status': 'decommissioned', 'description': 'RHUI 3 content delivery servers'},
+        'rhuius': {'status': 'decommissioned', 'description': 'RHUI 3 content delivery servers in Azure US Government'}
+    },
+    'endpoints': [
+        {'infrastructure': 'rhui4', 'region': 'westeurope', 'addresses': ['52.136.197.163']},
+        {'infrastructure': 'rhui4', 'region': 'southcentralus', 'addresses': ['20.225.226.182']},
+        {'infrastructure': 'rhui4', 'region': 'eastus', 'addresses': ['52.142.4.99']},
+        {'infrastructure': 'rhui4', 'region': 'australiaeast', 'addresses': ['20.248.180.252']},
+        {'infrastructure': 'rhui4', 'region': 'southeastasia', 'addresses': ['20.24.186.80']},
+        {'infrastructure': 'rhui3', 'addresses': ['13.91.47.76', '40.85.190.91', '52.187.75.218']},
+        {'infrastructure': 'rhuius', 'addresses': ['13.72.186.193', '13.72.14.155', '52.224.249.194']}
+    ]
+}
+# where a catalog file is looked for when --endpoints isn't used, the first one found wins
+endpoint_catalog_paths = [ '/etc/rhui-check/rhui-endpoints.json' ]
+if os.path.isfile(sys.argv[0]):
+    endpoint_catalog_paths.insert(0, os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'rhui-endpoints.json'))
 system_proxy = dict()
 bad_hosts = list()
+# resolved RHUI hosts for this run, {host: ([address, ...], error)}
+dns_cache = dict()
+issues_marker = 'RHUI_CHECK_ISSUES '
+warnings_marker = 'RHUI_CHECK_WARNINGS '
+# parsed client certificates, {path: (file stamp, details)}
+cert_cache = dict()
+# uname, releasever and basearch of this host, and the baseurls expanded with them
+host_facts = HostFacts()
+# ETag and Last-Modified of the repomd.xml files for --probe conditional, kept between runs
+repomd_validators = RepomdValidators('/var/cache/rhui-check/repomd.json')
+# largest repomd.xml read to the end to keep its connection open when probing with --probe conditional
+repomd_drain_limit = 65536
+# results for the structured report, every probed baseurl and every RHUI package checked
+repo_results = list()
+checked_packages = list()
+run_complete = False
+# class and recommended actions of every issue, actions are printed in this order
+issue_classes = {
+    'ca_cert_invalid':      ('certificate',   ["Reinstall ca-certificates package: yum/dnf reinstall ca-certificates", "Run: update-ca-trust"]),
+    'ca_cert_check_failed': ('certificate',   ["Reinstall ca-certificates package: yum/dnf reinstall ca-certificates", "Run: update-ca-trust"]),
+    'invalid_cert':         ('certificate',   ["Reinstall RHUI package to restore certificate"]),
+    'unreadable_cert':      ('certificate',   ["Reinstall RHUI package to restore certificate"]),
+    'decommissioned_rhui':  ('configuration', ["Reinstall RHUI package to move to the current RHUI servers"]),
+    'rhuipkg_missing':      ('configuration', ["Install the appropriate RHUI package"]),
+    'rhuipkg_invalid':      ('configuration', ["Reinstall the RHUI package"]),
+    'rpmdb_error':          ('configuration', ["Rebuild the rpm database: rpm --rebuilddb"]),
+    'rhuirepo_missing':     ('configuration', ["Install the appropriate RHUI package"]),
+    'rhuirepo_not_enabled': ('configuration', ["Enable Microsoft RHUI repositories"]),
+    'eus_missing':          ('configuration', ["Create /etc/yum/vars/releasever file for EUS repos"]),
+    'extra_eus':            ('configuration', ["Remove /etc/yum/vars/releasever file for non-EUS repos"]),
+    'invalid_proxy':        ('configuration', ["Correct the proxy setting in the yum/dnf configuration or the RHUI repository file"]),
+    'unable_to_connect':    ('connectivity',  ["Check network connectivity to RHUI servers", "Verify firewall/NSG rules allow RHUI IP addresses", "Check /etc/hosts for incorrect RHUI entries"]),
+    'invalid_repoconfig':   ('configuration', ["Reinstall RHUI package to restore repository configuration"]),
+    'invalid_endpoints':    ('usage',         ["Correct the RHUI endpoint catalog given with --endpoints, see rhui-endpoints.json for the format"]),
+    'not_root':             ('error',         ["Run the check as root, in fleet mode the remote user needs passwordless sudo"]),
+    'log_file_error':       ('error',         ["Make sure /var/log is writable and its filesystem has free space"]),
+    'requests_missing':     ('error',         ["Install the python requests module: yum/dnf install python3-requests"]),
+    'fleet_unreachable':    ('unreachable',   []),
+    'fleet_timeout':        ('unreachable',   []),
+    'check_aborted':        ('unreachable',   []),
+}
+# recommended actions for the warnings, which don't change the status or the exit code
+warning_actions = {
+    'cert_expiring': ["Update the RHUI package before the client certificate expires: yum update 'rhui-*'"],
+}
+# 1 is also what python exits with on an unexpected error, 2 what argparse exits with on a bad command line
+exit_codes = {'passed': 0, 'error': 1, 'usage': 2, 'certificate': 3, 'configuration': 4, 'connectivity': 5, 'unreachable': 6}
+# when issues of several classes are found the first one here decides the exit code, the rest usually follow from it
+exit_class_order = ['error', 'usage', 'certificate', 'configuration', 'connectivity', 'unreachable']
+# public key algorithms as openssl x509 -text names them
+key_names = {'rsaEncryption': 'RSA', 'id-ecPublicKey': 'EC', 'ED25519': 'Ed25519'}
+signature_names = {
+    '1.2.840.113549.1.1.5': 'sha1WithRSAEncryption',
+    '1.2.840.113549.1.1.10': 'rsassaPss',
+    '1.2.840.113549.1.1.11': 'sha256WithRSAEncryption',
+    '1.2.840.113549.1.1.12': 'sha384WithRSAEncryption',
+    '1.2.840.113549.1.1.13': 'sha512WithRSAEncryption',
+    '1.2.840.10045.4.3.2': 'ecdsa-with-SHA256',
+    '1.2.840.10045.4.3.3': 'ecdsa-with-SHA384',
+    '1.2.840.10045.4.3.4': 'ecdsa-with-SHA512',
+    '1.3.101.112': 'Ed25519',
+    'ED25519': 'Ed25519',
+}
+# files monitor mode re-reads the configuration for, the RHUI package files are added once they are known
+monitor_files = ['/etc/yum.conf', '/etc/dnf/dnf.conf', '/etc/yum/vars/releasever', '/etc/dnf/vars/releasever', '/var/lib/rpm']
  
 pattern = dict()
 pattern['clientcert'] = r'^/[/a-zA-Z0-9_\-]+\.(crt)$'
 pattern['clientkey']  = r'^/[/a-zA-Z0-9_\-]+\.(pem)$'
 pattern['repofile']    = r'^/[/a-zA-Z0-9_\-\.]+\.(repo)$'
-
-if os.geteuid() != 0:
-   logging.critical('This script needs to execute with root privileges')
-   logging.critical('You could leverage the sudo tool to gain administrative privileges')
-   exit(1)
+# all the patterns above in one expression, the name of the matching group is the pattern key
+pattern_regex = re.compile('|'.join('(?P<{}>{})'.format(key, value) for key, value in pattern.items()))
+
+# compiled once, these run against every repository and baseurl
+url_regex = re.compile(r'[^:]*://([^/]*)/.*')
+releasever_regex = re.compile(r'^.*el([0-9][0-9]*).*')
+openssl_not_after_regex = re.compile(r'Not After *: *(.*)')
+openssl_key_regex = re.compile(r'Public Key Algorithm: *(\S+)')
+openssl_key_size_regex = re.compile(r'Public-Key: *\(([0-9]+) bit\)')
+openssl_signature_regex = re.compile(r'Signature Algorithm: *(\S+)')
+default_regex = re.compile(r'\[*default\]*')
+rhuirepo_regex = re.compile(r'^(rhui-)?microsoft.*')
+eusrepo_regex = re.compile(r'.*-(eus|e4s)-.*')
 
 parser = argparse.ArgumentParser()
 parser.add_argument(  '--debug','-d',
                       action='store_true',
                       help='Use DEBUG level')
+parser.add_argument(  '--workers','-w',
+                      type=int,
+                      default=8,
+                      help='Maximum number of repositories probed in parallel, use 1 for a serial run')
+parser.add_argument(  '--fleet',
+                      metavar='INVENTORY',
+                      help='Run the check over ssh on every host listed in an Ansible style inventory file and aggregate the results')
+parser.add_argument(  '--fleet-workers',
+                      type=int,
+                      default=16,
+                      help='Number of hosts checked at the same time in fleet mode')
+parser.add_argument(  '--ssh-command',
+                      default='ssh -o BatchMode=yes -o ConnectTimeout=10',
+                      help='Command used to reach the hosts in fleet mode')
+parser.add_argument(  '--ssh-user',
+                      help='Remote user for fleet mode, unless set by ansible_user in the inventory')
+parser.add_argument(  '--ssh-timeout',
+                      type=int,
+                      default=300,
+                      help='Seconds to wait for each host in fleet mode')
+parser.add_argument(  '--cert-warn-days',
+                      type=int,
+                      default=30,
+                      help='Report the cert_expiring issue when the RHUI client certificate expires within this many days')
+parser.add_argument(  '--monitor',
+                      type=int,
+                      metavar='SECONDS',
+                      help='Keep running and probe every RHUI repository about every SECONDS seconds, writing rolling statistics to the status file')
+parser.add_argument(  '--status-file',
+                      default='/run/rhui-check/status.json',
+                      help='Where monitor mode writes the RHUI host statistics')
+parser.add_argument(  '--jitter',
+                      type=float,
+                      default=0.2,
+                      help='Random spread of the monitor mode probe interval, 0.2 means +/- 20%%')
+parser.add_argument(  '--window',
+                      type=int,
+                      default=60,
+                      help='Number of recent probes per RHUI host the monitor mode statistics are based on')
+parser.add_argument(  '--endpoints',
+                      metavar='FILE',
+                      help='RHUI endpoint catalog (JSON) to validate the RHUI server addresses against, instead of rhui-endpoints.json next to the script, /etc/rhui-check/rhui-endpoints.json or the built-in catalog')
+parser.add_argument(  '--endpoints-data',
+                      help=argparse.SUPPRESS)
+parser.add_argument(  '--probe',
+                      choices=['head', 'conditional', 'get'],
+                      default='get',
+                      help='How to check each repomd.xml: get (default) downloads and validates every repomd.xml, conditional GETs that the server answers with 304 when the repository is unchanged since the last run, head sends HEAD requests')
+parser.add_argument(  '--format',
+                      choices=['text', 'json'],
+                      default='text',
+                      help='text prints a summary when not run from a terminal, json always prints the full results as JSON on stdout')
+parser.add_argument(  '--report-issues',
+                      action='store_true',
+                      help=argparse.SUPPRESS)
 args = parser.parse_args()
+
+if args.fleet:
+    logger = start_logging(args.debug, log_file=False)
+    exit(run_fleet(args))
+
+# registered first so fleet mode gets the issues of a host however early the check stops there
+if args.report_issues:
+    atexit.register(print_issues_report)
+
+if os.geteuid() != 0:
+   logging.critical('This script needs to execute with root privileges')
+   logging.critical('You could leverage the sudo tool to gain administrative privileges')
+   stop_check('not_root', 'not running with root privileges')
+
 logger = start_logging(args.debug)
 
+endpoint_index = load_endpoint_catalog(args.endpoints, args.endpoints_data)
+
 try:
     import requests
 except ImportError:
     logger.critical("'requests' python module not found, but it's required for this test script, review your python installation.")
-    exit(1) 
+    stop_check('requests_missing', "the 'requests' python module is not installed")
 except Exception as e:
     # It seems requests module requires ca-certificates in newer versions of RHEL/python.
     # rhel10/python3.12(?) 
@@ -605,12 +1821,20 @@ except Exception as e:
     # check if it is due to issues with the ca-certificates package.
     if not validate_ca_certificates():
         logger.critical("CA certificates issue detected - this may be preventing requests module from loading")
-        if not sys.stdout.isatty():
+        if not sys.stdout.isatty() and args.format == 'text':
             print("ERROR: Unable to import requests module - CA certificates may be corrupted")
-        exit(1)
+        exit(exit_code(issues))
     logger.critical(e)
     raise
 
+try:
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+except ImportError:
+    # the client certificate is read with openssl instead
+    x509 = None
+
 try:
     import configparser
 except ImportError:
@@ -628,82 +1852,49 @@ class localParser(configparser.ConfigParser):
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+session_pool = SessionPool(args.workers)
+
+# head falls back to the conditional GET, so both modes start from the validators of the last run
+if args.probe != 'get':
+    repomd_validators.load()
+
+if args.monitor:
+    exit(run_monitor(args))
+
+if args.format == 'json':
+    atexit.register(print_json_report)
+
 yum_dnf_conf = read_yum_dnf_conf()
 system_proxy = get_proxies(yum_dnf_conf,'main')
 
 for package_name in rpm_names():
     data = get_pkg_info(package_name)
     if verify_pkg_info(package_name, data):
+        checked_packages.append({'name': package_name, 'repofile': data['repofile'], 'clientcert': data['clientcert']})
         cert_active = expiration_time(data['clientcert'])
+        # None is a certificate that can't be read, expiration_time() already recorded unreadable_cert
         if not cert_active:
             failures = True
+        if cert_active is False:
             issues['invalid_cert'] = 1
 
         reposconfig = check_rhui_repo_file(data['repofile'])
         enabled_repos, newissues  = check_repos(reposconfig)
         issues.update(newissues) 
-        connect_to_repos(reposconfig, enabled_repos, issues)
+        logger.debug('Host facts: {}'.format(host_facts.as_dict()))
+        connect_to_repos(reposconfig, enabled_repos, issues, args.workers)
 
+handshakes_saved = session_pool.handshakes_saved()
+logger.info('{} RHUI request(s) sent over {} connection(s), {} TLS handshake(s) saved by connection reuse.'.format(session_pool.requests, session_pool.connections(), handshakes_saved))
+session_pool.close()
+repomd_validators.save()
+run_complete = True
 
-# Print clean summary for non-TTY environments (like Azure Run Command)
-if not sys.stdout.isatty():
-    print("")
-    print("="*70)
-    print("RHUI Connectivity Check Results")
-    print(f"Started at: {script_start_time}")
-    print("="*70)
-
-if issues:
-    if not sys.stdout.isatty():
-        print("")
-        print("Status: FAILED")
-        print("")
-        print("Issues detected:")
-        for issue, description in issues.items():
-            print(f"  - {issue}: {description}")
-        print("")
-        print("Detailed logs: /var/log/rhuicheck.log")
-        print("")
-        print("Recommended actions:")
-        if 'ca_cert_invalid' in issues or 'ca_cert_check_failed' in issues:
-            print("  * Reinstall ca-certificates package: yum/dnf reinstall ca-certificates")
-            print("  * Run: update-ca-trust")
-        if 'invalid_cert' in issues:
-            print("  * Reinstall RHUI package to restore certificate")
-        if 'rhuirepo_missing' in issues:
-            print("  * Install the appropriate RHUI package")
-        if 'rhuirepo_not_enabled' in issues:
-            print("  * Enable Microsoft RHUI repositories")
-        if 'eus_missing' in issues:
-            print("  * Create /etc/yum/vars/releasever file for EUS repos")
-        if 'extra_eus' in issues:
-            print("  * Remove /etc/yum/vars/releasever file for non-EUS repos")
-        if 'unable_to_connect' in issues:
-            print("  * Check network connectivity to RHUI servers")
-            print("  * Verify firewall/NSG rules allow RHUI IP addresses")
-            print("  * Check /etc/hosts for incorrect RHUI entries")
-        if 'invalid_repoconfig' in issues:
-            print("  * Reinstall RHUI package to restore repository configuration")
-        print("")
-        print("For detailed troubleshooting: https://aka.ms/tsrhuicert")
-        print("="*70)
-        print("")
-    exit(1)
-else:
+if not issues:
     logger.info('All communication tests to the RHUI infrastructure have passed, if problems persist, remove third party repositories and test again.')
     logger.info('The RHUI repository configuration file is {}, move any other configuration file to a temporary location and test again.'.format(data['repofile']))
-    
-    if not sys.stdout.isatty():
-        print("")
-        print("Status: SUCCESS")
-        print("")
-        print("All RHUI connectivity tests passed successfully!")
-        print(f"")
-        print(f"RHUI package: {package_name}")
-        print(f"Repository config: {data['repofile']}")
-        print("")
-        print("Detailed logs: /var/log/rhuicheck.log")
-        print("="*70)
-        print("")
-    
-    exit(0)
+
+if args.format == 'text' and not sys.stdout.isatty():
+    print_text_report(build_report())
+
+exit(exit_code(issues))
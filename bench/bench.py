@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for vmassist.py and rhui-checkv2.py.
+
+Every scenario runs one of the scripts against a throw away fixture root: os-release, agent and yum config,
+RHUI certificates and repo file, and stub rpm/dpkg/dnf/zypper/tdnf/systemctl/findmnt/ip/waagent binaries that
+answer like the real ones after a configurable delay.  The wire server, IMDS and the RHUI repositories are
+served by a local HTTP stand-in which either answers or accepts connections and never replies.
+
+Both scripts have their paths and the Azure addresses hard coded, so the harness runs a copy of each script with
+the /etc, /var, /usr and /run paths moved into the fixture root and the addresses pointed at the stand-in.
+
+Reported per scenario: wall time, tasks created (processes and threads, from /proc/stat, so run it on an idle
+machine) and the peak RSS of the script or its largest child.  Root is needed, same as for the scripts
+themselves, the stand-in listens on port 80 of 127.0.0.2-127.0.0.4.
+"""
+
+import argparse
+import json
+import os
+import selectors
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scripts = {
+    'vmassist': os.path.join(repo_dir, 'vmassist', 'linux', 'vmassist.py'),
+    'rhui': os.path.join(repo_dir, 'Linux_scripts', 'rhui-check', 'rhui-checkv2.py'),
+}
+
+# the whole of 127/8 is local on Linux, so every endpoint gets its own address and can keep its real port
+wire_ip = '127.0.0.2'
+imds_ip = '127.0.0.3'
+rhui_ip = '127.0.0.4'
+address_rewrites = [('168.63.129.16', wire_ip), ('169.254.169.254', imds_ip), ('52.136.197.163', rhui_ip)]
+path_rewrites = ['/etc/', '/var/', '/usr/', '/run/']
+endpoints = [(wire_ip, 80), (wire_ip, 32526), (imds_ip, 80), (rhui_ip, 80)]
+status_reasons = {200: 'OK', 304: 'Not Modified', 404: 'Not Found'}
+
+os_releases = {
+    'ubuntu': 'NAME="Ubuntu"\nID=ubuntu\nID_LIKE=debian\nVERSION_ID="22.04"\nPRETTY_NAME="Ubuntu 22.04.4 LTS"\n',
+    'rhel': 'NAME="Red Hat Enterprise Linux"\nID="rhel"\nID_LIKE="fedora"\nVERSION_ID="9.4"\nPRETTY_NAME="Red Hat Enterprise Linux 9.4 (Plow)"\n',
+    'sles': 'NAME="SLES"\nID="sles"\nID_LIKE="suse"\nVERSION_ID="15.5"\nPRETTY_NAME="SUSE Linux Enterprise Server 15 SP5"\n',
+    'azurelinux': 'NAME="Microsoft Azure Linux"\nID=azurelinux\nVERSION_ID="3.0"\nPRETTY_NAME="Microsoft Azure Linux 3.0"\n',
+}
+agent_services = {'ubuntu': 'walinuxagent.service', 'rhel': 'waagent.service', 'sles': 'waagent.service', 'azurelinux': 'waagent.service'}
+goal_state_version = '2.12.0.4'
+
+# 'latency' is the delay in seconds of every stub ('*') or of one in particular, the *-timeout scenarios are what
+#   a VM without working networking looks like: endpoints that never answer and package managers stuck on metadata
+# 'fleet' runs rhui-check in fleet mode over the fleet_inventory hosts, through the ssh stand-in
+scenarios = [
+    {'name': 'vmassist-ubuntu', 'script': 'vmassist', 'os': 'ubuntu', 'http': 'ok', 'latency': {}},
+    {'name': 'vmassist-rhel', 'script': 'vmassist', 'os': 'rhel', 'http': 'ok', 'latency': {}},
+    {'name': 'vmassist-sles', 'script': 'vmassist', 'os': 'sles', 'http': 'ok', 'latency': {}},
+    {'name': 'vmassist-azurelinux', 'script': 'vmassist', 'os': 'azurelinux', 'http': 'ok', 'latency': {}},
+    {'name': 'vmassist-rhel-slow', 'script': 'vmassist', 'os': 'rhel', 'http': 'ok', 'latency': {'*': 0.2, 'dnf': 2}},
+    {'name': 'vmassist-timeout', 'script': 'vmassist', 'os': 'rhel', 'http': 'hang', 'latency': {'*': 0.5, 'dnf': 10}},
+    {'name': 'rhui-rhel9', 'script': 'rhui', 'os': 'rhel', 'http': 'ok', 'latency': {}},
+    {'name': 'rhui-timeout', 'script': 'rhui', 'os': 'rhel', 'http': 'hang', 'latency': {'*': 0.5}},
+    {'name': 'rhui-fleet', 'script': 'rhui', 'os': 'rhel', 'http': 'ok', 'latency': {}, 'fleet': True},
+]
+
+### stub binaries, {root} is the fixture root, the package details are made up from the file names
+stub_bodies = {
+    'rpm': r'''case "$1" in
+  -qa) echo rhui-azure-rhel9 ;;
+  -V) exit 0 ;;
+  -q)
+    if [ "$2" = "--list" ]; then
+      printf '%s\n' {root}/etc/pki/rhui/product/content.crt {root}/etc/pki/rhui/key.pem {root}/etc/yum.repos.d/rh-cloud.repo
+      exit 0
+    fi
+    # -q --queryformat FORMAT --whatprovides PATH...
+    shift 4
+    for p in "$@"; do echo "${p##*/}{suffix}"; done ;;
+esac''',
+    'dpkg': r'''shift
+for p in "$@"; do echo "${p##*/}: $p"; done''',
+    'apt-cache': r'''shift 2
+for n in "$@"; do printf 'Package: %s\nVersion: 1.0-1\nOrigin: Ubuntu\n\n' "$n"; done''',
+    'dnf': r'''shift
+for n in "$@"; do
+  printf 'Name         : %s\nVersion      : 1.0\nRelease      : 1.el9\nArchitecture : x86_64\nFrom repo    : rhel-9-for-x86_64-appstream-rhui-rpms\n\n' "${n%-1.0-1.el9.x86_64}"
+done''',
+    'zypper': r'''shift 3
+for n in "$@"; do printf 'Name           : %s\nVersion        : 1.0-1\nRepository     : SLE-Module-Basesystem15-SP5-Updates\n\n' "$n"; done''',
+    'tdnf': r'''shift 2
+for n in "$@"; do printf 'Name          : %s\nVersion       : 1.0\nRepo          : azurelinux-official-base\n\n' "$n"; done''',
+    'systemctl': r'''# show -p PROPERTIES UNIT...
+shift 3
+for u in "$@"; do
+  printf 'Type=simple\nLoadState=loaded\nActiveState=active\nSubState=running\nFragmentPath={root}/usr/lib/systemd/system/%s\nUnitFileState=enabled\n\n' "$u"
+done''',
+    'findmnt': r'''printf 'TARGET="/" SOURCE="/dev/sda1" FSTYPE="xfs" OPTIONS="rw,relatime" USE%%="41%%"\n' ''',
+    'ip': r'''echo '[{"ifindex":1,"ifname":"lo","address":"00:00:00:00:00:00","addr_info":[{"family":"inet","local":"127.0.0.1"}]},{"ifindex":2,"ifname":"eth0","address":"00:0d:3a:12:34:56","addr_info":[{"family":"inet","local":"10.0.0.4","prefixlen":24}]}]' ''',
+    'waagent': r'''case "$1" in
+  --version) printf 'WALinuxAgent-2.7.0.6 running on bench 1.0\nPython: 3.9.18\nGoal state agent: {goal}\n' ;;
+  --show-configuration) printf 'Extensions.Enabled = True\nAutoUpdate.Enabled = True\nHttpProxy.Host = None\n' ;;
+esac''',
+    'python3': 'exit 0',
+    # rhui-check reads the client certificate with openssl when the cryptography module isn't installed
+    'openssl': 'exec {openssl} "$@"',
+}
+
+### ssh stand-in for fleet mode, the hosts named down-* refuse the connection, the hang-* ones never answer and the
+#   others run the remote command on this machine, against the fixture root
+ssh_stub = r'''#!/bin/sh
+# bench stub for ssh [-o OPTION]... [-l USER] HOST COMMAND
+while [ "${1#-}" != "$1" ]; do shift 2; done
+host=$1
+case "$host" in
+  down-*) echo "ssh: connect to host $host port 22: Connection refused" >&2; exit 255 ;;
+  hang-*) exec sleep 3600 ;;
+esac
+cd /
+PATH={root}/fleet/bin:$PATH exec sh -c "$2"
+'''
+fleet_inventory = '''# bench fleet, see ssh_stub
+[rhui]
+rhel9-a
+rhel9-b ansible_host=10.0.0.5 ansible_user=azureuser
+
+[broken]
+down-1
+hang-1 ansible_host=hang-1.internal
+'''
+fleet_ssh_timeout = 5
+
+### HTTP stand-in
+wire_versions = '<?xml version="1.0" encoding="utf-8"?><Versions><Preferred><Version>2015-04-05</Version></Preferred></Versions>'
+wire_goal_state = ('<?xml version="1.0" encoding="utf-8"?><GoalState><Incarnation>1</Incarnation><Container><RoleInstanceList>'
+                   '<RoleInstance><Configuration><ExtensionsConfig>http://{}/machine/?comp=config&amp;type=extensionsConfig&amp;incarnation=1'
+                   '</ExtensionsConfig></Configuration></RoleInstance></RoleInstanceList></Container></GoalState>').format(wire_ip)
+wire_extensions = ('<?xml version="1.0" encoding="utf-8"?><Extensions><GuestAgentExtension><GAFamilies><GAFamily><Name>Prod</Name>'
+                   '<Version>{}</Version></GAFamily></GAFamilies></GuestAgentExtension></Extensions>').format(goal_state_version)
+imds_instance = '{"compute": {"location": "benchregion", "vmSize": "Standard_D2s_v5"}, "network": {}}'
+repomd = '<?xml version="1.0" encoding="UTF-8"?><repomd xmlns="http://linux.duke.edu/metadata/repo"><revision>1</revision></repomd>'
+
+def stand_in_response(address, path):
+    """Returns (status, content type, body) for a request to one of the stand-in endpoints."""
+    if address == (wire_ip, 80):
+        if 'comp=versions' in path:
+            return 200, 'text/xml', wire_versions
+        if 'comp=goalstate' in path:
+            return 200, 'text/xml', wire_goal_state
+        if 'extensionsConfig' in path:
+            return 200, 'text/xml', wire_extensions
+    elif address == (imds_ip, 80) and path.startswith('/metadata/instance'):
+        return 200, 'application/json', imds_instance
+    elif address == (rhui_ip, 80) and path.endswith('/repodata/repomd.xml'):
+        return 200, 'text/xml', repomd
+    return 404, 'text/plain', 'not found'
+
+def serve(mode):
+    """
+    Runs the HTTP stand-in until SIGTERM, in a single thread so it doesn't add to the task count of a run.  In 'hang'
+    mode connections are accepted and never answered, so the scripts run into their own timeouts.
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    selector = selectors.DefaultSelector()
+    for address in endpoints:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        listener.listen(128)
+        listener.setblocking(False)
+        selector.register(listener, selectors.EVENT_READ, None)
+    print('ready', flush=True)
+
+    buffers = dict()
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.data is None:
+                    connection, _ = key.fileobj.accept()
+                    buffers[connection] = b''
+                    if mode != 'hang':
+                        selector.register(connection, selectors.EVENT_READ, key.fileobj.getsockname())
+                    continue
+                connection = key.fileobj
+                try:
+                    data = connection.recv(65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    selector.unregister(connection)
+                    connection.close()
+                    del buffers[connection]
+                    continue
+                buffers[connection] += data
+                # keep-alive, answer every complete request in the buffer
+                while b'\r\n\r\n' in buffers[connection]:
+                    request, buffers[connection] = buffers[connection].split(b'\r\n\r\n', 1)
+                    lines = request.decode('utf-8', 'replace').split('\r\n')
+                    method, path = lines[0].split(' ')[:2]
+                    headers = dict((name.strip().lower(), value.strip()) for name, _, value in (line.partition(':') for line in lines[1:]))
+                    status, content_type, body = stand_in_response(key.data, path)
+                    body = body.encode('utf-8')
+                    # conditional GETs of an unchanged document get 304, HEAD the headers only
+                    etag = '"{:08x}"'.format(zlib.crc32(body))
+                    if status == 200 and headers.get('if-none-match') == etag:
+                        status, body = 304, b''
+                    header = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nETag: {}\r\n\r\n'.format(
+                        status, status_reasons[status], content_type, len(body), etag)
+                    if method == 'HEAD':
+                        body = b''
+                    connection.setblocking(True)
+                    connection.sendall(header.encode('utf-8') + body)
+                    connection.setblocking(False)
+    except KeyboardInterrupt:
+        pass
+
+class StandIn:
+    """The HTTP stand-in as a separate process, started before and stopped after the measured runs."""
+
+    def __init__(self, mode):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode], stdout=subprocess.PIPE)
+        if self.process.stdout.readline().strip() != b'ready':
+            self.process.wait()
+            raise SystemExit('HTTP stand-in failed to start, it needs root to listen on port 80')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+### fixture root
+def write_file(path, content, mode=0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as stream:
+        stream.write(content)
+    os.chmod(path, mode)
+
+def stub_script(name, root, scenario, latency_scale):
+    latency = scenario['latency'].get(name, scenario['latency'].get('*', 0)) * latency_scale
+    suffix = '-1.0-1.el9.x86_64' if scenario['os'] == 'rhel' else ''
+    body = stub_bodies[name].replace('{root}', root).replace('{suffix}', suffix).replace('{goal}', goal_state_version)
+    body = body.replace('{openssl}', shutil.which('openssl') or '/usr/bin/openssl')
+    delay = 'sleep {:g}\n'.format(latency) if latency > 0 else ''
+    return '#!/bin/sh\n# bench stub for {}\n{}{}\n'.format(name, delay, body)
+
+def make_certificate(work_dir):
+    """Creates the RHUI client certificate and key once per harness run."""
+    cert = os.path.join(work_dir, 'content.crt')
+    key = os.path.join(work_dir, 'key.pem')
+    if not os.path.exists(cert):
+        try:
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '3650', '-subj', '/CN=bench-rhui',
+                            '-keyout', key, '-out', cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            raise SystemExit('openssl is needed to create the RHUI client certificate for the rhui scenarios')
+    return cert, key
+
+def build_root(root, scenario, work_dir, latency_scale):
+    write_file(os.path.join(root, 'etc', 'os-release'), os_releases[scenario['os']])
+    write_file(os.path.join(root, 'etc', 'waagent.conf'), 'Extensions.Enabled=y\nAutoUpdate.Enabled=y\n')
+    write_file(os.path.join(root, 'etc', 'sysconfig', 'network-scripts', 'ifcfg-eth0'), 'DEVICE=eth0\nBOOTPROTO=dhcp\nONBOOT=yes\n')
+    write_file(os.path.join(root, 'etc', 'crypto-policies', 'config'), 'DEFAULT\n')
+    for directory in ['var/lib/waagent', 'var/log', 'var/cache', 'run']:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    for unit in [agent_services[scenario['os']], 'ssh.service', 'sshd.service']:
+        write_file(os.path.join(root, 'usr', 'lib', 'systemd', 'system', unit), '[Service]\nExecStart=/bin/true\n')
+    for name in stub_bodies:
+        write_file(os.path.join(root, 'usr', 'bin', name), stub_script(name, root, scenario, latency_scale), 0o755)
+
+    if scenario['script'] == 'rhui':
+        cert, key = make_certificate(work_dir)
+        os.makedirs(os.path.join(root, 'etc', 'pki', 'rhui', 'product'))
+        shutil.copy(cert, os.path.join(root, 'etc', 'pki', 'rhui', 'product', 'content.crt'))
+        shutil.copy(key, os.path.join(root, 'etc', 'pki', 'rhui', 'key.pem'))
+        write_file(os.path.join(root, 'etc', 'yum.conf'), '[main]\ngpgcheck=1\n')
+        repos = [('rhui-microsoft-azure-rhel9', 'microsoft-azure-rhel9'),
+                 ('rhel-9-for-x86_64-baseos-rhui-rpms', 'content/dist/rhel9/rhui/$releasever/$basearch/baseos/os'),
+                 ('rhel-9-for-x86_64-appstream-rhui-rpms', 'content/dist/rhel9/rhui/$releasever/$basearch/appstream/os')]
+        repo_file = ''
+        for name, path in repos:
+            repo_file += '[{}]\nname={}\nbaseurl=http://{}/{}\nenabled=1\nsslclientcert={}\nsslclientkey={}\n\n'.format(
+                name, name, rhui_ip, path, os.path.join(root, 'etc', 'pki', 'rhui', 'product', 'content.crt'),
+                os.path.join(root, 'etc', 'pki', 'rhui', 'key.pem'))
+        write_file(os.path.join(root, 'etc', 'yum.repos.d', 'rh-cloud.repo'), repo_file)
+
+    if scenario.get('fleet'):
+        write_file(os.path.join(root, 'usr', 'bin', 'ssh'), ssh_stub.replace('{root}', root), 0o755)
+        write_file(os.path.join(root, 'fleet', 'bin', 'sudo'), '#!/bin/sh\nexec "$@"\n', 0o755)
+        # python3 is a stub in usr/bin, the remote check needs the real one
+        os.symlink(sys.executable, os.path.join(root, 'fleet', 'bin', 'python3'))
+        write_file(os.path.join(root, 'fleet', 'inventory'), fleet_inventory)
+        with open(os.path.join(os.path.dirname(scripts['rhui']), 'rhui-endpoints.json')) as stream:
+            catalog = stream.read()
+        for address, local in address_rewrites:
+            catalog = catalog.replace(address, local)
+        write_file(os.path.join(root, 'fleet', 'rhui-endpoints.json'), catalog)
+
+    # the copy of the script with its paths and addresses moved into the fixture
+    with open(scripts[scenario['script']]) as stream:
+        source = stream.read()
+    for prefix in path_rewrites:
+        for quote in ['"', "'"]:
+            source = source.replace(quote + prefix, quote + root + prefix)
+    for address, local in address_rewrites:
+        # in fleet mode only the --endpoints catalog knows the RHUI stand-in, so the hosts pass only if it reaches them
+        if scenario.get('fleet') and local == rhui_ip:
+            continue
+        source = source.replace(address, local)
+    script = os.path.join(root, os.path.basename(scripts[scenario['script']]))
+    write_file(script, source)
+
+    if scenario['script'] == 'vmassist':
+        return [sys.executable, script, '--noterm', '--bash', 'SERVICE={}|PY={}'.format(agent_services[scenario['os']], os.path.join(root, 'usr', 'bin', 'python3')),
+                '--log', os.path.join(root, 'var', 'log', 'vmassist.log'), '--json', os.path.join(root, 'report.json')]
+    if scenario.get('fleet'):
+        # the certificate is valid for 3650 days, every host that answers reports the cert_expiring warning
+        return [sys.executable, script, '--fleet', os.path.join(root, 'fleet', 'inventory'), '--ssh-timeout', str(fleet_ssh_timeout),
+                '--cert-warn-days', '4000', '--endpoints', os.path.join(root, 'fleet', 'rhui-endpoints.json')]
+    return [sys.executable, script]
+
+### measurement
+def tasks_created():
+    """Processes and threads created since boot, system wide."""
+    with open('/proc/stat') as stream:
+        for line in stream:
+            if line.startswith('processes '):
+                return int(line.split()[1])
+    return 0
+
+def run_once(scenario, work_dir, args):
+    root = tempfile.mkdtemp(prefix='root_', dir=work_dir)
+    command = build_root(root, scenario, work_dir, args.latency_scale)
+    env = {key: value for key, value in os.environ.items() if not key.lower().endswith('_proxy')}
+    env['PATH'] = os.path.join(root, 'usr', 'bin') + ':' + env.get('PATH', '/usr/bin:/bin')
+    env['LC_ALL'] = 'C'
+
+    with open(os.path.join(root, 'output.txt'), 'w') as output:
+        tasks = tasks_created()
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                   cwd=root, env=env, start_new_session=True)
+        killed = False
+        # wait4() gives the rusage of this run alone, poll it so a hung script can be killed
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() - start > args.run_timeout:
+                os.killpg(process.pid, signal.SIGKILL)
+                pid, status, usage = os.wait4(process.pid, 0)
+                killed = True
+                break
+            time.sleep(0.01)
+        wall = time.monotonic() - start
+        tasks = tasks_created() - tasks
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+
+    if not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+    return {'wall': round(wall, 3), 'tasks': tasks, 'rss': usage.ru_maxrss, 'rc': process.returncode, 'killed': killed, 'root': root}
+
+def run_scenario(scenario, work_dir, args):
+    stand_in = StandIn(scenario['http'])
+    try:
+        runs = [run_once(scenario, work_dir, args) for _ in range(args.repeat)]
+    finally:
+        stand_in.stop()
+    walls = [run['wall'] for run in runs]
+    return {
+        'wall': round(statistics.median(walls), 3),
+        'min': min(walls),
+        'max': max(walls),
+        'tasks': int(statistics.median(run['tasks'] for run in runs)),
+        'rss': max(run['rss'] for run in runs),
+        'rc': sorted(set(run['rc'] for run in runs)),
+        'killed': sum(run['killed'] for run in runs),
+        'runs': runs,
+    }
+
+def print_results(results):
+    print('{:<22} {:>9} {:>9} {:>9} {:>7} {:>10}  {}'.format('scenario', 'wall(s)', 'min', 'max', 'tasks', 'RSS(MiB)', 'exit'))
+    for name, result in results.items():
+        exit_codes = ','.join(str(rc) for rc in result['rc'])
+        if result['killed']:
+            exit_codes += ' ({} killed)'.format(result['killed'])
+        print('{:<22} {:>9.3f} {:>9.3f} {:>9.3f} {:>7} {:>10.1f}  {}'.format(
+            name, result['wall'], result['min'], result['max'], result['tasks'], result['rss'] / 1024, exit_codes))
+
+def compare(results, baseline_file, tolerance, slack):
+    """Returns the number of scenarios slower than the baseline by more than tolerance (fraction) plus slack (seconds)."""
+    with open(baseline_file) as stream:
+        baseline = json.load(stream)['scenarios']
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            print('{}: not in the baseline'.format(name))
+            continue
+        limit = baseline[name]['wall'] * (1 + tolerance) + slack
+        verdict = 'ok'
+        if result['wall'] > limit:
+            verdict = 'REGRESSION'
+            regressions += 1
+        print('{}: {:.3f}s, baseline {:.3f}s, limit {:.3f}s - {}'.format(name, result['wall'], baseline[name]['wall'], limit, verdict))
+    return regressions
+
+parser = argparse.ArgumentParser(description='Benchmark vmassist.py and rhui-checkv2.py against fixture roots')
+parser.add_argument(  '--scenario', '-s',
+                      action='append',
+                      help='Run the scenarios whose name contains this, can be repeated, all of them by default')
+parser.add_argument(  '--repeat', '-r',
+                      type=int,
+                      default=3,
+                      help='Runs per scenario, the median wall time is reported')
+parser.add_argument(  '--latency-scale',
+                      type=float,
+                      default=1.0,
+                      help='Multiply the stub binary delays of every scenario by this')
+parser.add_argument(  '--run-timeout',
+                      type=float,
+                      default=300,
+                      help='Kill a run after this many seconds')
+parser.add_argument(  '--save',
+                      help='Write the results to this JSON file, to be used as a baseline')
+parser.add_argument(  '--compare',
+                      help='Compare the results against this baseline, exit with 1 on any regression')
+parser.add_argument(  '--tolerance',
+                      type=float,
+                      default=0.10,
+                      help='Allowed slow down against the baseline as a fraction')
+parser.add_argument(  '--slack',
+                      type=float,
+                      default=0.25,
+                      help='Allowed slow down against the baseline in seconds, on top of --tolerance')
+parser.add_argument(  '--keep',
+                      action='store_true',
+                      help='Keep the fixture roots, with the script output and logs, for inspection')
+parser.add_argument(  '--list',
+                      action='store_true',
+                      help='List the scenarios and exit')
+parser.add_argument(  '--serve',
+                      help=argparse.SUPPRESS)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        exit(0)
+
+    selected = [scenario for scenario in scenarios if not args.scenario or any(part in scenario['name'] for part in args.scenario)]
+    if args.list:
+        for scenario in selected:
+            print('{:<22} {:<9} {:<11} http:{:<5} latency:{}'.format(scenario['name'], scenario['script'], scenario['os'], scenario['http'], scenario['latency']))
+        exit(0)
+    if not selected:
+        exit('No scenario matches {}'.format(args.scenario))
+    if os.geteuid() != 0:
+        exit('The benchmark needs root, same as the scripts it runs')
+
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    results = dict()
+    try:
+        for scenario in selected:
+            print('running {} ...'.format(scenario['name']), file=sys.stderr, flush=True)
+            results[scenario['name']] = run_scenario(scenario, work_dir, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if args.keep:
+        print('fixture roots kept in {}'.format(work_dir))
+    if args.save:
+        with open(args.save, 'w') as stream:
+            json.dump({'version': 1, 'python': sys.version.split()[0], 'scenarios': results}, stream, indent=2)
+    if args.compare and compare(results, args.compare, args.tolerance, args.slack):
+        exit(1)
@@ -28,53 +28,80 @@ import socket
 import requests
 import logging
 import subprocess
+import shutil
 import re
 # for os-release (initially)
 import csv
 import pathlib
 # network checking
 import socket
+import fcntl
+import struct
 import json
 # For talking to the wire server and decoding responses
 import http.client
 from xml.etree import ElementTree
+from urllib.parse import urlparse, unquote
+import base64
+# running the endpoint probes side by side, and timing everything
+import time
+import threading
+import contextlib
+import concurrent.futures
+# watch mode
+import select
+import signal
 
 ### COMMAND LINE ARGUMENT HANDLING
-parser = argparse.ArgumentParser(
-    description="stuff"
-)
-parser.add_argument('-b', '--bash', required=True, type=str)
-parser.add_argument('-r', '--report', action='store_true') # this is just to 'catch' the bash 'reporting' parameter, we don't use it
-parser.add_argument('-d', '--debug', action='store_true')
-parser.add_argument('-v', '--verbose', action='count', default=0)
-parser.add_argument('-l', '--log', type=str, required=False, default='/var/log/azure/'+os.path.basename(__file__)+'.log')
-parser.add_argument('-t', '--noterm', action='store_true') # mainly used for coloring output
-args=parser.parse_args()
-# TODO: implement using verbosity level
-if ( args.debug ):
-  if ( args.verbose == 0 ):
-    args.verbose = 1
-
-# example bash value:
-# bash="DISTRO=debian|SERVICE=walinuxagent.service|UNIT=active|PY=/usr/bin/python3.8|PYCOUNT=1|PYREQ=loaded|PYALA=loaded"
-bashArgs = dict(inStr.split('=') for inStr in args.bash.split("|"))
-# any value can be extracted with 
-#   bashArgs.get('NAME', "DefaultString")
-#  ex:
-#   bashArgs.get('PY',"N/A")
+def buildParser():
+  parser = argparse.ArgumentParser(
+      description="stuff"
+  )
+  parser.add_argument('-b', '--bash', required=True, type=str)
+  parser.add_argument('-r', '--report', action='store_true') # this is just to 'catch' the bash 'reporting' parameter, we don't use it
+  parser.add_argument('-d', '--debug', action='store_true')
+  parser.add_argument('-v', '--verbose', action='count', default=0)
+  parser.add_argument('-l', '--log', type=str, required=False, default='/var/log/azure/'+os.path.basename(__file__)+'.log')
+  parser.add_argument('-t', '--noterm', action='store_true') # mainly used for coloring output
+  parser.add_argument('-j', '--json', type=str, required=False) # write the JSON report to this file, '-' for stdout
+  parser.add_argument('-p', '--trace', type=str, required=False) # write a Chrome trace (chrome://tracing, Perfetto) of all timed calls to this file
+  parser.add_argument('-n', '--no-cache', action='store_true') # ignore and don't update the on-disk package lookup and wire server caches
+  parser.add_argument('--cache-ttl', type=int, required=False, default=86400) # seconds before a cached package lookup or wire server state is fetched again
+  parser.add_argument('-w', '--watch', type=int, required=False) # keep running, re-checking connectivity and disk every WATCH seconds
+  parser.add_argument('-c', '--cmd-timeout', type=int, required=False, default=30) # kill any external command still running after this many seconds
+  parser.add_argument('-e', '--deadline', type=int, required=False, default=120) # seconds all external commands of a run get together, 0 for no limit
+  parser.add_argument('-s', '--serial', action='store_true') # don't start independent commands ahead of their check
+  return parser
+def parseBashArgs(bashIn):
+  # example bash value:
+  # bash="DISTRO=debian|SERVICE=walinuxagent.service|UNIT=active|PY=/usr/bin/python3.8|PYCOUNT=1|PYREQ=loaded|PYALA=loaded"
+  # any value can be extracted with 
+  #   bashArgs.get('NAME', "DefaultString")
+  #  ex:
+  #   bashArgs.get('PY',"N/A")
+  return dict(inStr.split('=', 1) for inStr in bashIn.split("|") if "=" in inStr)
+# Nothing runs at import time so the checks can be used as a library, these defaults are what an importer gets
+#   until it calls init() - main() replaces them with the real command line
+args=buildParser().parse_args(["--bash", ""])
+bashArgs={}
+# JSON report stream, opened by main() when asked for
+jsonStream=None
 ### END COMMAND LINE ARGUMENT HANDLING
 ### UTILS
 #### UTIL VARs and OBJs
 vmaPyVersion="1.0.1"
+runStart=time.monotonic()
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(format='%(asctime)s py %(levelname)s %(message)s', filename=args.log, level=logging.DEBUG)
-# start logging as soon as possible
-logger.info("Python script version "+vmaPyVersion+" started:"+os.path.basename(__file__))
-# add the 'to the console' flag to the logger
-if ( args.verbose > 0 ):
-  logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
-  logger.info("Debug on")
+def setupLogging(logFile, verbose=0):
+  # only the CLI sets up the root logger, a program importing this file keeps its own logging config
+  logging.basicConfig(format='%(asctime)s py %(levelname)s %(message)s', filename=logFile, level=logging.DEBUG)
+  # start logging as soon as possible
+  logger.info("Python script version "+vmaPyVersion+" started:"+os.path.basename(__file__))
+  # add the 'to the console' flag to the logger
+  if ( verbose > 0 ):
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    logger.info("Debug on")
 #### END UTIL VARS
 #### UTIL FUNCTIONS
 def colorPrint(color, strIn):
@@ -106,6 +133,95 @@ def colorString(strIn, redVal="dead", greenVal="active", yellowVal="inactive"):
   else:
     return cBlack(strIn)
 
+#### Timing
+# Every stage, subprocess, HTTP request and socket probe is recorded in 'timings' so slow runs can be
+#   traced back to the exact package manager/systemctl/wire server call.  A profile table goes to the log at
+#   the end of the run, and --trace writes all the entries as a Chrome trace
+timings=[]
+@contextlib.contextmanager
+def timed(name, category="call"):
+  callStart=time.monotonic()
+  try:
+    yield
+  finally:
+    timings.append({'name': name, 'cat': category, 'start': callStart - runStart,
+                    'dur': time.monotonic() - callStart, 'tid': threading.get_ident()})
+def timingProfile():
+  # aggregate the timed calls by category and name: {(cat, name): [count, total, max]}
+  profile={}
+  for entry in timings:
+    thisEntry=profile.setdefault((entry['cat'], entry['name']), [0, 0.0, 0.0])
+    thisEntry[0]+=1
+    thisEntry[1]+=entry['dur']
+    thisEntry[2]=max(thisEntry[2], entry['dur'])
+  return profile
+def logTimingProfile():
+  # stages in the order they ran, then every other kind of call sorted by the total time spent in it
+  profile=timingProfile()
+  logger.info("--- timing profile ---")
+  logger.info(f"{'category':<12}{'name':<48}{'count':>6}{'total(s)':>10}{'max(s)':>10}")
+  stageKeys=[key for key in dict.fromkeys((e['cat'], e['name']) for e in timings) if key[0] == "stage"]
+  callKeys=sorted([key for key in profile if key[0] != "stage"], key=lambda key: -profile[key][1])
+  for key in stageKeys + callKeys:
+    count, total, longest = profile[key]
+    logger.info(f"{key[0]:<12}{key[1][:47]:<48}{count:>6}{total:>10.3f}{longest:>10.3f}")
+  logger.info(f"{'total':<12}{'':<48}{'':>6}{time.monotonic() - runStart:>10.3f}")
+  logger.info("--- END timing profile ---")
+def writeTrace(pathIn):
+  # Chrome trace event format, complete ('X') events with microsecond timestamps
+  events=[{'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'ts': int(e['start'] * 1000000),
+           'dur': int(e['dur'] * 1000000), 'pid': os.getpid(), 'tid': e['tid']} for e in timings]
+  try:
+    with open(pathIn, 'w') as traceFile:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, traceFile)
+    logger.info(f"Wrote {len(events)} trace events to {pathIn}")
+  except OSError as e:
+    logger.warning(f"Unable to write trace file {pathIn}: {e}")
+
+#### JSON report
+# The JSON report is written as JSON lines - one object per line, flushed as soon as each check stage finishes -
+#   so the collector still gets everything up to the point where a later check crashed.  Record types:
+#   - header : schema name/version, script version, host and OS details
+#   - stage  : the bins/services/checks/findings entries added or changed by one stage, and how long it took
+#   - error  : an uncaught exception stopped the script, no 'end' record will follow
+#   - end    : complete copy of all the result dicts plus the timing of every stage
+# Bump jsonSchemaVersion whenever a record or key is renamed or removed, adding keys is fine
+jsonSchema="vmassist-linux"
+jsonSchemaVersion=1
+jsonSent={}
+stageTimes={}
+# watch mode only streams finding changes after the first full run
+streamStages=True
+def jsonEmit(recordType, **data):
+  if jsonStream is None:
+    return
+  record={"type": recordType, "schema": jsonSchema, "schemaVersion": jsonSchemaVersion}
+  record.update(data)
+  jsonStream.write(json.dumps(record, default=str, sort_keys=True) + "\n")
+  jsonStream.flush()
+def jsonStage(stageName, stageStart):
+  # time the stage and stream whatever it added to, changed or removed from the result dicts
+  elapsed=round(time.monotonic() - stageStart, 3)
+  stageTimes[stageName]=elapsed
+  timings.append({'name': stageName, 'cat': 'stage', 'start': stageStart - runStart,
+                  'dur': time.monotonic() - stageStart, 'tid': threading.get_ident()})
+  logger.info(f"Stage {stageName} took {elapsed}s")
+  if jsonStream is None or not streamStages:
+    return
+  stageData={}
+  removed={}
+  for dictName, dictIn in [("bins", bins), ("services", services), ("checks", checks), ("findings", findings)]:
+    # round trip through json so the comparison is against exactly what was sent
+    current=json.loads(json.dumps(dictIn, default=str))
+    sent=jsonSent.get(dictName, {})
+    stageData[dictName]={key: value for key, value in current.items() if sent.get(key) != value}
+    removed[dictName]=[key for key in sent if key not in current]
+    jsonSent[dictName]=current
+  jsonEmit("stage", stage=stageName, elapsed=elapsed, removed=removed, **stageData)
+def jsonExcepthook(excType, excValue, excTb):
+  # let the collector know the report is partial before the normal traceback
+  jsonEmit("error", error=f"{excType.__name__}: {excValue}", complete=False)
+  sys.__excepthook__(excType, excValue, excTb)
 #### END UTIL FUNCS
 ### END UTILS
 ### MAIN CODE
@@ -113,19 +229,14 @@ def colorString(strIn, redVal="dead", greenVal="active", yellowVal="inactive"):
 fullPercent=90
 wireIP="168.63.129.16"
 imdsIP="169.254.169.254"
-# debug percentage
-if ( args.verbose > 0 ):
-  fullPercent=20
-# parse out os-release and put the values into a dict
-
-path = pathlib.Path("/etc/os-release")
-with open(path) as stream:
-  reader = csv.reader(filter(lambda line: line.strip(), stream), delimiter="=")
-  os_release = dict(reader)
-osrID=os_release.get("ID_LIKE", os_release.get("ID"))
-osMajS,osMinS=os_release.get("VERSION_ID").split(".")
-osMaj=int(osMajS)
-osMin=int(osMinS)
+# parsed /etc/os-release, filled in by init()
+os_release={}
+osrID=""
+osMaj=0
+osMin=0
+# values the check stages hand to each other and to the report (agent binary and unit, versions, report
+#   strings), filled in by init() and the checks themselves
+facts={}
 
 # TODO: Add a family / major version check for 'supported' and "doesn't work" checks
 # TODO: perhaps add a best-effort flag, wrap things that might not work in 'best effort' mode
@@ -136,10 +247,564 @@ bins={}
 services={}
 checks={}
 findings={}
+# package owner and repository per path, filled in by resolvePkgs()
+pkgCache={}
+# on-disk copy of pkgCache so scheduled runs can skip the package managers when nothing changed, entries are
+#   only reused if the file (inode/mtime) and the package databases (mtime) are unchanged and the TTL hasn't passed
+diskCacheFile="/var/cache/vmassist/pkgcache.json"
+diskCacheVersion=1
+diskCache=None
+# any package install/remove or repo metadata refresh touches at least one of these
+pkgDbPaths=["/var/lib/dpkg/status", "/var/lib/apt/lists", "/var/lib/rpm", "/usr/lib/sysimage/rpm",
+            "/var/lib/dnf/history.sqlite", "/etc/yum.repos.d", "/etc/zypp/repos.d"]
+# wire server client: one keep-alive connection for every wire server request, and the negotiated API version and
+#   goal state incarnation kept on disk so ExtensionsConfig is only downloaded again when the incarnation changes
+wireConn=None
+wireStateFile="/var/cache/vmassist/wirestate.json"
+wireStateVersion=1
+wireState=None
+# what the agent itself asks for when the versions list can't be read
+wireDefaultVersion="2012-11-30"
+# {request name: {'status':, 'elapsed': secs to the response headers}} for the wire server requests of this pass
+wireLatency={}
+# systemd properties per unit, filled in by fetchUnits()
+unitCache={}
+# network config dirs searched for static IP and MAC addresses, the usual ones of all common distros
+networkConfigDirs=["/etc/sysconfig", "/etc/netplan", "/etc/NetworkManager", "/etc/network"]
+unitProps=["LoadState", "UnitFileState", "ActiveState", "SubState", "Type", "FragmentPath"]
 # took out the part to put some default findings in, delete them if we find something bad
+# patterns for the binary/service findings, compiled once instead of per binary
+#   questionable install locations
+badPathRegex=re.compile(r"local|opt|home")
+#   repositories we expect the agent/python to come from, per distro family - fedora family also covers RHEL and
+#   AL's initial install (@System, anaconda), rhui and appstream which is ok-ish
+goodRepoRegex={
+  "debian": re.compile(r"Origin: Ubuntu"),
+  "fedora": re.compile(r"@System|anaconda|rhui|AppStream|azurelinux"),
+  "azurelinux": re.compile(r"@System|anaconda|rhui|AppStream|azurelinux"),
+  "suse": re.compile(r"SLE-Module")
+}
+#   the 'repo' field of a failed lookup, only the fedora family reports it
+failRepoRegex=re.compile(r"fail")
+#   v.v.v with an optional 4th .v section since some agent versions only have 3
+versionRegex=re.compile(r'\d+\.\d+\.\d+(\.\d+)?')
+#   octal escapes (\040 for a space) in /proc/self/mountinfo paths
+mountEscapeRegex=re.compile(r'\\([0-7]{3})')
+
+# External commands never get a shell and never run unbounded: each one is killed after --cmd-timeout seconds, and
+#   all the commands of a run share the --deadline set by runChecks(), so a hung dnf/zypper costs a 'timed out'
+#   finding instead of the whole report
+runDeadline=None
+# commands started ahead of their check by startCmds(), {tuple(cmdList): (Popen, start time)}
+cmdStarted={}
+# commands killed for running out of time since runCheck() last cleared this
+cmdTimedOut=[]
+# filesystem types the disk check looks at
+diskFsTypes=("ext2", "ext3", "ext4", "btrfs", "xfs", "vfat")
+# ioctl for the IPv4 address of an interface, from linux/sockios.h
+SIOCGIFADDR=0x8915
 
 #### END Global vars
 #### Main logic functions
+def startCmd(cmdList):
+  # start a command in its own session, so it can be killed together with anything it spawned
+  return subprocess.Popen(cmdList, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+def killCmd(proc):
+  try:
+    os.killpg(proc.pid, signal.SIGKILL)
+  except OSError:
+    pass
+  try:
+    proc.communicate(timeout=1)
+  except subprocess.TimeoutExpired:
+    # something escaped the session and still holds the pipes, leave it
+    pass
+def startCmds(cmdLists):
+  # Parallel dispatch - start commands that don't depend on each other now, runCmd() picks up their output when
+  #   their check gets to them
+  if args.serial:
+    return
+  for cmdList in cmdLists:
+    if cmdList and cmdList[0] and tuple(cmdList) not in cmdStarted:
+      try:
+        cmdStarted[tuple(cmdList)]=(startCmd(cmdList), time.monotonic())
+      except OSError:
+        # runCmd() will try again and log it
+        pass
+def stopCmds():
+  # anything started ahead that no check asked for
+  for proc, _ in cmdStarted.values():
+    killCmd(proc)
+  cmdStarted.clear()
+def runCmd(cmdList, timeout=None):
+  # Run an external command and return (rc, stdout, stderr).  rc is None if the command couldn't be started or ran
+  #   out of time - its own timeout or what is left of the run deadline - and was killed
+  cmdName=" ".join([os.path.basename(cmdList[0])] + cmdList[1:2])
+  if timeout is None:
+    timeout=args.cmd_timeout
+  with timed(cmdName, "subprocess"):
+    proc, procStart=cmdStarted.pop(tuple(cmdList), (None, None))
+    if proc is None:
+      if ( runDeadline is not None and time.monotonic() >= runDeadline ):
+        logger.warning(f"Run deadline passed, not running {cmdName}")
+        cmdTimedOut.append(cmdName)
+        return None, "", "timed out"
+      try:
+        proc=startCmd(cmdList)
+      except OSError as e:
+        logger.info(f"unable to run {cmdList[0]}: {e}")
+        return None, "", str(e)
+      procStart=time.monotonic()
+    if proc.poll() is not None:
+      # started ahead and already done, the output is waiting in the pipes
+      timeLeft=None
+    else:
+      timeLeft=procStart + timeout - time.monotonic()
+      if runDeadline is not None:
+        timeLeft=min(timeLeft, runDeadline - time.monotonic())
+      timeLeft=max(timeLeft, 0)
+    try:
+      cmdOut, cmdErr = proc.communicate(timeout=timeLeft)
+    except subprocess.TimeoutExpired:
+      killCmd(proc)
+      logger.warning(f"{cmdName} still running after {time.monotonic() - procStart:.1f}s, killed it")
+      cmdTimedOut.append(cmdName)
+      return None, "", "timed out"
+  return proc.returncode, cmdOut.decode(errors="replace"), cmdErr.decode(errors="replace").strip()
+def runQuery(cmdList):
+  # run a package database query and hand back stdout whatever the return code, batch queries return
+  #   non-zero when only *some* of the arguments could not be matched, so the RC can't be trusted
+  _, queryOut, queryErr = runCmd(cmdList)
+  return queryOut, queryErr
+def waaCmd(option):
+  return [facts['waaBin'], option]
+def parseInfoBlocks(infoOut):
+  # split the output of 'apt-cache show', 'dnf info', 'zypper info' or 'tdnf info' into one list of
+  #   (key, value) pairs per package, blocks are separated by empty lines in all of them
+  blocks=[]
+  thisBlock=[]
+  for line in infoOut.splitlines():
+    if not line.strip():
+      if thisBlock:
+        blocks.append(thisBlock)
+      thisBlock=[]
+      continue
+    if ":" in line:
+      key, value = line.split(":", 1)
+      thisBlock.append((key.strip(), value.strip()))
+  if thisBlock:
+    blocks.append(thisBlock)
+  return blocks
+def blockValue(block, keyList):
+  # first value in the block for any of the keys, in the order they appear in the output
+  for key, value in block:
+    if key in keyList:
+      return value
+  return None
+def dpkgOwnersNative(pathList):
+  # Find the owning package for each path straight from the /var/lib/dpkg/info/*.list files, without
+  #   spawning dpkg.  Returns {path: package} for the paths found, or None if the database can't be read
+  infoDir="/var/lib/dpkg/info"
+  wanted=set(pathList)
+  fileOwners={}
+  try:
+    for listName in sorted(os.listdir(infoDir)):
+      if not listName.endswith(".list"):
+        continue
+      with open(os.path.join(infoDir, listName), 'r', errors='replace') as listFile:
+        hits=wanted.intersection(listFile.read().splitlines())
+      # list files are named pkg.list or pkg:arch.list
+      for hit in hits:
+        fileOwners.setdefault(hit, listName[:-5].split(":")[0])
+      if len(fileOwners) == len(wanted):
+        break
+  except OSError as e:
+    logger.info(f"unable to read the dpkg database in {infoDir}, falling back to dpkg: {e}")
+    return None
+  return fileOwners
+def aptOriginsNative(pkgList):
+  # Find the repository origin for each package from the apt lists, preferring the entry matching the
+  #   installed version.  Returns {package: "Origin: x"} for the packages found in a repository, or None
+  #   if there are no uncompressed package lists to read (apt-cache will be used instead)
+  listsDir="/var/lib/apt/lists"
+  installed={}
+  try:
+    with open("/var/lib/dpkg/status", 'r', errors='replace') as statusFile:
+      for block in parseInfoBlocks(statusFile.read()):
+        pkgName=blockValue(block, ["Package"])
+        if pkgName in pkgList:
+          installed[pkgName]=blockValue(block, ["Version"])
+    packageLists=[f for f in sorted(os.listdir(listsDir)) if f.endswith("_Packages")]
+  except OSError as e:
+    logger.info(f"unable to read the apt lists, falling back to apt-cache: {e}")
+    return None
+  if not packageLists:
+    return None
+  origins={}
+  for listName in packageLists:
+    try:
+      with open(os.path.join(listsDir, listName), 'rb') as listFile:
+        data=b"\n" + listFile.read()
+    except OSError:
+      continue
+    for pkgName in pkgList:
+      marker=("\nPackage: " + pkgName + "\n").encode()
+      start=data.find(marker)
+      # a list can hold several versions of a package, stop once the installed one is found
+      while start >= 0 and not ( pkgName in origins and origins[pkgName][1] ):
+        end=data.find(b"\n\n", start + 1)
+        if end < 0:
+          end=len(data)
+        stanza=parseInfoBlocks(data[start:end].decode(errors='replace'))
+        stanza=stanza[0] if stanza else []
+        origin=blockValue(stanza, ["Origin"]) or releaseOrigin(listsDir, listName)
+        if origin:
+          isInstalled=( blockValue(stanza, ["Version"]) == installed.get(pkgName) )
+          if pkgName not in origins or isInstalled:
+            origins[pkgName]=(f"Origin: {origin}", isInstalled)
+        start=data.find(marker, end)
+  return {pkgName: origins[pkgName][0] for pkgName in origins}
+def releaseOrigin(listsDir, listName):
+  # the Origin of a whole suite lives in the matching [In]Release file:
+  #   host_path_dists_suite_component_binary-arch_Packages => host_path_dists_suite_InRelease
+  if "_dists_" not in listName:
+    return None
+  prefix, rest = listName.split("_dists_", 1)
+  for releaseName in ["InRelease", "Release"]:
+    releasePath=os.path.join(listsDir, f"{prefix}_dists_{rest.split('_')[0]}_{releaseName}")
+    try:
+      with open(releasePath, 'r', errors='replace') as releaseFile:
+        for line in releaseFile:
+          if line.startswith("Origin:"):
+            return line.split(":", 1)[1].strip()
+    except OSError:
+      continue
+  return None
+def rpmHeaderValues(blob, tagList):
+  # Minimal reader for the rpm header blobs stored in rpmdb.sqlite, returns {tag: value} for the string,
+  #   string array and int32 tags requested
+  indexCount, dataLen = struct.unpack(">II", blob[:8])
+  dataStart=8 + indexCount * 16
+  values={}
+  for i in range(indexCount):
+    tag, tagType, offset, count = struct.unpack(">iIiI", blob[8 + i * 16:24 + i * 16])
+    if tag not in tagList:
+      continue
+    if tagType == 4:
+      values[tag]=list(struct.unpack(f">{count}i", blob[dataStart + offset:dataStart + offset + count * 4]))
+    elif tagType in (6, 8, 9):
+      strings=[]
+      pos=dataStart + offset
+      for _ in range(count if tagType != 6 else 1):
+        endPos=blob.index(b"\0", pos)
+        strings.append(blob[pos:endPos].decode(errors='replace'))
+        pos=endPos + 1
+      values[tag]=strings[0] if tagType == 6 else strings
+  return values
+def rpmOwnersNative(pathList):
+  # Find the owning package of each path without spawning rpm, using the rpm python bindings when this
+  #   python has them, or reading rpmdb.sqlite (RHEL9+, Azure Linux 3) directly.
+  #   Returns {path: (name, version, release, arch)} for the paths found, or None if neither is available
+  fileOwners={}
+  try:
+    import rpm
+  except ImportError:
+    rpm=None
+  if rpm:
+    try:
+      ts=rpm.TransactionSet()
+      for path in pathList:
+        for hdr in ts.dbMatch('basenames', path):
+          nvra=[hdr[tag] for tag in ('name', 'version', 'release', 'arch')]
+          fileOwners[path]=tuple(v.decode() if isinstance(v, bytes) else str(v) for v in nvra)
+          break
+      return fileOwners
+    except Exception as e:
+      logger.info(f"rpm bindings failed to query the database: {e}")
+  # NAME, VERSION, RELEASE, ARCH, DIRINDEXES, BASENAMES, DIRNAMES
+  nvraTags=[1000, 1001, 1002, 1022]
+  fileTags=[1116, 1117, 1118]
+  dbPath="/var/lib/rpm/rpmdb.sqlite"
+  if not os.path.exists(dbPath):
+    return None
+  try:
+    import sqlite3
+    db=sqlite3.connect(f"file:{dbPath}?mode=ro", uri=True)
+    try:
+      for path in pathList:
+        dirName, baseName = os.path.split(path)
+        for hnum, idx in db.execute("SELECT hnum, idx FROM Basenames WHERE key=?", (baseName,)).fetchall():
+          row=db.execute("SELECT blob FROM Packages WHERE hnum=?", (hnum,)).fetchone()
+          if not row:
+            continue
+          hdr=rpmHeaderValues(bytes(row[0]), nvraTags + fileTags)
+          # the basename index doesn't know about directories, check the dirname for this file entry
+          if hdr[1118][hdr[1116][idx]].rstrip("/") == dirName.rstrip("/"):
+            fileOwners[path]=tuple(hdr[tag] for tag in nvraTags)
+            break
+    finally:
+      db.close()
+  except Exception as e:
+    logger.info(f"unable to read {dbPath}, falling back to rpm: {e}")
+    return None
+  return fileOwners
+def dnfOriginsNative(nvraList):
+  # dnf keeps the repository each package was installed from in its history database, read it directly
+  #   instead of spawning 'dnf info' (which loads all the repo metadata).  Returns {nvra: repo} for the
+  #   packages found, or None if there is no history database
+  dbPath="/var/lib/dnf/history.sqlite"
+  if not os.path.exists(dbPath):
+    return None
+  origins={}
+  try:
+    import sqlite3
+    db=sqlite3.connect(f"file:{dbPath}?mode=ro", uri=True)
+    try:
+      for nvra in nvraList:
+        nvr, arch = nvra.rsplit(".", 1)
+        name, version, release = nvr.rsplit("-", 2)
+        # only look at transactions that brought this exact package in: install, downgrade, upgrade, reinstall
+        row=db.execute("SELECT repo.repoid FROM trans_item JOIN rpm ON trans_item.item_id = rpm.item_id "
+                       "JOIN repo ON trans_item.repo_id = repo.id WHERE rpm.name=? AND rpm.version=? "
+                       "AND rpm.release=? AND rpm.arch=? AND trans_item.action IN (1, 2, 6, 9) "
+                       "ORDER BY trans_item.id DESC LIMIT 1", (name, version, release, arch)).fetchone()
+        if row:
+          origins[nvra]=row[0]
+    finally:
+      db.close()
+  except Exception as e:
+    logger.info(f"unable to read {dbPath}, falling back to dnf: {e}")
+    return None
+  return origins
+def fileStamp(pathIn):
+  # identity of a file for the disk cache, a package update replaces the file so the inode or mtime changes
+  try:
+    st=os.stat(pathIn)
+  except OSError:
+    return None
+  return [st.st_ino, st.st_mtime_ns]
+def pkgDbStamp():
+  return {dbPath: (fileStamp(dbPath) or [None, None])[1] for dbPath in pkgDbPaths}
+def loadDiskCache():
+  # read the disk cache once per run, a missing, unreadable or outdated cache just means starting empty
+  global diskCache
+  if diskCache is not None:
+    return diskCache
+  diskCache={}
+  if ( args.no_cache ):
+    return diskCache
+  try:
+    with open(diskCacheFile) as cacheFile:
+      cacheData=json.load(cacheFile)
+  except FileNotFoundError:
+    return diskCache
+  except (OSError, ValueError) as e:
+    logger.info(f"Ignoring unreadable package cache {diskCacheFile}: {e}")
+    return diskCache
+  if ( cacheData.get("version") != diskCacheVersion or cacheData.get("os") != osrID or cacheData.get("db") != pkgDbStamp() ):
+    logger.info("Package databases changed since the package cache was written, ignoring it")
+    return diskCache
+  now=time.time()
+  diskCache={p: entry for p, entry in cacheData.get("entries", {}).items() if now - entry.get("stored", 0) < args.cache_ttl}
+  logger.info(f"Loaded {len(diskCache)} package cache entries from {diskCacheFile}")
+  return diskCache
+def saveDiskCache():
+  if ( args.no_cache ):
+    return
+  cacheData={"version": diskCacheVersion, "os": osrID, "db": pkgDbStamp(), "entries": diskCache}
+  try:
+    os.makedirs(os.path.dirname(diskCacheFile), mode=0o755, exist_ok=True)
+    # write and rename so a run killed halfway (or a parallel run) never leaves a broken cache behind
+    tmpFile=f"{diskCacheFile}.{os.getpid()}"
+    with open(tmpFile, 'w') as cacheFile:
+      json.dump(cacheData, cacheFile)
+    os.replace(tmpFile, diskCacheFile)
+  except OSError as e:
+    logger.info(f"Unable to write package cache {diskCacheFile}: {e}")
+def loadWireState():
+  # read the saved wire server state once per run, same rules as the package cache
+  global wireState
+  if wireState is not None:
+    return wireState
+  wireState={}
+  if ( args.no_cache ):
+    return wireState
+  try:
+    with open(wireStateFile) as stateFile:
+      stateData=json.load(stateFile)
+  except FileNotFoundError:
+    return wireState
+  except (OSError, ValueError) as e:
+    logger.info(f"Ignoring unreadable wire server state {wireStateFile}: {e}")
+    return wireState
+  if ( stateData.get("version") != wireStateVersion or time.time() - stateData.get("stored", 0) >= args.cache_ttl ):
+    logger.info("Saved wire server state is outdated, ignoring it")
+    return wireState
+  wireState=stateData.get("state", {})
+  logger.info(f"Loaded wire server state from {wireStateFile}: {wireState}")
+  return wireState
+def saveWireState():
+  if ( args.no_cache ):
+    return
+  stateData={"version": wireStateVersion, "stored": time.time(), "state": wireState}
+  try:
+    os.makedirs(os.path.dirname(wireStateFile), mode=0o755, exist_ok=True)
+    tmpFile=f"{wireStateFile}.{os.getpid()}"
+    with open(tmpFile, 'w') as stateFile:
+      json.dump(stateData, stateFile)
+    os.replace(tmpFile, wireStateFile)
+  except OSError as e:
+    logger.info(f"Unable to write wire server state {wireStateFile}: {e}")
+def resolvePkgs(pathsIn):
+  # Batch version of the package/repository lookups for validateBin, the package databases are read
+  #   in-process when possible, otherwise every path is handed to the package manager in one call per distro
+  #   family and every unique package is looked up in the repositories once
+  #   - results are stored in pkgCache keyed by the path as passed in
+  paths=[p for p in dict.fromkeys(pathsIn) if p and p not in pkgCache]
+  if not paths:
+    return
+  # anything still valid in the disk cache doesn't need the package databases at all
+  loadDiskCache()
+  stamps={p: [os.path.realpath(p), fileStamp(p)] for p in paths}
+  for p in paths:
+    entry=diskCache.get(p)
+    if entry and entry.get("stamp") == stamps[p]:
+      pkgCache[p]={"pkg": entry["pkg"], "repo": entry["repo"]}
+  cachedPaths=[p for p in paths if p in pkgCache]
+  if cachedPaths:
+    logger.info(f"Using cached package data for: {cachedPaths}")
+  paths=[p for p in paths if p not in pkgCache]
+  if not paths:
+    return
+  logger.info(f"Resolving owning packages for {len(paths)} path(s): {paths}")
+  timedOutBefore=len(cmdTimedOut)
+  realPaths={p: os.path.realpath(p) for p in paths}
+  owners={}
+  if (osrID == "debian"):
+    # dpkg -S prints "pkg[:arch][, pkg2]: /path" for each path it knows about, ask for the dereferenced
+    #   and the original path at once since usrmerge links often only match the original
+    queryPaths=list(dict.fromkeys(list(realPaths.values()) + paths))
+    with timed("dpkg info lists", "native"):
+      fileOwners=dpkgOwnersNative(queryPaths)
+    if fileOwners is None:
+      dpkgOut, _ = runQuery(["dpkg", "-S"] + queryPaths)
+      fileOwners={}
+      for line in dpkgOut.splitlines():
+        if line.startswith("diversion") or ": " not in line:
+          continue
+        pkgPart, filePart = line.rsplit(": ", 1)
+        fileOwners.setdefault(filePart.strip(), pkgPart.split(",")[0].split(":")[0].strip())
+    for p in paths:
+      owner = fileOwners.get(realPaths[p], fileOwners.get(p))
+      if not owner:
+        logger.info(f"All attempts to validate {p} have failed. Likely a rogue file")
+      owners[p]=owner
+    pkgs=list(dict.fromkeys(o for o in owners.values() if o))
+    with timed("apt lists", "native"):
+      repos=aptOriginsNative(pkgs) if pkgs else {}
+    if repos is None:
+      repos={}
+      aptOut, _ = runQuery(["apt-cache", "show", "--no-all-versions"] + pkgs)
+      for block in parseInfoBlocks(aptOut):
+        pkgName=blockValue(block, ["Package"])
+        origin=blockValue(block, ["Origin"])
+        if pkgName and origin and pkgName not in repos:
+          repos[pkgName]=f"Origin: {origin}"
+    for p in paths:
+      if owners[p]:
+        if owners[p] not in repos:
+          # we didn't get a match, probably a manual install (dkpg) or installed from source
+          logger.info(f"package {owners[p]} does not appear to have come from a repository")
+        pkgCache[p]={"pkg": owners[p], "repo": repos.get(owners[p], "no repo")}
+      else:
+        # binary not found or may be source installed (no pkg)
+        pkgCache[p]={"pkg": f"no file or owning pkg for {p}", "repo": "n/a"}
+  elif ( "fedora" in osrID or "centos" in osrID or osrID == "suse" or osrID == "mariner" or osrID == "azurelinux" ):
+    # RHEL reports the full NVRA as before, SUSE and Azure Linux only the package name
+    if ( "fedora" in osrID or "centos" in osrID ):
+      queryFormat="%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\n"
+    else:
+      queryFormat="%{NAME}\\n"
+    # rpm prints one line per path, missing files would only show up on stderr so leave them out of the query
+    queryPaths=[realPaths[p] for p in paths if os.path.exists(realPaths[p])]
+    with timed("rpmdb", "native"):
+      nativeOwners=rpmOwnersNative(queryPaths) if queryPaths else {}
+    if nativeOwners is not None:
+      if ( "fedora" in osrID or "centos" in osrID ):
+        rpmOwners={q: "{}-{}-{}.{}".format(*nvra) for q, nvra in nativeOwners.items()}
+      else:
+        rpmOwners={q: nvra[0] for q, nvra in nativeOwners.items()}
+    else:
+      rpmOut, _ = runQuery(["rpm", "-q", "--queryformat", queryFormat, "--whatprovides"] + queryPaths)
+      rpmLines=rpmOut.strip().splitlines()
+      if ( len(rpmLines) != len(queryPaths) ):
+        # a file owned by several packages throws off the line count, fall back to one query per path
+        logger.info("rpm returned an unexpected number of owners, querying paths one at a time")
+        rpmLines=[runQuery(["rpm", "-q", "--queryformat", queryFormat, "--whatprovides", q])[0].strip().split("\n")[0] for q in queryPaths]
+      rpmOwners=dict(zip(queryPaths, rpmLines))
+    for p in paths:
+      owner=rpmOwners.get(realPaths[p], "")
+      owners[p]=None if ( not owner or "not owned" in owner or "no package provides" in owner ) else owner
+    pkgs=list(dict.fromkeys(o for o in owners.values() if o))
+    repos={}
+    repoErr=""
+    if pkgs:
+      if ( "fedora" in osrID or "centos" in osrID ):
+        # the dnf history database knows where installed packages came from, anything it doesn't know
+        #   (or everything, if it can't be read) is looked up with dnf info
+        with timed("dnf history", "native"):
+          repos=dnfOriginsNative(pkgs) or {}
+        missingPkgs=[pkg for pkg in pkgs if pkg not in repos]
+        # dnf loads the repo metadata for every call, which is the expensive part, so only do it once
+        infoOut, repoErr = runQuery(["dnf", "info"] + missingPkgs) if missingPkgs else ("", "")
+        for block in parseInfoBlocks(infoOut):
+          nvra=f"{blockValue(block, ['Name'])}-{blockValue(block, ['Version'])}-{blockValue(block, ['Release'])}.{blockValue(block, ['Architecture'])}"
+          # Repo line should look like "From repo   : [reponame]", older versions only list "Repository"
+          repo=blockValue(block, ["From repo", "Repository"])
+          if repo and nvra not in repos:
+            repos[nvra]=repo
+      elif osrID == "suse":
+        infoOut, repoErr = runQuery(["zypper", "--quiet", "--no-refresh", "info"] + pkgs)
+        for block in parseInfoBlocks(infoOut):
+          pkgName=blockValue(block, ["Name"])
+          repo=blockValue(block, ["Repository"])
+          if pkgName and repo and pkgName not in repos:
+            repos[pkgName]=repo
+      else:
+        infoOut, repoErr = runQuery(["tdnf", "--installed", "info"] + pkgs)
+        for block in parseInfoBlocks(infoOut):
+          pkgName=blockValue(block, ["Name"])
+          repo=blockValue(block, ["Repo"])
+          if pkgName and repo and pkgName not in repos:
+            repos[pkgName]=repo
+    for p in paths:
+      if owners[p]:
+        if owners[p] in repos:
+          thisRepo=repos[owners[p]]
+        elif ( "fedora" in osrID or "centos" in osrID ):
+          # we didn't get a match, probably a manual install (rpm), built from source, or a general DNF failure
+          thisRepo=f"repo search failed: {repoErr}"
+        else:
+          # we didn't get a match, probably a manual install (rpm) or from source
+          thisRepo="not from a repo"
+        pkgCache[p]={"pkg": owners[p], "repo": thisRepo}
+      else:
+        pkgCache[p]={"pkg": f"no file or owning pkg for {p}", "repo": "n/a"}
+  else:
+    print("Unable to determine OS family from os-release")
+    for p in paths:
+      pkgCache[p]={"pkg": "packaging system unknown", "repo": "n/a"}
+    return
+  if ( len(cmdTimedOut) > timedOutBefore ):
+    # the package manager was killed, whatever it didn't get to answer would look like a rogue file
+    logger.info("Package lookups timed out, not caching the results")
+    return
+  now=time.time()
+  for p in paths:
+    # a failed repo search is most likely temporary (network, repo outage), so always try those again
+    if not pkgCache[p]["repo"].startswith("repo search failed"):
+      diskCache[p]={"pkg": pkgCache[p]["pkg"], "repo": pkgCache[p]["repo"], "stamp": stamps[p], "stored": now}
+  saveDiskCache()
 def validateBin(binPathIn):
   # usage: pass in a binary to check, the following will be determined
   #  - absolute path (dereference links)
@@ -156,89 +821,47 @@ def validateBin(binPathIn):
     logger.info(f"Link found: {binPath} points to {realBin}, verify outputs if this returns empty data")
     binPath=realBin
   thisBin={"exe":binPathIn}
- 
-  if (osrID == "debian"):
-    noPkg=False # extra exception flag, using pure try/excepts is difficult to follow
-    try:
-      # Find what package owns the binary
-      thisBin["pkg"]=subprocess.check_output("dpkg -S " + binPath, shell=True, stderr=subprocess.DEVNULL).decode().strip().split(":")[0]
-    except:
-      logger.info(f"issue validating {binPath}, reverting to original path: {binPathIn}")
-      try:
-        thisBin["pkg"]=subprocess.check_output("dpkg -S " + binPathIn, shell=True, stderr=subprocess.DEVNULL).decode().strip().split(":")[0]
-      except subprocess.CalledProcessError as e:
-        logger.info(f"All attempts to validate {binPathIn} have failed. Likely a rogue file: {e.output}")
-        noPkg=True
-    if not noPkg:
-      # find what repository the package came from
-      try:
-        aptOut=subprocess.check_output("apt-cache show --no-all-versions " + thisBin["pkg"] , shell=True, stderr=subprocess.DEVNULL).decode().strip()
-        thisBin["repo"]=re.search("Origin.*",aptOut).group()
-      except subprocess.CalledProcessError as e:
-        # we didn't get a match, probably a manual install (dkpg) or installed from source
-        logger.info(f"package {thisBin['pkg']} does not appear to have come from a repository")
-        thisBin["repo"]="no repo"
-    else: 
-      # binary not found or may be source installed (no pkg)
-      thisBin["pkg"]=f"no file or owning pkg for {binPathIn}"
-      thisBin["repo"]="n/a"
-  # catch more options for ID in os-release since RHEL10 adds some variabilty
-  elif ( "fedora" in osrID or "centos" in osrID ):
-    try:
-      rpm=subprocess.check_output("rpm -q --whatprovides " + binPath, shell=True, stderr=subprocess.DEVNULL).decode().strip()
-      thisBin["pkg"]=rpm
-      try:
-        # expand on this to make the call to 'dnf'
-        #dnfOut=subprocess.check_output("dnf info " + rpm, shell=True, stderr=subprocess.DEVNULL).decode().strip()
-        result=subprocess.run(["dnf","info",rpm], stdout=subprocess.PIPE, stderr=subprocess.PIPE,check=True)
-      except subprocess.CalledProcessError as e:
-        # we didn't get a match, probably a manual install (rpm), built from source, or a general DNF failure
-        thisBin["repo"]=f"repo search failed: {e.stderr.decode()}"
-      else:
-        dnfOut=result.stdout.decode().strip()
-        # Repo line should look like "From repo   : [reponame]" so clean it up
-        m = re.search(r"(From repo.*|Repository.*)",dnfOut).group().strip().split(":")[1].strip()
-        if ( not m ):
-          m = f"No repo found for {binPath}"
-        thisBin["repo"]=m
-    except subprocess.CalledProcessError as e:
-      thisBin["pkg"]=f"no file or owning pkg: {e.output}"
-      thisBin["repo"]="n/a"
-  elif ( osrID == "suse"):
-    try:
-      rpm=subprocess.check_output('rpm -q --queryformat %{NAME} --whatprovides ' + binPath, shell=True, stderr=subprocess.DEVNULL).decode()
-      thisBin["pkg"]=rpm
-      try:
-        # options:
-        zyppOut=subprocess.check_output("zypper --quiet --no-refresh info " + rpm, shell=True, stderr=subprocess.DEVNULL).decode().strip()
-        thisBin["repo"]=re.search("Repository.*",zyppOut).group().split(":")[1].strip()
-      except:
-        # we didn't get a match, probably a manual install (rpm) or from source
-        thisBin["repo"]="not from a repo"
-    except subprocess.CalledProcessError as e:
-      thisBin["pkg"]="no file or owning pkg: " + e
-      thisBin["repo"]="n/a"
-  elif ( osrID == "mariner" or osrID == "azurelinux"):
-    try:
-      rpm=subprocess.check_output('rpm -q --queryformat %{NAME} --whatprovides ' + binPath, shell=True).decode()
-      thisBin["pkg"]=rpm
-      try:
-        # options:
-        zyppOut=subprocess.check_output("tdnf --installed info " + rpm, shell=True).decode().strip()
-        thisBin["repo"]=re.search("Repo.*",zyppOut).group().split(":")[1].strip()
-      except:
-        # we didn't get a match, probably a manual install (rpm) or from source
-        thisBin["repo"]="not from a repo"
-    except subprocess.CalledProcessError as e:
-      thisBin["pkg"]="no file or owning pkg: " + e
-      thisBin["repo"]="n/a"
-  else:
-    print("Unable to determine OS family from os-release")
-    thisBin["pkg"]="packaging system unknown"
-    thisBin["repo"]="n/a"
+  # package data is normally already there from the batched resolvePkgs() call in the main flow
+  if binPathIn not in pkgCache:
+    resolvePkgs([binPathIn])
+  thisBin["pkg"]=pkgCache[binPathIn]["pkg"]
+  thisBin["repo"]=pkgCache[binPathIn]["repo"]
   logString = binPath + " owned by package '" + thisBin["pkg"] + "' from repo '" + thisBin["repo"] + "'"
   logger.info(logString)
   bins[binPathIn]=thisBin
+def fetchUnits(unitList):
+  # Fetch all the properties checkService needs for every unit in a single 'systemctl show' call, instead
+  #   of one 'systemctl status' plus a 'systemctl show' per property and per unit.  The output is one block
+  #   of PROP=value lines per unit, separated by empty lines, in the order the units were requested
+  units=[u for u in dict.fromkeys(unitList) if u not in unitCache]
+  if not units:
+    return
+  showRC, showOut, showErr = runCmd(["systemctl", "show", "-p", ",".join(unitProps)] + units)
+  if showRC is None:
+    # systemd didn't answer, report the units as such rather than as missing
+    for unitName in units:
+      unitCache[unitName]={"LoadState": "loaded", "ActiveState": "unknown", "SubState": showErr, "UnitFileState": "unknown"}
+    return
+  blocks=[]
+  thisBlock={}
+  for line in showOut.splitlines() + [""]:
+    if not line.strip():
+      if thisBlock:
+        blocks.append(thisBlock)
+      thisBlock={}
+    elif "=" in line:
+      key, value = line.split("=", 1)
+      thisBlock[key]=value
+  if ( len(blocks) != len(units) ):
+    logger.info(f"systemctl show returned {len(blocks)} blocks for {len(units)} units: {showErr}")
+  for unitName, props in zip(units, blocks):
+    unitCache[unitName]=props
+  for unitName in units:
+    # anything systemctl didn't tell us about is treated as a missing unit
+    unitCache.setdefault(unitName, {"LoadState": "not-found"})
+def unitExists(unitName):
+  fetchUnits([unitName])
+  return unitCache[unitName].get("LoadState", "not-found") != "not-found"
 def checkService(unitName, package=False):
   # take in a unit file and check status, enabled, etc.
   # output object:
@@ -246,44 +869,33 @@ def checkService(unitName, package=False):
   logger.info("Service/Unit check " + unitName)
 
   thisSvc={"svc":unitName}
-  unitStat=0          # default service status return, we'll set this based on the 'systemctl status' RC
   thisSvc["status"]="undef" # this will get changed somewhere
-  # First off, let us check if the unit even exists
-  try:
-    throwawayVal=subprocess.check_output(f"systemctl status {unitName}", shell=True)
-    #0 program is running or service is OK <<= default value of unitStat
-    #1 program is dead and /var/run pid file exists
-    #2 program is dead and /var/lock lock file exists
-    #3 program is not running
-    #4 program or service status is unknown
-    #5-99  reserved for future LSB use
-    #100-149   reserved for distribution use
-    #150-199   reserved for application use
-    #200-254   reserved
-  except subprocess.CalledProcessError as sysctlErr:
-    # we will be referencing this return code later, assuming it's not 4 - see table above
-    unitStat=sysctlErr.returncode
-    if ( unitStat == 4 ):
-      thisSvc["status"]="nonExistantService"
-    else:
-      logger.info(f"Service {unitName} status returned unexpected value: {sysctlErr.output} with text: {sysctlErr.output}")
-  # Unit was determined to exist (not rc=4), so lets validate the service status and maybe some other files
-  if ( unitStat < 4 ):
+  # defaults for when the unit isn't here or package details weren't asked for
+  thisSvc["config"]="n/a"
+  thisSvc["path"]=""
+  thisSvc["pkg"]="not checked"
+  thisSvc["repo"]="n/a"
+  # the properties are normally already there from the fetchUnits() call in the main flow
+  fetchUnits([unitName])
+  props=unitCache[unitName]
+  # First off, let us check if the unit even exists, LoadState=not-found is what 'systemctl status' RC 4 was
+  if not unitExists(unitName):
+    thisSvc["status"]="nonExistantService"
+    logger.info(f"Service {unitName} does not exist")
+  else:
     # Process the configured, active and substate for the service.  Active/Sub could be inactive(dead) in an interactive console
-    #  This can be done from systemctl show [service] --property=[UnitFileState|ActiveState|SubState]
-    config=subprocess.check_output(f"systemctl show {unitName} --property=UnitFileState",shell=True).decode().strip().split("=")[1]
-    active=subprocess.check_output(f"systemctl show {unitName} --property=ActiveState",shell=True).decode().strip().split("=")[1]
-    sub=subprocess.check_output(f"systemctl show {unitName} --property=SubState",shell=True).decode().strip().split("=")[1]
-    thisSvc["config"]=config
+    thisSvc["config"]=props.get("UnitFileState", "")
     # make the 'status' look like the output of `systemctl status`
-    thisSvc["status"]=f"{active}({sub})"
+    thisSvc["status"]=f"{props.get('ActiveState', '')}({props.get('SubState', '')})"
+    # oneshot units like cloud-init are healthy in active(exited), keep the type for the findings checks
+    thisSvc["type"]=props.get("Type", "")
 
     # more integrety checks based on digging into the files
-    thisSvc["path"]=subprocess.check_output(f"systemctl show {unitName} -p FragmentPath", shell=True).decode().strip().split("=")[1]
+    thisSvc["path"]=props.get("FragmentPath", "")
     # Which python does the service call?
     # # dive into the file in 'path' and logic out what python is being called for validations
     # who owns it... maybe?
-    if ( package ):
+    if ( package and thisSvc["path"] ):
       # We need to process the owner and path of the unit if (package) was set by the caller
       logger.info(f"Checking owners for unit: {unitName} using validateBins")
       # No need to re-code all this, just call validateBin(binName)
@@ -294,22 +906,18 @@ def checkService(unitName, package=False):
       del bins[thisSvc["path"]]
     else:
       logger.info(f"package details for {unitName} not requested, skipping")
-      pass
-  else:
-    #set some defaults when the unit wasn't here
-    pass
 
-  unitFile=subprocess.check_output(f"systemctl show {unitName} -p FragmentPath", shell=True).decode().strip().split("=")[1]
-  logString = unitName + " unit file found at " + thisSvc["path"] + "owned by package '" + thisSvc["pkg"] + "from repo: " + thisSvc["repo"]
+  logString = unitName + " unit file found at " + thisSvc["path"] + " owned by package '" + thisSvc["pkg"] + "' from repo: " + thisSvc["repo"]
   logger.info(logString)
   services[unitName]=thisSvc
   
-def checkHTTPURL(urlIn):
+def checkHTTPURL(urlIn, timeout=5):
   checkURL = urlIn
   headers = {'Metadata': 'True'}
   returnString=""
   try:
-    r = requests.get(checkURL, headers=headers, timeout=5)
+    with timed(f"GET {checkURL}", "http"):
+      r = requests.get(checkURL, headers=headers, timeout=timeout)
     returnString=r.status_code
     r.raise_for_status()
   except requests.exceptions.HTTPError as errh:
@@ -323,13 +931,14 @@ def checkHTTPURL(urlIn):
   except requests.exceptions.RequestException as err:
     returnString=f"UnexpectedErr"
   return returnString
-def isOpen(ip, port):
+def isOpen(ip, port, timeout=2):
   # return true/false if the remote port is/isn't listening, only takes an IP, no DNS is done
   # using connect_ex would give us the error code for analysis, but we're just going for true/false here
   s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  s.settimeout(2)
+  s.settimeout(timeout)
   try:
-    is_open = s.connect((ip, int(port))) == 0 # True if open, False if not
+    with timed(f"connect {ip}:{port}", "socket"):
+      is_open = s.connect((ip, int(port))) == 0 # True if open, False if not
     if is_open:
       s.shutdown(socket.SHUT_RDWR)
     return True
@@ -337,437 +946,693 @@ def isOpen(ip, port):
     is_open = False
   s.close()
   return is_open
+def wireClose():
+  global wireConn
+  if wireConn is not None:
+    wireConn.close()
+    wireConn=None
+def wireProxy():
+  # The proxy the wire server requests go through, picked from HTTP_PROXY/NO_PROXY the same way requests does, so a
+  #   proxy in the environment affects these checks like it did when they were made with requests.  Returns
+  #   (host, port, headers for the proxy) or None for a direct connection
+  proxyURL=requests.utils.get_environ_proxies(f"http://{wireIP}/").get("http")
+  if not proxyURL:
+    return None
+  parsedProxy=urlparse(proxyURL if "://" in proxyURL else f"http://{proxyURL}")
+  proxyHeaders={}
+  if parsedProxy.username:
+    proxyAuth=f"{unquote(parsedProxy.username)}:{unquote(parsedProxy.password or '')}"
+    proxyHeaders["Proxy-Authorization"]="Basic " + base64.b64encode(proxyAuth.encode()).decode()
+  return parsedProxy.hostname, parsedProxy.port or 80, proxyHeaders
+def wireRequest(name, endpoint, headers=None, timeout=5):
+  # GET from the wire server over the shared keep-alive connection and return the response with its body unread,
+  #   so wireFind() can parse big documents as they arrive.  Anything but a 200 raises HTTPException, and a
+  #   connection the wire server dropped while idle is opened again once
+  global wireConn
+  reqHeaders={
+    "Accept": "application/xml",  # Requesting XML response
+    "User-Agent": "VM assist"  # Optional, helps identify the client
+  }
+  reqHeaders.update(headers or {})
+  # through a proxy the request line carries the whole URL
+  proxy=wireProxy()
+  target=endpoint
+  if proxy:
+    target=f"http://{wireIP}{endpoint}"
+    reqHeaders.update(proxy[2])
+  for attempt in (1, 2):
+    reused=wireConn is not None
+    if not reused:
+      if proxy:
+        logger.info(f"Connecting to the wire server through the proxy {proxy[0]}:{proxy[1]}")
+        wireConn=http.client.HTTPConnection(proxy[0], proxy[1], timeout=timeout)
+      else:
+        wireConn=http.client.HTTPConnection(wireIP, timeout=timeout)
+    elif wireConn.sock is not None:
+      wireConn.sock.settimeout(timeout)
+    reqStart=time.monotonic()
+    try:
+      with timed(f"wire {name}", "http"):
+        wireConn.request("GET", target, headers=reqHeaders)
+        response=wireConn.getresponse()
+    except ConnectionError as e:
+      wireClose()
+      if ( reused and attempt == 1 ):
+        logger.info(f"Wire server dropped the idle connection ({e}), reconnecting")
+        continue
+      raise
+    except Exception:
+      wireClose()
+      raise
+    wireLatency[name]={'status': response.status, 'elapsed': round(time.monotonic() - reqStart, 3)}
+    logger.info(f"Wire server {name} returned {response.status} after {wireLatency[name]['elapsed']}s")
+    if response.status != 200:
+      # read the rest so the connection can be used again
+      response.read()
+      raise http.client.HTTPException(f"{name} returned HTTP {response.status}")
+    return response
+def wireFind(response, paths):
+  # Text of the first element at each of the paths (below the root element, 'a/b/c') in the XML response.  The
+  #   document is parsed as it is read and every element dropped once seen, ExtensionsConfig carries the settings
+  #   of every extension on the VM and can be large.  Returns {path: text or None}
+  found=dict.fromkeys(paths)
+  tagPath=[]
+  for event, elem in ElementTree.iterparse(response, events=("start", "end")):
+    if event == "start":
+      tagPath.append(elem.tag)
+      continue
+    thisPath="/".join(tagPath[1:])
+    if ( thisPath in found and found[thisPath] is None ):
+      found[thisPath]=elem.text
+    tagPath.pop()
+    elem.clear()
+  return found
+def wireVersions(timeout=5):
+  # Connectivity probe for the wire server, also picking up its preferred API version for checkGoalState() on the
+  #   connection the goal state requests will reuse.  Returns the HTTP status or the checkHTTPURL() error strings
+  wireLatency.clear()
+  try:
+    response=wireRequest("versions", "/?comp=versions", timeout=timeout)
+  except http.client.HTTPException:
+    if "versions" in wireLatency:
+      return f"Error:{wireLatency['versions']['status']}"
+    return "UnexpectedErr"
+  except socket.timeout:
+    return "Timeout"
+  except OSError:
+    return "ConnectErr"
+  try:
+    apiVers=wireFind(response, ["Preferred/Version"])["Preferred/Version"]
+  except ElementTree.ParseError as e:
+    # the wire server answered, that's what this probe is about, checkGoalState() falls back to a saved version
+    logger.warning(f"Unable to parse the wire server versions: {e}")
+    wireClose()
+    apiVers=None
+  if apiVers:
+    loadWireState()['apiVersion']=apiVers
+  return response.status
+def probeEndpoints(probeList):
+  # Run all the endpoint probes at the same time so a VM with blocked platform endpoints waits for the
+  #   slowest probe instead of the sum of all of them.  Each probe is a dict:
+  #   {'name': key, 'func': checkHTTPURL/isOpen/wireVersions, 'args': (...), 'timeout': secs, 'timeoutValue': value if the deadline passes}
+  # returns {name: {'name':, 'value':, 'elapsed': secs, 'timedOut': bool}}
+  def timedProbe(probe):
+    probeStart=time.monotonic()
+    value=probe['func'](*probe['args'], timeout=probe['timeout'])
+    return value, round(time.monotonic() - probeStart, 3)
+  results={}
+  executor=concurrent.futures.ThreadPoolExecutor(max_workers=len(probeList))
+  stageStart=time.monotonic()
+  futures={}
+  for probe in probeList:
+    # the probe functions take their own timeout, the stage deadline adds a second to cover connection setup
+    futures[probe['name']]=executor.submit(timedProbe, probe)
+  for probe in probeList:
+    deadline=stageStart + probe['timeout'] + 1
+    thisResult={'name': probe['name'], 'timedOut': False}
+    try:
+      thisResult['value'], thisResult['elapsed']=futures[probe['name']].result(timeout=max(0, deadline - time.monotonic()))
+    except concurrent.futures.TimeoutError:
+      thisResult['value']=probe['timeoutValue']
+      thisResult['timedOut']=True
+    except Exception as e:
+      logger.warning(f"Probe {probe['name']} failed: {e}")
+      thisResult['value']=probe['timeoutValue']
+    if 'elapsed' not in thisResult:
+      thisResult['elapsed']=round(time.monotonic() - stageStart, 3)
+    logger.info(f"Probe {probe['name']} returned {thisResult['value']} after {thisResult['elapsed']}s")
+    results[probe['name']]=thisResult
+  # don't wait around for anything that blew through its deadline, it will end on its own socket timeout
+  executor.shutdown(wait=False)
+  return results
 
 def getInterfaces():
-  # Get all interfaces present in the system except for loopback, return as a dict
-  # -- May have an issue with multiple VIPs on a NIC
-  ipOut = subprocess.run(['ip', '-j', 'address', 'show'], stdout=subprocess.PIPE)
-  intJSON = json.loads(ipOut.stdout.decode('utf-8'))
-  
+  # Get all interfaces present in the system except for loopback, return as a dict.  The MAC comes from
+  #   /sys/class/net/<if>/address and the IPv4 address from the SIOCGIFADDR ioctl, so no 'ip' process is needed
+  # -- May have an issue with multiple VIPs on a NIC, the ioctl only returns the primary address
+  try:
+    with timed("/sys/class/net", "native"):
+      ifNames=sorted(os.listdir("/sys/class/net"))
+  except OSError as e:
+    # None rather than an empty dict, so checkNetwork() doesn't report a missing eth0
+    logger.error(f"Unable to list the interfaces: {e}")
+    return None
   addresses = {}
-  for iface in intJSON:
-    iface_name = iface.get('ifname')
-    if iface_name != "lo":
-      addresses[iface_name] = {}
-      addresses[iface_name]['mac'] = iface.get('address')
-      for addr_info in iface.get('addr_info', []):
-        if addr_info.get('family') == 'inet':  # Only IPv4 addresses
-          addresses[iface_name]['ip'] = addr_info.get('local')
+  ioSock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    for ifName in ifNames:
+      if ifName == "lo":
+        continue
+      try:
+        with open(f"/sys/class/net/{ifName}/address") as addrFile:
+          addresses[ifName] = {'mac': addrFile.read().strip()}
+      except OSError:
+        # bonding_masters and friends live here too, they aren't interfaces
+        continue
+      try:
+        ifReq=fcntl.ioctl(ioSock.fileno(), SIOCGIFADDR, struct.pack('256s', ifName.encode()[:15]))
+        addresses[ifName]['ip'] = socket.inet_ntoa(ifReq[20:24])
+      except OSError:
+        # no IPv4 address on this interface
+        pass
+  finally:
+    ioSock.close()
   return addresses
-# TODO:: repackage this search function as a generic re: search, and call it with the defined re for MAC addresses
-def searchDirForMAC(dirToSearch, returnDict, okMAC):
-  # return all MACs found defined in some config file in the passed in directory
-  #   We'll add each file, and the MAC(s) found in there, to the passed in dict
-  # accept an 'ok' MAC definition, because it would be ok for cloud-init managed
-  #   configs to have a mac defined - CI will reset the configs if the mac changes
-  # Define a MAC address regex pattern (e.g., 00:1A:2B:3C:4D:5E or 00-1A-2B-3C-4D-5E)
-  mac_pattern = re.compile(r'([0-9a-f]{2}(?::[0-9a-f]{2}){5})', re.IGNORECASE)
-  # Walk through all files in the directory
-  for root, _, files in os.walk(dirToSearch):
-    # loop through all files in the dirToSearch
-    for file_name in files:
-      file_path = os.path.join(root, file_name)
-      # Check if it's a regular file (skip links, sockets, pipes, etc.)
-      if os.path.isfile(file_path):
-        try:
-          with open(file_path, 'r') as file:
-            content = file.read()
-            # Find all MAC addresses in the file
-            mac_addresses = mac_pattern.findall(content)
-            # If MAC addresses are found, and not the passed in okMAC, add them to the dictionary
-            # mac_addresses as returned from findall will be an array of string(s)
-            if ( mac_addresses and (okMAC not in mac_addresses) ):
-              returnDict[file_path] = mac_addresses
-        except (UnicodeDecodeError, PermissionError):
-          # Skip files that can't be read due to encoding or permission issues
-          # just create the exception code block, but we won't be using it
-          pass
-              
-def searchDirForString(dirToSearch, returnDict, string):
-  for root, _, files in os.walk(dirToSearch):
-    # loop through all files in the dirToSearch
-    for file_name in files:
-      file_path = os.path.join(root, file_name)
-      # Check if it's a regular file (skip links, sockets, pipes, etc.)
-      if os.path.isfile(file_path):
-        try:
-          # Create a holding space for any/all matched text
-          defLines=""
-          # Open this file and search for the string
-          with open(file_path, 'r') as file:
-            for line_number, line in enumerate(file, start=1):
-              # store the line number and line in the return string
-              if string in line:
-                # after the first occurrance add a newline every time we find a line
-                if (defLines):
-                  defLines = f"{defLines}\n"
-                defLines = f"{defLines}{line_number}: {line.strip()}"
-          # if we found anything create the file entry in the dict with all lines
-          if ( defLines ):
-            returnDict[file_path] = defLines
-        except (UnicodeDecodeError, PermissionError):
-          # Skip files that can't be read due to encoding or permission issues
-          # just create the exception code block, but we won't be using it
-          pass
+def readMounts(fsTypes):
+  # Mounted filesystems of the given types from /proc/self/mountinfo, with their usage from statvfs, instead of
+  #   running findmnt.  Lines look like:
+  #   36 35 98:0 / /mnt1 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+  #   (id, parent, major:minor, root, mount point, mount options, optional fields, '-', type, source, super options)
+  #   Bind mounts share the usage of their filesystem, so statvfs is only called once per device - container hosts
+  #   can have hundreds of them
+  mounts=[]
+  usage={}
+  try:
+    with open("/proc/self/mountinfo") as mountFile:
+      mountLines=mountFile.read().splitlines()
+  except OSError as e:
+    logger.error(f"Unable to read the mount table: {e}")
+    return mounts
+  for line in mountLines:
+    fields=line.split()
+    if "-" not in fields[6:]:
+      continue
+    sep=fields.index("-", 6)
+    if fields[sep+1] not in fsTypes:
+      continue
+    major, minor = fields[2].split(":")
+    dev=os.makedev(int(major), int(minor))
+    target=mountEscapeRegex.sub(lambda m: chr(int(m.group(1), 8)), fields[4])
+    if dev not in usage:
+      try:
+        fsStat=os.statvfs(target)
+        # same as findmnt's USE%
+        usage[dev]=round((fsStat.f_blocks - fsStat.f_bfree) * 100 / fsStat.f_blocks) if fsStat.f_blocks else 0
+      except OSError as e:
+        logger.info(f"Unable to get the usage of {target}: {e}")
+        usage[dev]=0
+    mounts.append({
+      'TARGET': target,
+      'SOURCE': mountEscapeRegex.sub(lambda m: chr(int(m.group(1), 8)), fields[sep+2]),
+      'FSTYPE': fields[sep+1],
+      # per mount options (noexec lives here) followed by the filesystem's own
+      'OPTIONS': ",".join(dict.fromkeys(fields[5].split(",") + fields[sep+3].split(",") if len(fields) > sep+3 else fields[5].split(","))),
+      'DEV': dev,
+      'USE%': usage[dev]
+    })
+  return mounts
+def walkConfigDirs(dirList):
+  # every regular file under the directories, each tree once even if one of the dirs is a link to, or inside, another
+  seenDirs=set()
+  for dirToSearch in dirList:
+    for root, dirs, files in os.walk(dirToSearch):
+      realRoot=os.path.realpath(root)
+      if realRoot in seenDirs:
+        dirs[:]=[]
+        continue
+      seenDirs.add(realRoot)
+      for file_name in files:
+        file_path = os.path.join(root, file_name)
+        # Check if it's a regular file (skip links, sockets, pipes, etc.)
+        if os.path.isfile(file_path):
+          yield file_path
+def configDirStamp(dirList):
+  # fingerprint of the files scanConfigDirs() reads, a file edited in place, added or removed anywhere below the
+  #   dirs changes it, the mtime of the dirs themselves only changes for entries added or removed right in them
+  return [[file_path, fileStamp(file_path)] for file_path in walkConfigDirs(dirList)]
+def scanConfigDirs(dirList, patterns, maxBytes=1048576):
+  # Walk each directory once and check every line of every file against all the patterns in the same pass,
+  #   files are streamed line by line so memory use doesn't depend on the file size
+  #   - patterns: {name: plain string or compiled regex}, a string is a simple 'in' test on the line
+  #   - returns {name: {filePath: [(lineNumber, line, [matches])]}} for every file with at least one match
+  # binary files and anything over maxBytes are skipped, configs are small text files
+  results={name: {} for name in patterns}
+  for file_path in walkConfigDirs(dirList):
+    try:
+      if ( os.path.getsize(file_path) > maxBytes ):
+        logger.info(f"Skipping {file_path} while scanning configs, larger than {maxBytes} bytes")
+        continue
+      fileHits={name: [] for name in patterns}
+      with open(file_path, 'rb') as file:
+        if b"\0" in file.read(1024):
+          # binary file, nothing to find in here
+          continue
+        file.seek(0)
+        for line_number, rawLine in enumerate(file, start=1):
+          line=rawLine.decode()
+          for name, pattern in patterns.items():
+            if isinstance(pattern, str):
+              if pattern in line:
+                fileHits[name].append((line_number, line.strip(), [pattern]))
+            else:
+              lineMatches=pattern.findall(line)
+              if lineMatches:
+                fileHits[name].append((line_number, line.strip(), lineMatches))
+      for name in patterns:
+        if fileHits[name]:
+          results[name][file_path]=fileHits[name]
+    except (UnicodeDecodeError, OSError):
+      # Skip files that can't be read due to encoding or permission issues
+      pass
+  return results
 
 #### END main logic funcs
 
-#### START main processing flow
+#### Check stages
+# Every check is a function that reads what it needs from 'facts', adds its entries to the bins/services/checks/findings
+#   dicts and hands back what it found as a result dict (see runCheck).  They can be run one at a time, in any
+#   order after init(), as often as needed - the entries a check made on its last run are dropped before it runs again
+def loadOSRelease(pathIn="/etc/os-release"):
+  # parse out os-release and put the values into a dict
+  global os_release, osrID, osMaj, osMin
+  path = pathlib.Path(pathIn)
+  with open(path) as stream:
+    reader = csv.reader(filter(lambda line: line.strip(), stream), delimiter="=")
+    os_release = dict(reader)
+  osrID=os_release.get("ID_LIKE", os_release.get("ID"))
+  osMajS,osMinS=os_release.get("VERSION_ID").split(".")
+  osMaj=int(osMajS)
+  osMin=int(osMinS)
+def init(bashIn="", osReleasePath="/etc/os-release", optionsIn=None):
+  # Set up everything the checks share: OS details, what the bash wrapper found, and where the agent lives.  A
+  #   program using this as a library calls this once, optionally with its own argparse-style options, then
+  #   runChecks() as often as it likes
+  global args, bashArgs, fullPercent
+  if optionsIn is not None:
+    args=optionsIn
+  bashArgs=parseBashArgs(bashIn)
+  # debug percentage
+  fullPercent=20 if ( args.verbose > 0 ) else 90
+  loadOSRelease(osReleasePath)
+  # log anything we've determined above
+  logger.info(f"OS family determined as {osrID}")
+  logger.info(f"OS Major Version={osMaj}")
+  logger.info(f"OS Minor Version={osMin}")
 
-# ToDo list from bash logstring: (delete when completed)
-# LOGSTRING="$LOGSTRING|SERVICE=$SERVICE"
-# LOGSTRING="$LOGSTRING|PY=$PY"
-# LOGSTRING="$LOGSTRING|PYVERS=$PYVERSION"
-# LOGSTRING="$LOGSTRING|PYCOUNT=$PYCOUNT"
-# LOGSTRING="$LOGSTRING|PYREQ=$PYREQ"
-# LOGSTRING="$LOGSTRING|PYALA=$PYALA"
-
-logger.info("args were "+str(parser.parse_args()))
-# log anything we've determined above 
-logger.info(f"OS family determined as {osrID}")
-logger.info(f"OS Major Version={osMaj}")
-logger.info(f"OS Minor Version={osMin}")
-osOld = False
-osFamOK = True
-if ( osrID == "fedora" ):
-  if ( osMaj < 8 ):
-    osOld = True
-elif ( osrID == "suse" ):
-  if ( osMaj < 15 ):
-    osOld = True
-elif ( osrID == "debian" ):
-  if ( osMaj < 20 ):
-    osOld = True
-elif ( osrID == "azurelinux" ):
-  if ( osMaj < 3 ):
-    osOld = True
-else:
-  osFamOK = False
-
-if ( osOld ):
-    logger.warning(f"OS family detected as {osrID} with major version of {osMaj} - this OS is too old too be reliably tested")
-    findings['osSup']={'description': 'OS is Old', 'status': f"OS Family:{osrID} with Major Release:{osMaj} is too old to be reliably tested"}
-if ( not osFamOK):
-    logger.warning(f"Unsupported OS family detected:{osrID}")
-    findings['osSup']={'description': 'OS family is minimally or completely untested', 'status': f"OS Family:{osrID}"}
-
-
-# We'll use the 'bash' arguments from the bash wrapper to seed this script
-waaServiceIn=bashArgs.get('SERVICE', "waagent.service") # this may differ per-distro, but offer a default
-pythonIn=bashArgs.get('PY', "/usr/bin/python3")
-waaBin=subprocess.check_output("which waagent", shell=True, stderr=subprocess.DEVNULL).decode().strip()
-logger.info(f"using waagent location {waaBin}")
-
-
-# look through the os.environ object for any mention of a variable with 'proxy' in the name
-osEnv=dict(os.environ)
-proxyVars = {key: osEnv[key] for key in osEnv if "proxy" in key.lower()}
-# create a check and if needed a finding
-if proxyVars:
-  logger.info(f"proxy definition found in env: {proxyVars}")
-  findings['proxy']={'description': 'ProxyCheck', 'status': f"Found proxy environment vars:\n{proxyVars}"}
-  checks['proxy']={"check":"proxy", "value":proxyVars}
-else:
-  logger.info(f"No proxies found in env")
-  checks['proxy']={"check":"proxy", "value":"None Found"}
-
-# Check services and binaries
-checkService(waaServiceIn, package=True)
-# Check SSHD, Debian based distros started naming it ssh and launching on connect, sometime before Ubuntu 24.04
-# TODO: make this version dependent - ubuntu 24.04+ uses JIT activation of sshd
-if ( osrID == "debian" ):
-  checkService("ssh.service", package=True)
-else:
-  checkService("sshd.service", package=True)
-
-validateBin(pythonIn)
-# PoC for right now to show what we can do, also because changing SSL can cause problems for extensions talking outside wire/IMDS
-validateBin("/usr/bin/openssl")
-validateBin(waaBin) # just to create another easy-to-check test
-# Lets pull the version out of the 'normal' --version output string, for manual comparisons
-waaVerOut=subprocess.check_output(f"{waaBin} --version", shell=True, stderr=subprocess.DEVNULL).decode().strip().lower().split('\n')
-# if the output changes format we'll have to recode this block
-# expected output:
-#['walinuxagent-2.7.0.6 running on redhat 8.10',
-# 'python: 3.6.8',
-# 'goal state agent: 2.7.0.6']
-waaVer = "0.0.0.0"
-waaGoalVer = "0.0.0.0"
-for line in waaVerOut:
-  # process the version out of string #1 or #3 above - with an optional 4th v.v.v.v section since some versions only have 3
-  verSearch = re.search(r'\d+\.\d+\.\d+(\.\d+)?', line)
-  if ( verSearch ):
-    if "walinuxagent" in line:
-      waaVer = verSearch.group(0)
-    elif "goal" in line:
-      waaGoalVer = verSearch.group(0)
-# log the check
-checks["waaVersion"]={
-    'description': 'Agent component versions',
-    'check': 'waaVersion',
-    'value': f"WAA:{waaVer}, Goal:{waaGoalVer}",
-    'type': 'config'
-    }
-logger.info(f"Found agent:{waaVer} and extension handler: {waaGoalVer}")
-# if the versions match, it's a 'finding' - these will only match if autoUpg is false or the package is VERY new so likely from source
-if waaVer == waaGoalVer:
-  logger.info(f"PA and Goal match version {waaVer} - this is probably bad!")
-  findings['waaVers']={'description': 'Agent/Goal versions', 'status': f"Agent version and goal state match = {waaVer} - this is unlikely"}
-
-## turn service/bins checks into 'checks' and 'findings'
-### Binaries
-#### string for the console report
-binReportString=""
-for binName in bins:
-  checks[bins[binName]['exe']] = {'check': bins[binName]['exe'],
-                                  'description': f"Binary check of {bins[binName]['exe']}",
-                                  'value': f"Package:{bins[binName]['pkg']}, source:{bins[binName]['repo']}"
-                                  }
-  # check for alarms in the binaries and create findings as needed
-  # - is the path include questionable areas - local, home, opt - these aren't "normal"
-  if ( re.search("local", bins[binName]['exe']) or 
-       re.search("opt", bins[binName]['exe']) or
-       re.search("home", bins[binName]['exe'])):
-    # this is bad, create a findings from this check
-    findings[f"bp:{bins[binName]['exe']}"]={
-      'description': f"binpath:{bins[binName]['exe']}",
-      'status': "Path includes questionable directories",
-      'type': "bin"
-    }
-    logger.warning(f"Checking path: {bins[binName]['exe']} found in a non-standard location")
-    binReportString+=f"{cYellow(bins[binName]['exe'])} => check location\n"
-  # - is the repository uncommon
-  repoBad=False
-  if osrID == "debian":
-    # check if the repository is expected, this should usually say "Origin: Ubuntu"
-    # We are blissfully ignoring *actual* Debian - which itself would be a cause for concern
-    if ( not re.search(r"Origin: Ubuntu", bins[binName]['repo'])):
-      repoBad=True
-  elif ( osrID == "fedora" or osrID == "azurelinux" ) : 
-    # Check if the 'repo' field includes the error indicator 'fail', or check if the repository name 
-    #   is either @System or anaconda (initial install for RHEL or AL), or includes 'rhui' or 'azurelinux',
-    #   or appstream - which is ok-ish
-    if ( re.search("fail", bins[binName]['repo']) 
-         or not (re.search(r"@System", bins[binName]['repo']) or
-                 re.search("anaconda", bins[binName]['repo']) or
-                 re.search("rhui", bins[binName]['repo']) or
-                 re.search("AppStream", bins[binName]['repo']) or
-                 re.search("azurelinux", bins[binName]['repo'])
-             )):
-      repoBad=True
-  elif osrID == "suse":
-    # check if the repository includes 'SLE-Module' or 'SUSE'
-    if ( not re.search(r"SLE-Module", bins[binName]['repo'])):
-      repoBad=True
-  # all distro-specific checks finished, report if needed
-  if ( repoBad ):
-    findings[f"bs:{bins[binName]['exe']}"]={
-      'description': f"binsource:{bins[binName]['exe']}",
-      'status': f"Binary came from unusual source: {bins[binName]['repo']}",
-      'type': "bin"
-    }
-    logger.warning(f"Checking {bins[binName]['exe']} found to be sourced from the repo {bins[binName]['repo']}")
-    binReportString+=f"{bins[binName]['exe']} => {cRed(bins[binName]['repo'])} - verify repository\n"
-if (len(binReportString) == 0 ):
-  binReportString=cGreen("-- No issues with checked binaries")
-  logger.info("No concerns found with binary checks")
-### Services/Units
-svcReportString=""
-for svcName in services:
-  if ( not re.search("running", services[svcName]['status']) ):
-    findings[f"ss:{services[svcName]['svc']}"]={
-      'description': f"service:{services[svcName]['svc']}",
-      'status': f"Service not in 'running' state: {services[svcName]['status']}",
-      'type': "svc"
-    }
-    logger.warning(f"Checking {services[svcName]['svc']} found in state {services[svcName]['status']}")
-    svcReportString+=f"{services[svcName]['svc']} => {cRed(services[svcName]['status'])} - check logs\n"
-  if ( not re.search("enabled", services[svcName]['config']) ):
-    findings[f"sc:{services[svcName]['svc']}"]={
-      'description': f"service:{services[svcName]['svc']}",
-      'status': f"Service not enabled: {services[svcName]['config']}",
-      'type': "svc"
+  # We'll use the 'bash' arguments from the bash wrapper to seed this script
+  facts.clear()
+  facts['waaServiceIn']=bashArgs.get('SERVICE', "waagent.service") # this may differ per-distro, but offer a default
+  facts['pythonIn']=bashArgs.get('PY', "/usr/bin/python3")
+  facts['waaBin']=shutil.which("waagent") or ""
+  if facts['waaBin']:
+    logger.info(f"using waagent location {facts['waaBin']}")
+  else:
+    logger.error("waagent not found in PATH, skipping the agent version and config checks")
+
+  # Check SSHD, Debian based distros started naming it ssh and launching on connect, sometime before Ubuntu 24.04
+  # TODO: make this version dependent - ubuntu 24.04+ uses JIT activation of sshd
+  if ( osrID == "debian" ):
+    facts['sshService']="ssh.service"
+    chronyService="chrony.service"
+  else:
+    facts['sshService']="sshd.service"
+    chronyService="chronyd.service"
+  # Other units worth a look when they are installed, no package lookups are done for these
+  facts['extraServices']=["cloud-init.service", chronyService, "NetworkManager.service"]
+
+def checkOS():
+  # TODO: Add a family / major version check for 'supported' and "doesn't work" checks
+  # TODO: perhaps add a best-effort flag, wrap things that might not work in 'best effort' mode
+  # -- weird versions - OEL, Alma, Rocky
+  osOld = False
+  osFamOK = True
+  if ( osrID == "fedora" ):
+    if ( osMaj < 8 ):
+      osOld = True
+  elif ( osrID == "suse" ):
+    if ( osMaj < 15 ):
+      osOld = True
+  elif ( osrID == "debian" ):
+    if ( osMaj < 20 ):
+      osOld = True
+  elif ( osrID == "azurelinux" ):
+    if ( osMaj < 3 ):
+      osOld = True
+  else:
+    osFamOK = False
+
+  if ( osOld ):
+      logger.warning(f"OS family detected as {osrID} with major version of {osMaj} - this OS is too old too be reliably tested")
+      findings['osSup']={'description': 'OS is Old', 'status': f"OS Family:{osrID} with Major Release:{osMaj} is too old to be reliably tested"}
+  if ( not osFamOK):
+      logger.warning(f"Unsupported OS family detected:{osrID}")
+      findings['osSup']={'description': 'OS family is minimally or completely untested', 'status': f"OS Family:{osrID}"}
+
+def checkProxy():
+  # look through the os.environ object for any mention of a variable with 'proxy' in the name
+  osEnv=dict(os.environ)
+  proxyVars = {key: osEnv[key] for key in osEnv if "proxy" in key.lower()}
+  # create a check and if needed a finding
+  if proxyVars:
+    logger.info(f"proxy definition found in env: {proxyVars}")
+    findings['proxy']={'description': 'ProxyCheck', 'status': f"Found proxy environment vars:\n{proxyVars}"}
+    checks['proxy']={"check":"proxy", "value":proxyVars}
+  else:
+    logger.info(f"No proxies found in env")
+    checks['proxy']={"check":"proxy", "value":"None Found"}
+
+def checkPackages():
+  global diskCache
+  waaServiceIn=facts['waaServiceIn']
+  sshService=facts['sshService']
+  # start from fresh unit states and re-check the package cache, a long running caller may have been sitting
+  #   here since the last run
+  unitCache.clear()
+  pkgCache.clear()
+  diskCache=None
+  # Get the state of every unit we're going to check from systemd in one call
+  fetchUnits([waaServiceIn, sshService] + facts['extraServices'])
+  # Ask the package database about every binary and unit file we are going to check in one go, instead
+  #   of spawning the package manager(s) again for each one
+  resolvePkgs([facts['pythonIn'], "/usr/bin/openssl", facts['waaBin']] + [unitCache[u].get("FragmentPath") for u in [waaServiceIn, sshService]])
+
+  # Check services and binaries
+  checkService(waaServiceIn, package=True)
+  checkService(sshService, package=True)
+  for extraService in facts['extraServices']:
+    if unitExists(extraService):
+      checkService(extraService)
+    else:
+      logger.info(f"{extraService} is not installed, skipping")
+
+  validateBin(facts['pythonIn'])
+  # PoC for right now to show what we can do, also because changing SSL can cause problems for extensions talking outside wire/IMDS
+  validateBin("/usr/bin/openssl")
+  if facts['waaBin']:
+    validateBin(facts['waaBin']) # just to create another easy-to-check test
+  else:
+    # nothing to validate, report the agent binary as not found instead of leaving it out of the report
+    bins["waagent"]={"exe": "waagent", "pkg": "not found in PATH", "repo": "n/a", "missing": True}
+
+def checkWaaVersion():
+  # Lets pull the version out of the 'normal' --version output string, for manual comparisons
+  waaVerRC, waaVerOut, waaVerErr = runCmd(waaCmd("--version"))
+  waaVerOut=waaVerOut.strip().lower().split('\n')
+  # if the output changes format we'll have to recode this block
+  # expected output:
+  #['walinuxagent-2.7.0.6 running on redhat 8.10',
+  # 'python: 3.6.8',
+  # 'goal state agent: 2.7.0.6']
+  waaVer = "0.0.0.0"
+  waaGoalVer = "0.0.0.0"
+  for line in waaVerOut:
+    # process the version out of string #1 or #3 above - with an optional 4th v.v.v.v section since some versions only have 3
+    verSearch = versionRegex.search(line)
+    if ( verSearch ):
+      if "walinuxagent" in line:
+        waaVer = verSearch.group(0)
+      elif "goal" in line:
+        waaGoalVer = verSearch.group(0)
+  facts['waaVer']=waaVer
+  facts['waaGoalVer']=waaGoalVer
+  # log the check
+  checks["waaVersion"]={
+      'description': 'Agent component versions',
+      'check': 'waaVersion',
+      'value': f"WAA:{waaVer}, Goal:{waaGoalVer}",
+      'type': 'config'
+      }
+  logger.info(f"Found agent:{waaVer} and extension handler: {waaGoalVer}")
+  # if the versions match, it's a 'finding' - these will only match if autoUpg is false or the package is VERY new so likely from source
+  if waaVerRC is None:
+    logger.warning(f"Unable to get the agent versions: {waaVerErr}")
+  elif waaVer == waaGoalVer:
+    logger.info(f"PA and Goal match version {waaVer} - this is probably bad!")
+    findings['waaVers']={'description': 'Agent/Goal versions', 'status': f"Agent version and goal state match = {waaVer} - this is unlikely"}
+
+def checkBinSvcFindings():
+  ## turn service/bins checks into 'checks' and 'findings'
+  ### Binaries
+  #### string for the console report
+  binReportString=""
+  for binName in bins:
+    checks[bins[binName]['exe']] = {'check': bins[binName]['exe'],
+                                    'description': f"Binary check of {bins[binName]['exe']}",
+                                    'value': f"Package:{bins[binName]['pkg']}, source:{bins[binName]['repo']}"
+                                    }
+    # - is it there at all, a missing binary has no path or repo to check
+    if ( bins[binName].get('missing') ):
+      findings[f"bm:{bins[binName]['exe']}"]={
+        'description': f"binmissing:{bins[binName]['exe']}",
+        'status': "Binary not found in PATH",
+        'type': "bin"
+      }
+      logger.warning(f"Checking {bins[binName]['exe']}: not found in PATH")
+      binReportString+=f"{cRed(bins[binName]['exe'])} => not found in PATH\n"
+      continue
+    # check for alarms in the binaries and create findings as needed
+    # - is the path include questionable areas - local, home, opt - these aren't "normal"
+    if ( badPathRegex.search(bins[binName]['exe']) ):
+      # this is bad, create a findings from this check
+      findings[f"bp:{bins[binName]['exe']}"]={
+        'description': f"binpath:{bins[binName]['exe']}",
+        'status': "Path includes questionable directories",
+        'type': "bin"
+      }
+      logger.warning(f"Checking path: {bins[binName]['exe']} found in a non-standard location")
+      binReportString+=f"{cYellow(bins[binName]['exe'])} => check location\n"
+    # - is the repository uncommon
+    #   debian should usually say "Origin: Ubuntu" - we are blissfully ignoring *actual* Debian, which itself
+    #   would be a cause for concern.  For fedora/azurelinux the error indicator 'fail' is also bad
+    repoBad=False
+    if osrID in goodRepoRegex:
+      if ( not goodRepoRegex[osrID].search(bins[binName]['repo']) ):
+        repoBad=True
+      elif ( osrID in ("fedora", "azurelinux") and failRepoRegex.search(bins[binName]['repo']) ):
+        repoBad=True
+    # all distro-specific checks finished, report if needed
+    if ( repoBad ):
+      findings[f"bs:{bins[binName]['exe']}"]={
+        'description': f"binsource:{bins[binName]['exe']}",
+        'status': f"Binary came from unusual source: {bins[binName]['repo']}",
+        'type': "bin"
+      }
+      logger.warning(f"Checking {bins[binName]['exe']} found to be sourced from the repo {bins[binName]['repo']}")
+      binReportString+=f"{bins[binName]['exe']} => {cRed(bins[binName]['repo'])} - verify repository\n"
+  if (len(binReportString) == 0 ):
+    binReportString=cGreen("-- No issues with checked binaries")
+    logger.info("No concerns found with binary checks")
+  facts['binReportString']=binReportString
+  ### Services/Units
+  svcReportString=""
+  for svcName in services:
+    # oneshot units are done once they get to active(exited)
+    svcDone=( services[svcName].get('type') == "oneshot" and "active(exited)" in services[svcName]['status'] )
+    if ( "running" not in services[svcName]['status'] and not svcDone ):
+      findings[f"ss:{services[svcName]['svc']}"]={
+        'description': f"service:{services[svcName]['svc']}",
+        'status': f"Service not in 'running' state: {services[svcName]['status']}",
+        'type': "svc"
+      }
+      logger.warning(f"Checking {services[svcName]['svc']} found in state {services[svcName]['status']}")
+      svcReportString+=f"{services[svcName]['svc']} => {cRed(services[svcName]['status'])} - check logs\n"
+    if ( "enabled" not in services[svcName]['config'] ):
+      findings[f"sc:{services[svcName]['svc']}"]={
+        'description': f"service:{services[svcName]['svc']}",
+        'status': f"Service not enabled: {services[svcName]['config']}",
+        'type': "svc"
+      }
+      logger.warning(f"Checking {services[svcName]['svc']} not enabled: {services[svcName]['config']}")
+      svcReportString+=f"{services[svcName]['svc']} => {cRed(services[svcName]['config'])} - check config\n"
+  if (len(svcReportString) == 0 ):
+    svcReportString=cGreen("-- No issues with checked services")
+    logger.info("No concerns found with service checks")
+  facts['svcReportString']=svcReportString
+
+  ## Early version report code
+    # print(f"Analysis of unit : {services[svcName]['svc']}:")
+    # print(f"  Owning pkg     : {services[svcName]['pkg']}" )
+    # print(f"  Repo for pkg   : {services[svcName]['repo']}" )
+    # print( "  run state      : "+colorString(services[svcName]['status'], redVal="dead", greenVal="active"))
+    # print( "  config state   : "+colorString(services[svcName]['config'], redVal="disabled", greenVal="enabled"))
+
+def checkConnectivity():
+  # Connectivity checks
+  ## Probe the wire server, its extension port and IMDS all at once
+  connProbes=probeEndpoints([
+    {'name': 'wire', 'func': wireVersions, 'args': (), 'timeout': 5, 'timeoutValue': "Timeout"},
+    {'name': 'wireExt', 'func': isOpen, 'args': (wireIP, 32526), 'timeout': 2, 'timeoutValue': False},
+    {'name': 'imds', 'func': checkHTTPURL, 'args': (f"http://{imdsIP}/metadata/instance?api-version=2021-02-01",), 'timeout': 5, 'timeoutValue': "Timeout"}
+  ])
+  ## Wire server
+  wireCheck=connProbes['wire']['value']
+  checks['wire']={"check":"wire 80", "value":wireCheck, "elapsed":connProbes['wire']['elapsed']}
+  if wireCheck != 200:
+    findings['wire80']={
+      'description': 'WireServer:80',
+      'status': wireCheck,
+      'type': "conn"
     }
-    logger.warning(f"Checking {services[svcName]['svc']} not enabled: {services[svcName]['config']}")
-    svcReportString+=f"{services[svcName]['svc']} => {cRed(services[svcName]['config'])} - check config\n"
-if (len(svcReportString) == 0 ):
-  svcReportString=cGreen("-- No issues with checked services")
-  logger.info("No concerns found with service checks")
-
-## Early version report code
-  # print(f"Analysis of unit : {services[svcName]['svc']}:")
-  # print(f"  Owning pkg     : {services[svcName]['pkg']}" )
-  # print(f"  Repo for pkg   : {services[svcName]['repo']}" )
-  # print( "  run state      : "+colorString(services[svcName]['status'], redVal="dead", greenVal="active"))
-  # print( "  config state   : "+colorString(services[svcName]['config'], redVal="disabled", greenVal="enabled"))
-
-# Connectivity checks
-## Wire server
-wireCheck=checkHTTPURL(f"http://{wireIP}/?comp=versions")
-thisCheck={"check":"wire 80", "value":wireCheck}
-checks['wire']=thisCheck
-if wireCheck != 200:
-  findings['wire80']={
-    'description': 'WireServer:80',
-    'status': wireCheck,
-    'type': "conn"
-  }
-  logger.warning(f"Wire server port 80 check returned {wireCheck} - check connectivity")
-else:
-  logger.info(f"Wire server port 80 check returned OK({wireCheck})")
-# temp variable clean up, this shouldn't remove the item  in the 'checks' dict, just the temp object
-del(thisCheck)
-## Wire server "extension" port
-wireExt=isOpen(wireIP,32526)
-thisCheck={"check":"wire 23526", "value":wireExt}
-checks['wireExt']=thisCheck
-if not wireExt :
-  findings['wire23526']={
-    'description': 'WireServer:32526',
-    'status': wireExt,
-    'type': "conn"
-  }
-  logger.warning(f"Wire server extension port (32526) test returned {wireExt} - check connectivity")
-else:
-  logger.info(f"Wire server extension port (32526) returned OK({wireExt})")
-# temp variable clean up, this shouldn't remove the item  in the 'checks' dict, just the temp object
-del(thisCheck)
-
-## IMDS
-imdsCheck=checkHTTPURL(f"http://{imdsIP}/metadata/instance?api-version=2021-02-01")
-thisCheck={"check":"imds 443", "value":imdsCheck}
-checks['imds']=thisCheck
-if imdsCheck != 200:
-  findings['imds']={
-    'description': 'IMDS',
-    'status': imdsCheck,
-    'type': "conn"
-  }
-  logger.warning(f"IMDS port 80 check returned {imdsCheck} - check connectivity")
-else:
-  logger.info(f"IMDS port 80 check returned OK({imdsCheck})")
-# temp variable clean up, this shouldn't remove the item  in the 'checks' dict, just the temp object
-del(thisCheck)
-
-# Secondary test for ext. handler version/auto upgrade
-# if the wire port state is 200(OK), query the wireserver for the latest goalstate (ext. handler) and check against the current goal state 
-if wireCheck == 200:
-  try:
-    # We only use these modules in here - so far
-    import xml.etree.ElementTree as ET
-    from urllib.parse import urlparse
-    # get the best API version *from the wire server
-    endpoint="/?comp=versions"
-    conn = http.client.HTTPConnection(wireIP)
-    headers = {
-      "Accept": "application/xml",  # Requesting XML response
-      "User-Agent": "VM assist"  # Optional, helps identify the client
+    logger.warning(f"Wire server port 80 check returned {wireCheck} - check connectivity")
+  else:
+    logger.info(f"Wire server port 80 check returned OK({wireCheck})")
+  ## Wire server "extension" port
+  wireExt=connProbes['wireExt']['value']
+  checks['wireExt']={"check":"wire 23526", "value":wireExt, "elapsed":connProbes['wireExt']['elapsed']}
+  if not wireExt :
+    findings['wire23526']={
+      'description': 'WireServer:32526',
+      'status': wireExt,
+      'type': "conn"
     }
-    conn.request("GET", endpoint, headers=headers)
-    response = conn.getresponse()
-    xmlResp=response.read()
-    apiVers=ET.fromstring(xmlResp).find("./Preferred/Version").text
-    
-    # Find the URLs for the different bits of the goal state
-    endpoint="/machine/?comp=goalstate"
-    headers = {
-      "x-ms-version": apiVers,
-      "Accept": "application/xml",  # Requesting XML response
-      "User-Agent": "PythonTestHarness"  # Optional, helps identify the client
+    logger.warning(f"Wire server extension port (32526) test returned {wireExt} - check connectivity")
+  else:
+    logger.info(f"Wire server extension port (32526) returned OK({wireExt})")
+
+  ## IMDS
+  imdsCheck=connProbes['imds']['value']
+  checks['imds']={"check":"imds 443", "value":imdsCheck, "elapsed":connProbes['imds']['elapsed']}
+  if imdsCheck != 200:
+    findings['imds']={
+      'description': 'IMDS',
+      'status': imdsCheck,
+      'type': "conn"
     }
-    conn.request("GET", endpoint, headers=headers)
-    response = conn.getresponse()
-    xmlResp=response.read().decode()
-    extConfURL=ET.fromstring(xmlResp).find("./Container/RoleInstanceList/RoleInstance/Configuration/ExtensionsConfig").text
-    
-    parsedURL=urlparse(extConfURL)
-    endpoint = parsedURL.path + "?" + parsedURL.query
-    conn.request("GET", endpoint, headers=headers)
-    response = conn.getresponse()
-    xmlResp=response.read().decode()
-    wireGSVersion=ET.fromstring(xmlResp).find("./GuestAgentExtension/GAFamilies/GAFamily/Version").text
-    
-    if wireGSVersion != waaGoalVer:
-      findings['waaUpgStat']={'status': f"not up to date - Local:{waaGoalVer} Wire:{wireGSVersion}", 'description':"GoalState version mismatch to wireserver"}
-  except:
-    findings['waaUpgStat']={'status': "failed during testing", 'description':f"GoalState version on VM ({waaGoalVer}) does not match wire server({wireGSVersion})"}
-  finally:
-    checks['waaUpgStat']={"check":"GoalVersion", "description":"Checking Goal State version against wire server", "value":wireGSVersion}
-else:
-  # flag that we skipped wireserver capability checks due to failing connectivity checks
-  findings['waaUpgStat']={'status': "skipped", 'description':"Did not check GoalState version on wire server"}
-  
-  
-# OS/config checks
-## Agent config
-waaConfigOut=subprocess.check_output(f"{waaBin} --show-configuration", shell=True, stderr=subprocess.DEVNULL).decode().strip().split('\n')
-waaConfig={}
-# put all output from the config command into a KVP
-for line in waaConfigOut:
-  key, value = line.split('=', 1)
-  waaConfig[key.strip()] = value.strip()
-checks['waaExt']={"check":"WAA Extension", "value":waaConfig['Extensions.Enabled']}
-if ( checks['waaExt']['value'] != 'True' ):
-  findings['waaExt']={'status': checks['waaExt']['value'], 'description':"Extensions are disabled in WAA config"}
-  logger.warning(f"Extensions potentially disabled: {checks['waaExt']['value']}")
-else:
-  logger.info(f"Extensions enabled in waagent config {checks['waaExt']['value']}")
-checks['waaUpg']={"check":"WAA AutoUpgrade", "value":waaConfig['AutoUpdate.Enabled']}
-if ( checks['waaUpg']['value'] != 'True' ):
-  findings['waaUpg']={'status': checks['waaUpg']['value'], 'description':"Agent extension handler auto-upgrade is disabled in WAA config"}
-  logger.warning(f"Agent(ext handler) auto-update possibly disabled: {checks['waaUpg']['value']}")
-else:
-  logger.info(f"Agent(ext handler) auto-update enabled in waagent config {checks['waaUpg']['value']}")
-
-# Checks against disks and objects
-## results of disk space checks
-### seed checks with a 'no problems' message, we'll reset it when we find one
-checks['fullFS']={"check":"fullFS", "description": f"filesystem util over {fullPercent}%", "none":f"No filesystems over {fullPercent}% util"}
-diskFind=""
-## find the device 'id' for checking if the extension directory is 'noexec'
-vlwaDev=os.stat("/var/lib/waagent").st_dev
-
-mounts=[]
-
-# only check these filesystem types ext4,xfs,vfat,btrfs,ext3
-findmnt=subprocess.check_output("findmnt --evaluate -nb -o TARGET,SOURCE,FSTYPE,OPTIONS,USE% --pairs -t=ext2,ext3,ext4,btrfs,xfs,vfat", shell=True, stderr=subprocess.DEVNULL).decode().strip().split("\n")
-
-for fm in findmnt:
-  pairs = fm.split()
-  dictTemp={}
-  for pair in pairs:
-    key, value = pair.split('=',1)
-    dictTemp[key] = value.strip('"%')
-  mounts.append(dictTemp)
-
-# this was initially done in psutils:
-#  mounts = psutil.disk_partitions()
-#  but was found that certain distros do not include psutils in their marketplace images, so re-wrote with generic python code
-for m in mounts:
-  logger.info(f"Checking {m['SOURCE']} mounted at {m['TARGET']}")
-  # the following hack brought to you by SLES, where USE% is instead USE_PCT
-  pcent=0
-  if ( 'USE%' in m ):
-    pcent = m['USE%']
-  elif ( 'USE_PCT' in m ):
-    pcent = m['USE_PCT']
-
-  if int(pcent) >= fullPercent:
-    logger.warning(f"Filesystem utilization for {m['TARGET']} is over {fullPercent}: {pcent}")
-    # delete the 'default empty set' wording in 'checks' for fullFS, because we found a disk over the util threshold
-    if 'none' in checks["fullFS"]:
-      checks['fullFS']={'check': 'fullFS', 'description':f'Look for filesystems utilized more than {fullPercent}','value':'see findings for details'}
-      findings['fullFS']={}
-    # Add each full filesystem to the list
-    if 'status' in findings['fullFS']:
-      findings['fullFS']['status'] = f"{findings['fullFS']['status']}, {m['TARGET']}:{pcent}"
-    else:
-      findings['fullFS']={'description': f"Filesystems over{fullPercent}",
-                           'status': f"{m['TARGET']}:{pcent}",
-                           'type':'os'
-      }
-  # check if this mount (m) is the one holding /var/lib/waagent, if so we will  want to check to see if the mount options include 'noexec'
-  if ( os.stat(m['TARGET']).st_dev == vlwaDev ):
+    logger.warning(f"IMDS port 80 check returned {imdsCheck} - check connectivity")
+  else:
+    logger.info(f"IMDS port 80 check returned OK({imdsCheck})")
+
+def checkGoalState():
+  # Secondary test for ext. handler version/auto upgrade
+  # if the wire port state is 200(OK), query the wireserver for the latest goalstate (ext. handler) and check against the current goal state
+  #   the versions request was already made by the connectivity probe, and ExtensionsConfig is only downloaded when
+  #   the goal state incarnation changed since the version in it was saved
+  waaGoalVer=facts['waaGoalVer']
+  # stays unknown if any of the wire server calls below fail
+  wireGSVersion="unknown"
+  fromCache=False
+  if checks['wire']['value'] == 200:
+    state=loadWireState()
+    headers={"x-ms-version": state.get('apiVersion', wireDefaultVersion)}
+    step="goalstate"
+    try:
+      # Find the URLs for the different bits of the goal state
+      extConfPath="Container/RoleInstanceList/RoleInstance/Configuration/ExtensionsConfig"
+      goalState=wireFind(wireRequest("goalstate", "/machine/?comp=goalstate", headers), ["Incarnation", extConfPath])
+      incarnation=goalState["Incarnation"]
+      extConfURL=goalState[extConfPath]
+      if not extConfURL:
+        raise ValueError("no ExtensionsConfig URL in the goal state")
+      if ( incarnation and incarnation == state.get('incarnation') and extConfURL == state.get('extConfURL') and state.get('gaVersion') ):
+        wireGSVersion=state['gaVersion']
+        fromCache=True
+        logger.info(f"Goal state incarnation {incarnation} unchanged, using the saved wire server version {wireGSVersion}")
+      else:
+        step="ExtensionsConfig"
+        parsedURL=urlparse(extConfURL)
+        endpoint = parsedURL.path + "?" + parsedURL.query
+        gaVersionPath="GuestAgentExtension/GAFamilies/GAFamily/Version"
+        gaVersion=wireFind(wireRequest("ExtensionsConfig", endpoint, headers), [gaVersionPath])[gaVersionPath]
+        if not gaVersion:
+          raise ValueError("no GAFamily version in ExtensionsConfig")
+        wireGSVersion=gaVersion
+        state.update({'incarnation': incarnation, 'extConfURL': extConfURL, 'gaVersion': wireGSVersion})
+        saveWireState()
+
+      if wireGSVersion != waaGoalVer:
+        findings['waaUpgStat']={'status': f"not up to date - Local:{waaGoalVer} Wire:{wireGSVersion}", 'description':"GoalState version mismatch to wireserver"}
+    except Exception as e:
+      logger.warning(f"Unable to get the wire server {step}: {e}")
+      findings['waaUpgStat']={'status': f"failed getting {step}: {e}", 'description':"Could not get the GoalState version from the wire server"}
+    finally:
+      checks['waaUpgStat']={"check":"GoalVersion", "description":"Checking Goal State version against wire server", "value":wireGSVersion,
+                            "cached":fromCache, "requests":dict(wireLatency)}
+  else:
+    # flag that we skipped wireserver capability checks due to failing connectivity checks
+    findings['waaUpgStat']={'status': "skipped", 'description':"Did not check GoalState version on wire server"}
+  facts['wireGSVersion']=wireGSVersion
+
+def checkWaaConfig():
+  # OS/config checks
+  ## Agent config
+  waaConfigRC, waaConfigOut, waaConfigErr = runCmd(waaCmd("--show-configuration"))
+  if waaConfigRC is None:
+    logger.warning(f"Unable to get the agent configuration: {waaConfigErr}")
+    checks['waaExt']={"check":"WAA Extension", "value":"unknown"}
+    checks['waaUpg']={"check":"WAA AutoUpgrade", "value":"unknown"}
+    return
+  waaConfig={}
+  # put all output from the config command into a KVP
+  for line in waaConfigOut.strip().split('\n'):
+    if "=" in line:
+      key, value = line.split('=', 1)
+      waaConfig[key.strip()] = value.strip()
+  checks['waaExt']={"check":"WAA Extension", "value":waaConfig.get('Extensions.Enabled', "unknown")}
+  if ( checks['waaExt']['value'] != 'True' ):
+    findings['waaExt']={'status': checks['waaExt']['value'], 'description':"Extensions are disabled in WAA config"}
+    logger.warning(f"Extensions potentially disabled: {checks['waaExt']['value']}")
+  else:
+    logger.info(f"Extensions enabled in waagent config {checks['waaExt']['value']}")
+  checks['waaUpg']={"check":"WAA AutoUpgrade", "value":waaConfig.get('AutoUpdate.Enabled', "unknown")}
+  if ( checks['waaUpg']['value'] != 'True' ):
+    findings['waaUpg']={'status': checks['waaUpg']['value'], 'description':"Agent extension handler auto-upgrade is disabled in WAA config"}
+    logger.warning(f"Agent(ext handler) auto-update possibly disabled: {checks['waaUpg']['value']}")
+  else:
+    logger.info(f"Agent(ext handler) auto-update enabled in waagent config {checks['waaUpg']['value']}")
+
+def checkDisk():
+  # Checks against disks and objects
+  ## results of disk space checks
+  ### seed checks with a 'no problems' message, we'll reset it when we find one
+  checks['fullFS']={"check":"fullFS", "description": f"filesystem util over {fullPercent}%", "none":f"No filesystems over {fullPercent}% util"}
+  ## find the device 'id' for checking if the extension directory is 'noexec'
+  vlwaPath=os.path.realpath("/var/lib/waagent")
+  vlwaDev=os.stat(vlwaPath).st_dev
+
+  # only check these filesystem types ext4,xfs,vfat,btrfs,ext3
+  with timed("/proc/self/mountinfo", "native"):
+    mounts=readMounts(diskFsTypes)
+  # the mount holding /var/lib/waagent is the deepest mount point above it on the same device, bind mounts of
+  #   that filesystem elsewhere don't matter
+  vlwaMount=None
+  for m in mounts:
+    if ( m['DEV'] == vlwaDev and (vlwaPath + "/").startswith(m['TARGET'].rstrip("/") + "/") ):
+      if ( vlwaMount is None or len(m['TARGET']) > len(vlwaMount['TARGET']) ):
+        vlwaMount=m
+
+  # this was initially done in psutils:
+  #  mounts = psutil.disk_partitions()
+  #  but was found that certain distros do not include psutils in their marketplace images, so re-wrote with generic python code
+  for m in mounts:
+    logger.info(f"Checking {m['SOURCE']} mounted at {m['TARGET']}")
+    pcent=m['USE%']
+    if pcent >= fullPercent:
+      logger.warning(f"Filesystem utilization for {m['TARGET']} is over {fullPercent}: {pcent}")
+      # delete the 'default empty set' wording in 'checks' for fullFS, because we found a disk over the util threshold
+      if 'none' in checks["fullFS"]:
+        checks['fullFS']={'check': 'fullFS', 'description':f'Look for filesystems utilized more than {fullPercent}','value':'see findings for details'}
+        findings['fullFS']={}
+      # Add each full filesystem to the list
+      if 'status' in findings['fullFS']:
+        findings['fullFS']['status'] = f"{findings['fullFS']['status']}, {m['TARGET']}:{pcent}"
+      else:
+        findings['fullFS']={'description': f"Filesystems over{fullPercent}",
+                             'status': f"{m['TARGET']}:{pcent}",
+                             'type':'os'
+        }
+  # check the mount holding /var/lib/waagent for the 'noexec' option
+  if ( vlwaMount ):
+    m=vlwaMount
     logger.info(f"Found /var/lib/waagent based in filesystem {m['TARGET']} on device {m['SOURCE']}, checking mount options")
     # create the 'checks' data describing this
     checks['noexec']={
@@ -776,7 +1641,7 @@ for m in mounts:
       'value': m['TARGET']
     }
     # add the 'findings' data if it's bad
-    if (re.search("noexec", m['OPTIONS'])):
+    if ( "noexec" in m['OPTIONS'].split(",") ):
       # Found noexec so flag it
       logger.error(f"mountpoint {m['TARGET']} mounted with 'noexec'")
       findings['noexec']={
@@ -784,165 +1649,409 @@ for m in mounts:
         'status':True
       }
 
-## Networking
-# Get a list of all the interfaces and addresses
-ints=(getInterfaces())
-# Since there's no reliable way to check whether eth0 is static or dhcp, look through the
-#   normal networking directories for the eth0 IP address. 
-#   If we've found any files holding the IP currently on eth0, that's a problem
-
-### Checks for defined MAC addresses or IPs - pertinent if someone hard coded configs
-# set dummy addresses for the search
-eth0MAC="de:ad:be:ef:4a:11"
-eth0IP="128.0.128.255"
-# If eth0 was found, store the MAC for checking for defined MAC addresses in files
-if ( 'eth0' in ints ):
-  eth0MAC = ints['eth0']['mac']
-  eth0IP = ints['eth0']['ip']
-  logger.info(f"Found {eth0MAC} on eth0, using this for config checks")
-else:
-  # if there is no eth0 defined, we're probably going to have some large issues with checks and possibly in 
-  #   the system state, so be sure to log it.  Also create a 'finding'
-  logger.error(f"Could not find a definition for eth0 - is networking sound?")
-  findings['noETH0']={
-    'description':"Could not locate an active eth0",
-    'status': f"eth0 - MAC:{eth0MAC}|IP{eth0IP}",
-    'type': 'os'
+def checkNetwork():
+  ## Networking
+  # Get a list of all the interfaces and addresses
+  ints=(getInterfaces())
+  # Since there's no reliable way to check whether eth0 is static or dhcp, look through the
+  #   normal networking directories for the eth0 IP address.
+  #   If we've found any files holding the IP currently on eth0, that's a problem
+
+  ### Checks for defined MAC addresses or IPs - pertinent if someone hard coded configs
+  # set dummy addresses for the search
+  eth0MAC="de:ad:be:ef:4a:11"
+  eth0IP="128.0.128.255"
+  # If eth0 was found, store the MAC for checking for defined MAC addresses in files
+  if ( ints is None ):
+    logger.warning("Interfaces unknown, checking config files without the eth0 addresses")
+  elif ( 'eth0' in ints ):
+    eth0MAC = ints['eth0']['mac']
+    eth0IP = ints['eth0'].get('ip', eth0IP)
+    logger.info(f"Found {eth0MAC} on eth0, using this for config checks")
+  else:
+    # if there is no eth0 defined, we're probably going to have some large issues with checks and possibly in
+    #   the system state, so be sure to log it.  Also create a 'finding'
+    logger.error(f"Could not find a definition for eth0 - is networking sound?")
+    findings['noETH0']={
+      'description':"Could not locate an active eth0",
+      'status': f"eth0 - MAC:{eth0MAC}|IP{eth0IP}",
+      'type': 'os'
+    }
+  # Define a MAC address regex pattern (e.g., 00:1A:2B:3C:4D:5E)
+  macPattern=re.compile(r'([0-9a-f]{2}(?::[0-9a-f]{2}){5})', re.IGNORECASE)
+  # we could check all of /etc, but that can be a lot and catch unrelated service configs (certain SSL configs
+  #   have "MAC looking strings"), so look in the usual network dirs, which should cover all common distros
+  #   - both the IP and the MACs are searched for in a single pass over these directories
+  configHits=scanConfigDirs(networkConfigDirs, {'ip': eth0IP, 'mac': macPattern})
+  filesWithIP={}
+  for foundFile in configHits['ip']:
+    # store the line number and line for every line holding the IP
+    filesWithIP[foundFile]="\n".join(f"{lineNo}: {line}" for lineNo, line, _ in configHits['ip'][foundFile])
+  if ( filesWithIP ):
+    checks['IPs']={"check":"Static IP addresses", "value":"IP found in files- see findings"}
+    fileString=""
+    for foundFile in filesWithIP:
+      # if the "second time through" add a ", " seperator
+      if (fileString):
+        fileString=f"{fileString}, "
+      fileString=f"{fileString}{foundFile}"
+    # create the 'findings' entry
+    findings['staticIP']={'description': 'eth0 IP found in files', 'status': fileString}
+    logger.warning(f"Found eth0 IP:{eth0IP} defined in a config file, could be static - check findings report")
+  else:
+    checks['IPs']={"check":"Static IP addresses", "value":"No IP addresses found in configs"}
+    logger.info(f"Did not find IP configured on eth0 listed in any config files")
+
+  filesWithMACs={}
+  for foundFile in configHits['mac']:
+    mac_addresses=[mac for _, _, lineMacs in configHits['mac'][foundFile] for mac in lineMacs]
+    # it would be ok for cloud-init managed configs to have the eth0 MAC defined - CI will reset the configs
+    #   if the mac changes - so only keep files which define some *other* MAC
+    if ( eth0MAC not in mac_addresses ):
+      filesWithMACs[foundFile]=mac_addresses
+  if ( filesWithMACs ):
+    checks['MACs']={"check":"MAC addresses", "value":"MACs found - see findings"}
+    fileString=""
+    for foundFile in filesWithMACs:
+      # if the "second time through" add a ", " seperator
+      if (fileString):
+        fileString=f"{fileString}, "
+      fileString=f"{fileString}{foundFile}=>{filesWithMACs[foundFile][0]}"
+    # create the 'findings' entry
+    findings['badMAC']={'description': 'MACs found', 'status': fileString}
+    logger.warning(f"Found eth0 MAC:{eth0MAC} defined in a config file - check findings report")
+  else:
+    checks['MACs']={"check":"MAC addresses", "value":"No MAC addresses found in configs"}
+    logger.info(f"Did not find MAC on eth0 listed in any config files")
+
+# All the checks in the order the CLI runs them.  'needs' are checks whose results (in 'facts' or the result
+#   dicts) this one reads, runChecks() runs those first if they haven't run yet.  'cmds' returns the external
+#   commands the check runs that can be started before any check has run
+checkList={
+  "os":             {"func": checkOS,             "needs": []},
+  "proxy":          {"func": checkProxy,          "needs": []},
+  "packages":       {"func": checkPackages,       "needs": []},
+  "waaVersion":     {"func": checkWaaVersion,     "needs": [], "cmds": lambda: [waaCmd("--version")]},
+  "binSvcFindings": {"func": checkBinSvcFindings, "needs": ["packages"]},
+  "connectivity":   {"func": checkConnectivity,   "needs": []},
+  "goalState":      {"func": checkGoalState,      "needs": ["waaVersion", "connectivity"]},
+  "waaConfig":      {"func": checkWaaConfig,      "needs": [], "cmds": lambda: [waaCmd("--show-configuration")]},
+  "disk":           {"func": checkDisk,           "needs": []},
+  "network":        {"func": checkNetwork,        "needs": []},
+}
+# which bins/services/checks/findings keys each check made on its last run
+checkOwners={}
+def runCheck(checkName):
+  # Run one check and return what it found:
+  #   {'name':, 'elapsed': secs, 'bins': {}, 'services': {}, 'checks': {}, 'findings': {}, 'removed': {dictName: [keys]}}
+  #   - the result dicts only hold the entries this check added or changed, 'removed' lists the entries from its
+  #     last run that it didn't make again (for example a finding that has been fixed)
+  resultDicts={"bins": bins, "services": services, "checks": checks, "findings": findings}
+  stageStart=time.monotonic()
+  lastKeys=checkOwners.get(checkName, {})
+  for dictName, keyList in lastKeys.items():
+    for key in keyList:
+      resultDicts[dictName].pop(key, None)
+  # round trip through json so entries that are changed in place still show up as changed
+  before={dictName: json.loads(json.dumps(dictIn, default=str)) for dictName, dictIn in resultDicts.items()}
+  del cmdTimedOut[:]
+  checkList[checkName]["func"]()
+  if cmdTimedOut:
+    findings[f"timeout:{checkName}"]={
+      'description': f"{checkName} check",
+      'status': f"timed out: {', '.join(dict.fromkeys(cmdTimedOut))}",
+      'type': "timeout"
+    }
+  result={"name": checkName, "elapsed": round(time.monotonic() - stageStart, 3), "removed": {}}
+  checkOwners[checkName]={}
+  for dictName, dictIn in resultDicts.items():
+    after=json.loads(json.dumps(dictIn, default=str))
+    result[dictName]={key: dictIn[key] for key in dictIn if before[dictName].get(key) != after[key]}
+    checkOwners[checkName][dictName]=list(result[dictName])
+    result["removed"][dictName]=[key for key in lastKeys.get(dictName, []) if key not in dictIn]
+  jsonStage(checkName, stageStart)
+  return result
+def runChecks(checkNames=None):
+  # run the named checks (all of them by default) plus anything they need that hasn't run yet, in checkList
+  #   order, returns {checkName: result} for every check that ran
+  global runDeadline
+  if checkNames is None:
+    checkNames=list(checkList)
+  wanted=set()
+  def addCheck(checkName):
+    if checkName not in checkList:
+      raise ValueError(f"Unknown check {checkName}, valid checks are: {', '.join(checkList)}")
+    wanted.add(checkName)
+    for need in checkList[checkName]["needs"]:
+      if need not in checkOwners:
+        addCheck(need)
+  for checkName in checkNames:
+    addCheck(checkName)
+  runDeadline=time.monotonic() + args.deadline if args.deadline else None
+  startCmds([cmdList for checkName in checkList if checkName in wanted for cmdList in checkList[checkName].get("cmds", list)()])
+  try:
+    return {checkName: runCheck(checkName) for checkName in checkList if checkName in wanted}
+  finally:
+    stopCmds()
+
+#### END check stages
+
+#### Reporting
+def printReport():
+  waaServiceIn=facts['waaServiceIn']
+  print(f"------ vmassist.py results -- v{vmaPyVersion}------")
+  print(f"Please see {cBlue('https://aka.ms/vmassistlinux')} for guidance on the information in the report output below")
+  print(f"OS family        : {osrID}")
+  # things we will always report on:
+  ## WAA service
+  ### => services[waaServiceIn]
+  #rint(f"OS family        : {osrID}")
+  print(f"Agent service    : {services[waaServiceIn]['svc']}")
+  print(f"=> status        : {colorString(services[waaServiceIn]['status'])}")
+  print(f"=> config state  : {colorString(services[waaServiceIn]['config'], redVal='disabled', greenVal='enabled')}")
+  print(f"=> source pkg    : {services[waaServiceIn]['pkg']}")
+  print(f"=> repository    : {services[waaServiceIn]['repo']}")
+  if facts['waaBin']:
+    print(f"Agent version from running {facts['waaBin']} --version")
+    print(f"=> Main version  : {facts['waaVer']}")
+    print(f"=> Goal state    : {colorString(facts['waaGoalVer'],redVal=facts['waaVer'],greenVal=facts['wireGSVersion'])}")
+  else:
+    print(f"Agent version    : {cRed('waagent not found in PATH')}")
+
+  #checkService(waaServiceIn, package=True)
+  # => {'walinuxagent.service': {'svc': 'walinuxagent.service', 'status': 'active(running)', 'config': 'enabled', 'path': '/usr/lib/systemd/system/walinuxagent.service', 'pkg': 'walinuxagent', 'repo': 'Origin: Ubuntu'}}
+  print(f"Wire Server")
+  print(f"  port 80        : {colorString(checks['wire']['value'], redVal='404', yellowVal='timeout', greenVal='200')}")
+  print(f"  port 32526     : {colorString(checks['wireExt']['value'], redVal='false', greenVal='true')}")
+  print(f"IMDS             : {colorString(checks['imds']['value'], redVal='404', yellowVal='timeout', greenVal='200')}")
+
+  # Always print out something about disk, use the default 'no problems' object, otherwise show what we found
+  if 'none' in checks["fullFS"]:
+    print(f"Disk util > {fullPercent}%  : {checks['fullFS']['none']}")
+  else:
+    print(f"Disk util > {fullPercent}%  : {findings['fullFS']['status']}")
+
+  # TODO: clean up and verify color on all core checks - wire server, waagent status
+  # TODO: optionally output all 'checks' objects
+  # Output the pre-determined binary findings
+  print("- Binary check results:")
+  print(facts['binReportString'])
+  print("- Service check results:")
+  print(facts['svcReportString'])
+  # TODO: parse findings list
+  print("- Findings from all checks:")
+  if ( findings ):
+    print(cYellow("-- All Findings (may duplicate Service and Binary checks) ---"))
+    for find in findings:
+      print(f"--- {findings[find]['description']} : {findings[find]['status']}")
+    print(cYellow("-- END Findings ---"))
+  else:
+    print(cGreen("-- No notable findings!"))
+
+  # TODO: add the core checks not covered in findings, bins, and services, to the logs
+  ### Log the raw data - don't send to the console
+  logger.info("--- verbose output of data structures ---")
+  logger.info("----- Binary check data structure:")
+  logger.info(str(bins))
+  logger.info("----- Service checks data structure:")
+  logger.info(str(services))
+  logger.info("----- All \"checks\" data structure:")
+  logger.info(str(checks))
+  logger.info("----- All \"findings\" data structure:")
+  logger.info(str(findings))
+  logger.info("--- END data structures ---")
+
+  # # DEBUG
+  # # semi-debug, looks good for now until we get the checks and findings presentation built up
+  if ( args.verbose > 0 ):
+    print("--- Verbose binary check output")
+    for binName in bins:
+      print(f"Analysis of      : {bins[binName]['exe']}:")
+      print(f"  Owning pkg     : {bins[binName]['pkg']}" )
+      print(f"  Repo for pkg   : {bins[binName]['repo']}" )
+    print("--- Verbose service check output")
+    for svcName in services:
+      print(f"Analysis of unit : {services[svcName]['svc']}:")
+      print(f"  Owning pkg     : {services[svcName]['pkg']}" )
+      print(f"  Repo for pkg   : {services[svcName]['repo']}" )
+      print( "  run state      : "+colorString(services[svcName]['status'], redVal="dead", greenVal="active"))
+      print( "  config state   : "+colorString(services[svcName]['config'], redVal="disabled", greenVal="enabled"))
+    print("--- END Verbose output")
+  # END DEBUG
+
+  print("------ END vmassist.py output ------")
+#### END Reporting
+
+#### Watch mode
+# Instead of running the whole bash+python pipeline from cron, stay resident and keep all the state in memory:
+#   - the cheap checks (wire server, IMDS, disk usage) run every interval
+#   - the expensive ones only run again when something they look at changed, see watchInputs()
+#   - interface and address changes are pushed by the kernel over rtnetlink, so the network check doesn't poll
+#   - only changes to the findings are reported
+watchEvery=["connectivity", "goalState", "disk"]
+# rtnetlink multicast groups, from linux/rtnetlink.h
+RTMGRP_LINK=0x1
+RTMGRP_IPV4_IFADDR=0x10
+def openNetlink():
+  try:
+    nlSock=socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+    nlSock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+    nlSock.setblocking(False)
+  except (OSError, AttributeError) as e:
+    logger.info(f"Unable to listen for interface changes on netlink, polling addresses instead: {e}")
+    return None
+  return nlSock
+def drainNetlink(nlSock):
+  # we only care that something changed, not what, so throw the messages away
+  try:
+    while nlSock.recv(65536):
+      pass
+  except (BlockingIOError, InterruptedError):
+    pass
+def watchInputs(pollInterfaces=False):
+  # Fingerprint of everything the expensive checks depend on, a check is re-run when its entry changes
+  unitList=[facts['waaServiceIn'], facts['sshService']] + facts['extraServices']
+  # one 'systemctl show' for state and unit file changes, a unit that dies or gets disabled shows up here too
+  unitState, _ = runQuery(["systemctl", "show", "-p", "LoadState,UnitFileState,ActiveState,SubState,FragmentPath"] + unitList)
+  unitPaths=[services[u]['path'] for u in services if services[u].get('path')]
+  inputs={
+    "packages": [pkgDbStamp(), unitState] + [fileStamp(p) for p in list(bins) + unitPaths],
+    # the agent drops each goal state agent it downloads in its own directory under /var/lib/waagent
+    "waaVersion": [fileStamp(facts['waaBin']), fileStamp("/var/lib/waagent")],
+    "waaConfig": [fileStamp(facts['waaBin']), fileStamp("/etc/waagent.conf")],
+    "network": configDirStamp(networkConfigDirs)
   }
-filesWithIP={}
-# we could check all of /etc, but that can be a lot and catch unrelated service configs, so look in the 
-#   usual network dirs
-searchDirForString("/etc/sysconfig", filesWithIP, eth0IP)
-searchDirForString("/etc/netplan", filesWithIP, eth0IP)
-if ( filesWithIP ):
-  checks['IPs']={"check":"Static IP addresses", "value":"IP found in files- see findings"}
-  fileString=""
-  for foundFile in filesWithIP: 
-    # if the "second time through" add a ", " seperator
-    if (fileString):
-      fileString=f"{fileString}, "
-    fileString=f"{fileString}{foundFile}"
-  # create the 'findings' entry
-  findings['staticIP']={'description': 'eth0 IP found in files', 'status': fileString}
-  logger.warning(f"Found eth0 IP:{eth0IP} defined in a config file, could be static - check findings report")
-else:
-  checks['IPs']={"check":"Static IP addresses", "value":"No IP addresses found in configs"}
-  logger.info(f"Did not find IP configured on eth0 listed in any config files")
-
-filesWithMACs={}
-# We can't search for /etc because certain SSL configs have "MAC looking strings", so check these two 
-#   directories, which should cover all common distros
-searchDirForMAC("/etc/sysconfig", filesWithMACs,eth0MAC)
-searchDirForMAC("/etc/netplan", filesWithMACs,eth0MAC)
-if ( filesWithMACs ):
-  checks['MACs']={"check":"MAC addresses", "value":"MACs found - see findings"}
-  fileString=""
-  for foundFile in filesWithMACs: 
-    # if the "second time through" add a ", " seperator
-    if (fileString):
-      fileString=f"{fileString}, "
-    fileString=f"{fileString}{foundFile}=>{filesWithMACs[foundFile][0]}"
-  # create the 'findings' entry
-  findings['badMAC']={'description': 'MACs found', 'status': fileString}
-  logger.warning(f"Found eth0 MAC:{eth0MAC} defined in a config file - check findings report")
-else:
-  checks['MACs']={"check":"MAC addresses", "value":"No MAC addresses found in configs"}
-  logger.info(f"Did not find MAC on eth0 listed in any config files")
-
-# END ALL CHECKS
-
-# START OUTPUT
-print(f"------ vmassist.py results -- v{vmaPyVersion}------")
-print(f"Please see {cBlue('https://aka.ms/vmassistlinux')} for guidance on the information in the report output below")
-print(f"OS family        : {osrID}")
-# things we will always report on:
-## WAA service
-### => services[waaServiceIn]
-#rint(f"OS family        : {osrID}")
-print(f"Agent service    : {services[waaServiceIn]['svc']}")
-print(f"=> status        : {colorString(services[waaServiceIn]['status'])}")
-print(f"=> config state  : {colorString(services[waaServiceIn]['config'], redVal='disabled', greenVal='enabled')}")
-print(f"=> source pkg    : {services[waaServiceIn]['pkg']}")
-print(f"=> repository    : {services[waaServiceIn]['repo']}")
-print(f"Agent version from running {waaBin} --version")
-print(f"=> Main version  : {waaVer}")
-print(f"=> Goal state    : {colorString(waaGoalVer,redVal=waaVer,greenVal=wireGSVersion)}")
-
-#checkService(waaServiceIn, package=True)
-# => {'walinuxagent.service': {'svc': 'walinuxagent.service', 'status': 'active(running)', 'config': 'enabled', 'path': '/usr/lib/systemd/system/walinuxagent.service', 'pkg': 'walinuxagent', 'repo': 'Origin: Ubuntu'}}
-print(f"Wire Server")
-print(f"  port 80        : {colorString(checks['wire']['value'], redVal='404', yellowVal='timeout', greenVal='200')}")
-print(f"  port 32526     : {colorString(checks['wireExt']['value'], redVal='false', greenVal='true')}")
-print(f"IMDS             : {colorString(checks['imds']['value'], redVal='404', yellowVal='timeout', greenVal='200')}")
-
-# Always print out something about disk, use the default 'no problems' object, otherwise show what we found
-if 'none' in checks["fullFS"]:
-  print(f"Disk util > {fullPercent}%  : {checks['fullFS']['none']}")
-else:
-  print(f"Disk util > {fullPercent}%  : {findings['fullFS']['status']}")
-
-# TODO: clean up and verify color on all core checks - wire server, waagent status
-# TODO: optionally output all 'checks' objects
-# Output the pre-determined binary findings
-print("- Binary check results:")
-print(binReportString)
-print("- Service check results:")
-print(svcReportString)
-# TODO: parse findings list
-print("- Findings from all checks:")
-if ( findings ):
-  print(cYellow("-- All Findings (may duplicate Service and Binary checks) ---"))
-  for find in findings:
-    print(f"--- {findings[find]['description']} : {findings[find]['status']}")
-  print(cYellow("-- END Findings ---"))
-else:
-  print(cGreen("-- No notable findings!"))
-
-# TODO: add the core checks not covered in findings, bins, and services, to the logs
-### Log the raw data - don't send to the console
-logger.info("--- verbose output of data structures ---")
-logger.info("----- Binary check data structure:")
-logger.info(str(bins))
-logger.info("----- Service checks data structure:")
-logger.info(str(services))
-logger.info("----- All \"checks\" data structure:")
-logger.info(str(checks))
-logger.info("----- All \"findings\" data structure:")
-logger.info(str(findings))
-logger.info("--- END data structures ---")
-
-# # DEBUG
-# # semi-debug, looks good for now until we get the checks and findings presentation built up
-if ( args.verbose > 0 ):
-  print("--- Verbose binary check output")
-  for binName in bins:
-    print(f"Analysis of      : {bins[binName]['exe']}:")
-    print(f"  Owning pkg     : {bins[binName]['pkg']}" )
-    print(f"  Repo for pkg   : {bins[binName]['repo']}" )
-  print("--- Verbose service check output")
-  for svcName in services:
-    print(f"Analysis of unit : {services[svcName]['svc']}:")
-    print(f"  Owning pkg     : {services[svcName]['pkg']}" )
-    print(f"  Repo for pkg   : {services[svcName]['repo']}" )
-    print( "  run state      : "+colorString(services[svcName]['status'], redVal="dead", greenVal="active"))
-    print( "  config state   : "+colorString(services[svcName]['config'], redVal="disabled", greenVal="enabled"))
-  print("--- END Verbose output")
-# END DEBUG
-
-print("------ END vmassist.py output ------")
-logger.info("Python ended")
-#if ( args.debug ):
-# print("------------ DATA STRUCTURE DUMP ------------")
-# # For development testing, These are the last pprint calls
-# from pprint import pprint
-# print("bins")
-# pprint(bins)
-# print("services")
-# pprint(services)
-# print("findings")
-# pprint(findings)
-# print("checks")
-# pprint(checks)
-# print("args")
-# pprint(args)
-# print("---------- END DATA STRUCTURE DUMP ----------")
+  if ( pollInterfaces ):
+    inputs["network"].append(getInterfaces())
+  return inputs
+def reportFindingChanges(lastFindings):
+  # print and log what is new, cleared or different since lastFindings, returns the findings to compare against next time
+  current=json.loads(json.dumps(findings, default=str))
+  added={key: current[key] for key in current if key not in lastFindings}
+  cleared={key: lastFindings[key] for key in lastFindings if key not in current}
+  changed={key: current[key] for key in current if key in lastFindings and lastFindings[key] != current[key]}
+  stamp=time.strftime("%Y-%m-%d %H:%M:%S")
+  for key in added:
+    logger.warning(f"New finding {key}: {added[key]}")
+    print(f"{stamp} {cRed('+')} {added[key].get('description')} : {added[key].get('status')}", flush=True)
+  for key in changed:
+    logger.warning(f"Changed finding {key}: {changed[key]}")
+    print(f"{stamp} {cYellow('~')} {changed[key].get('description')} : {changed[key].get('status')}", flush=True)
+  for key in cleared:
+    logger.info(f"Cleared finding {key}: {cleared[key]}")
+    print(f"{stamp} {cGreen('-')} {cleared[key].get('description')} : cleared", flush=True)
+  if ( added or changed or cleared ):
+    jsonEmit("change", time=time.strftime("%Y-%m-%dT%H:%M:%S%z"), added=added, changed=changed, cleared=list(cleared))
+  return current
+def runWatched(checkNames):
+  # a failing check shouldn't take the watcher down, log it and try again next time
+  for checkName in checkNames:
+    try:
+      runChecks([checkName])
+    except Exception:
+      logger.exception(f"Check {checkName} failed in watch mode")
+def watch(interval):
+  global streamStages
+  streamStages=False
+  nlSock=openNetlink()
+  lastInputs=watchInputs(nlSock is None)
+  lastFindings=json.loads(json.dumps(findings, default=str))
+  logger.info(f"Watching, checking {', '.join(watchEvery)} every {interval}s")
+  print(f"Watching for changes every {interval}s, stop with Ctrl-C", flush=True)
+  nextCycle=time.monotonic() + interval
+  while True:
+    readable, _, _ = select.select([nlSock] if nlSock else [], [], [], max(0, nextCycle - time.monotonic()))
+    # keep the timing data from growing forever, only the current cycle is interesting
+    del timings[:]
+    if readable:
+      # give DHCP a moment to finish, a new lease is usually several netlink messages
+      time.sleep(1)
+      drainNetlink(nlSock)
+      logger.info("Interface change seen on netlink, re-checking network")
+      runWatched(["network"])
+    else:
+      nextCycle=max(nextCycle + interval, time.monotonic())
+      runWatched(watchEvery)
+      inputs=watchInputs(nlSock is None)
+      changedInputs=[checkName for checkName in inputs if inputs[checkName] != lastInputs.get(checkName)]
+      if changedInputs:
+        logger.info(f"Inputs changed for: {changedInputs}")
+      # the binary and service findings are built from what the packages check found
+      if "packages" in changedInputs:
+        changedInputs.append("binSvcFindings")
+      runWatched([checkName for checkName in checkList if checkName in changedInputs])
+      # the packages check may have found different files to watch
+      lastInputs=watchInputs(nlSock is None) if "packages" in changedInputs else inputs
+    lastFindings=reportFindingChanges(lastFindings)
+
+#### START main processing flow
+def main(argv=None):
+  global args, jsonStream
+  args=buildParser().parse_args(argv)
+  # TODO: implement using verbosity level
+  if ( args.debug ):
+    if ( args.verbose == 0 ):
+      args.verbose = 1
+  # open the JSON report early, if it goes to stdout the console output has to move out of the way before anything
+  #   (like the verbose logging handler) grabs stdout
+  if ( args.json == "-" ):
+    jsonStream=sys.stdout
+    sys.stdout=sys.stderr
+  elif ( args.json ):
+    jsonStream=open(args.json, 'w')
+  if jsonStream is not None:
+    sys.excepthook=jsonExcepthook
+  setupLogging(args.log, args.verbose)
+
+  # ToDo list from bash logstring: (delete when completed)
+  # LOGSTRING="$LOGSTRING|SERVICE=$SERVICE"
+  # LOGSTRING="$LOGSTRING|PY=$PY"
+  # LOGSTRING="$LOGSTRING|PYVERS=$PYVERSION"
+  # LOGSTRING="$LOGSTRING|PYCOUNT=$PYCOUNT"
+  # LOGSTRING="$LOGSTRING|PYREQ=$PYREQ"
+  # LOGSTRING="$LOGSTRING|PYALA=$PYALA"
+
+  logger.info("args were "+str(args))
+  init(args.bash)
+  jsonEmit("header", pyVersion=vmaPyVersion, started=time.strftime("%Y-%m-%dT%H:%M:%S%z"), hostname=socket.gethostname(),
+           os={"id": osrID, "major": osMaj, "minor": osMin, "prettyName": os_release.get("PRETTY_NAME", "").strip('"')})
+
+  runChecks()
+  # END ALL CHECKS
+  jsonEmit("end", complete=True, elapsed=round(time.monotonic() - runStart, 3), stages=stageTimes,
+           calls=[{'category': key[0], 'name': key[1], 'count': value[0], 'total': round(value[1], 3), 'max': round(value[2], 3)}
+                  for key, value in timingProfile().items() if key[0] != "stage"],
+           bins=bins, services=services, checks=checks, findings=findings)
+  # all the timed calls are done, save the profile before the report in case the report itself fails
+  logTimingProfile()
+  if ( args.trace ):
+    writeTrace(args.trace)
+
+  # START OUTPUT
+  printReport()
+  if ( args.watch ):
+    # systemd stops us with SIGTERM, leave the same way as for Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+      watch(args.watch)
+    except (KeyboardInterrupt, SystemExit):
+      logger.info("Watch mode stopped")
+  logger.info("Python ended")
+  #if ( args.debug ):
+  # print("------------ DATA STRUCTURE DUMP ------------")
+  # # For development testing, These are the last pprint calls
+  # from pprint import pprint
+  # print("bins")
+  # pprint(bins)
+  # print("services")
+  # pprint(services)
+  # print("findings")
+  # pprint(findings)
+  # print("checks")
+  # pprint(checks)
+  # print("args")
+  # pprint(args)
+  # print("---------- END DATA STRUCTURE DUMP ----------")
+
+if __name__ == "__main__":
+  main()
@@ -28,6 +28,13 @@
 #      -h     Print this Help.
 #      -v     Verbose mode, up to -vvv.
 #      -r     Always show the 'bash' report when spawning the python script
+#      -j     Write the python script results as a JSON report to the given file
+#      -p     Write a Chrome trace of the python script checks to the given file
+#      -n     Don't use the package lookup cache in /var/cache/vmassist
+#      -w     Keep running and re-check every given number of seconds, reporting only changed findings
+#      -c     Kill any command the python script runs after this many seconds
+#      -e     Total seconds all commands of the python script may take
+#      -s     Run the python script's commands one at a time
 #
 # Need 
 # - disclaimers
@@ -63,7 +70,7 @@ UNITSTAT="undef"
 UNITSTATRC=0
 
 # process command-line switches
-while getopts ":hvr" option; do
+while getopts ":hvrj:p:nw:c:e:s" option; do
    case $option in
       h) # display Help
         echo "help would go here"
@@ -74,6 +81,20 @@ while getopts ":hvr" option; do
       r)
         BASHREPORT=1
         ;;
+      j) # JSON report file, handled by the python script which gets all our args
+        ;;
+      p) # trace file, also handled by the python script
+        ;;
+      n) # skip the package cache, also handled by the python script
+        ;;
+      w) # watch interval, also handled by the python script
+        ;;
+      c) # command timeout, also handled by the python script
+        ;;
+      e) # command deadline, also handled by the python script
+        ;;
+      s) # serial commands, also handled by the python script
+        ;;
       \?) # Invalid option
         echo "Error: Invalid option"
         exit;;